@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"Helper functions for tracking the performance of the core and the simulators"
+
+from __future__ import annotations
+
+import re
+import json
+import time
+import subprocess
+
+from simulate import run_simulation
+from util import info, warning, error
+
+# Programs the benchmarks are run on
+WORKLOADS = ["dhrystone", "basic"]
+
+# Dhrystones per second of the VAX 11/780, the reference for a single DMIPS
+_VAX_DHRYSTONES = 1757
+
+_RUNS_PATTERN = re.compile(r"for default of (\d+) runs")
+_USER_PATTERN = re.compile(r"User time: (\d+), User Inst: (\d+)")
+_COUNTER_PATTERNS = {
+    "mispredicted": re.compile(r"Mispredicted:\s+(\d+)"),
+    "data_stalled": re.compile(r"Data Stalled:\s+(\d+)"),
+    "control_stalled": re.compile(r"Control Stalled:\s+(\d+)"),
+    "frontend_stalled": re.compile(r"Frontend Stalled:\s+(\d+)"),
+    "backend_stalled": re.compile(r"Backend Stalled:\s+(\d+)"),
+}
+
+# Allowed regression of each metric in percent, the simulated metrics are
+# deterministic while the host speed is noisy
+DEFAULT_THRESHOLDS = {
+    "cycles": 1.0,
+    "cpi": 1.0,
+    "dmips_per_mhz": 1.0,
+    "cycles_per_second": 15.0,
+}
+
+# Metrics where a larger value is a regression
+_LOWER_IS_BETTER = {"cycles", "cpi"}
+
+
+def parse_benchmark_output(output):
+    """Parses the counters the program reports about itself, programs that do not
+    measure themselves only give an empty dictionary"""
+    metrics = {}
+    user = _USER_PATTERN.search(output)
+    if user is None:
+        return metrics
+    # The time CSR counts core cycles so the measured time is in cycles
+    user_cycles = int(user.group(1))
+    user_instructions = int(user.group(2))
+    metrics["user_cycles"] = user_cycles
+    metrics["user_instructions"] = user_instructions
+    if user_instructions > 0:
+        metrics["cpi"] = user_cycles / user_instructions
+    runs = _RUNS_PATTERN.search(output)
+    if runs is not None and user_cycles > 0:
+        dhrystones_per_cycle = int(runs.group(1)) / user_cycles
+        metrics["dmips_per_mhz"] = dhrystones_per_cycle * 1e6 / _VAX_DHRYSTONES
+    for name, pattern in _COUNTER_PATTERNS.items():
+        counter = pattern.search(output)
+        if counter is not None:
+            metrics[name] = int(counter.group(1))
+    return metrics
+
+
+def run_benchmark(simulator, name, binary, repeat=3, timeout=None):
+    """Runs a single workload on the simulator, the simulated metrics come from the
+    first run and the host speed is the best of every run"""
+    metrics = None
+    best_speed = None
+    for _ in range(repeat):
+        result = run_simulation(simulator, name, binary, timeout=timeout)
+        if not result.passed():
+            raise RuntimeError(f"Benchmark {name} did not pass: {result.status}!")
+        if metrics is None:
+            metrics = {"cycles": result.cycles}
+            metrics.update(parse_benchmark_output(result.output))
+        if result.cycles is not None and result.sim_time_us:
+            speed = result.cycles / (result.sim_time_us / 1e6)
+            best_speed = speed if best_speed is None else max(best_speed, speed)
+    metrics["cycles_per_second"] = best_speed
+    return metrics
+
+
+def _get_commit():
+    process = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, check=False
+    )
+    return process.stdout.decode("utf-8").strip() or None
+
+
+def run_benchmarks(simulator, programs, repeat=3, timeout=None):
+    "Runs every workload that was built on the simulator, returning a history entry"
+    workloads = {}
+    for name in WORKLOADS:
+        if name not in programs:
+            continue
+        workloads[name] = run_benchmark(
+            simulator,
+            name,
+            programs[name].get_binary(),
+            repeat=repeat,
+            timeout=timeout,
+        )
+    return {
+        "time": time.time(),
+        "commit": _get_commit(),
+        "simulator": simulator,
+        "workloads": workloads,
+    }
+
+
+def load_history(path):
+    "Reads the benchmark history, or nothing if no benchmarks were run yet"
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return []
+
+
+def write_history(history, path):
+    "Writes the benchmark history as JSON"
+    with open(path, "w") as file:
+        json.dump(history, file, indent=2)
+
+
+def load_baseline(path):
+    """Reads the baselines saved from earlier runs, one entry per simulator, or
+    nothing if no baseline was saved yet"""
+    try:
+        with open(path, "r") as file:
+            baselines = json.load(file)
+    except (OSError, ValueError):
+        return []
+    # Older baselines held the entry of a single simulator
+    if "simulator" in baselines:
+        return [baselines]
+    return list(baselines.values())
+
+
+def write_baseline(entry, path):
+    """Saves the entry as the baseline later runs of the same simulator are compared
+    against, keeping the baselines of the other simulators"""
+    baselines = {baseline["simulator"]: baseline for baseline in load_baseline(path)}
+    baselines[entry["simulator"]] = entry
+    with open(path, "w") as file:
+        json.dump(baselines, file, indent=2)
+
+
+def get_baseline(history, simulator):
+    "Returns the most recent entry for the same simulator, from the history or baselines"
+    for entry in reversed(history):
+        if entry["simulator"] == simulator:
+            return entry
+    return None
+
+
+def compare_benchmarks(entry, baseline, thresholds=None):
+    """Prints every metric next to the baseline, returning the descriptions of
+    the metrics that regressed past their threshold"""
+    if thresholds is None:
+        thresholds = DEFAULT_THRESHOLDS
+    regressions = []
+    for name, metrics in entry["workloads"].items():
+        old_metrics = {} if baseline is None else baseline["workloads"].get(name, {})
+        for metric, value in metrics.items():
+            old_value = old_metrics.get(metric)
+            if value is None:
+                continue
+            if old_value is None or old_value == 0:
+                info(f"{name} {metric}: {value:.4g}")
+                continue
+            change = (value - old_value) / old_value * 100
+            info(f"{name} {metric}: {value:.4g} ({change:+.2f}%)")
+            if metric not in thresholds:
+                continue
+            regression = change if metric in _LOWER_IS_BETTER else -change
+            if regression > thresholds[metric]:
+                message = (
+                    f"{name} {metric} regressed {regression:.2f}% "
+                    f"({old_value:.4g} -> {value:.4g})"
+                )
+                error(message)
+                regressions.append(message)
+    if baseline is None:
+        warning("No baseline to compare the benchmarks against")
+    return regressions
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"Benchmarks the readmemh hex conversion against the original per-byte converter"
+
+import io
+import os
+import time
+import argparse
+
+from util import info, convert_hex, convert_hex_stream
+
+
+def convert_hex_per_byte(src_bytes, dest_file):
+    "The original converter, kept as the reference point for the benchmark"
+    len_bytes = 0
+    word = ""
+    for src_byte in src_bytes:
+        word = "%02x" % (src_byte) + word
+        if len(word) >= 8:
+            dest_file.write(word + "\n")
+            word = ""
+        len_bytes += 1
+    if len(word) > 0:
+        dest_file.write(word + "\n")
+    return len_bytes
+
+
+def _time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--size", type=int, default=4, help="image size in MiB")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per converter")
+    args = parser.parse_args()
+
+    src_bytes = os.urandom(args.size << 20)
+    converters = {
+        "per-byte": lambda: convert_hex_per_byte(src_bytes, io.StringIO()),
+        "batched": lambda: convert_hex(src_bytes, io.StringIO()),
+        "streamed": lambda: convert_hex_stream(io.BytesIO(src_bytes), io.StringIO()),
+        "batched (64-bit)": lambda: convert_hex(
+            src_bytes, io.StringIO(), word_width=64
+        ),
+    }
+
+    baseline = None
+    for name, converter in converters.items():
+        duration = _time(converter, args.repeat)
+        baseline = duration if baseline is None else baseline
+        info(
+            f"{name:>16}: {duration * 1000:8.1f} ms, "
+            f"{args.size / duration:8.1f} MiB/s, {baseline / duration:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,149 +5,691 @@ Builds the RTL with verilator
 
 from __future__ import annotations
 
+import io
 import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
 import subprocess
 import time
-import copy
 import glob
-from typing import Dict
+from fnmatch import fnmatch
 from pathlib import Path
-from filecmp import cmp as filecmp
-from shutil import copy as filecopy
 
-from util import info, error
-from riscv import RiscvProgram, write_riscv_ninja_rules
+from ninja.misc.ninja_syntax import Writer as NinjaWriter
+
+from util import info, error, debug
+from benchmark import (
+    DEFAULT_THRESHOLDS,
+    compare_benchmarks,
+    get_baseline,
+    load_baseline,
+    load_history,
+    run_benchmarks,
+    write_baseline,
+    write_history,
+)
+from checkpoint import CheckpointStore, get_restore_args
+from compile_cache import CompileCache, get_cache_dir, get_launcher
+from graph import ImportGraph
+from riscv import RiscvProgram, get_linker_memory_size, write_riscv_ninja_rules
+from simulate import run_simulation, run_simulations, write_results
+from sources import (
+    HeaderFile,
+    SourceCache,
+    SourceFile,
+    search_folders,
+    search_headers,
+    search_sources,
+)
+from timing import (
+    BuildTimer,
+    get_ninja_rules,
+    get_ninja_steps,
+    get_step_durations,
+    load_report,
+    print_report,
+    read_ninja_log,
+    write_report,
+)
 from verilator import (
+    OUTPUT_SPLITS,
+    PROFILES,
+    VerilatorProfile,
     VerilatorProgram,
+    get_profile,
+    get_pgo_profile,
+    load_output_splits,
+    save_output_splits,
     write_verilator_ninja_rules,
     write_verilator_compile_ninja_rules,
 )
+from watch import get_watcher
 
+RTL_ROOT = "rtl"
+# Special comments parsed from every RTL file, kept between builds
+SOURCES_CACHE = "bin/sources_cache.json"
 
-def get_includes_imports(path):
-    """Parses special comments in the file to find dependencies"""
-    with open(path, "r") as file:
-        include_paths = []
-        import_paths = []
-        wrapper_path = None
-        no_lint = False
-        for line in file.readlines():
-            if line.startswith("//!import "):
-                import_paths.append("rtl/" + line[len("//!import") :].strip())
-            elif line.startswith("//!include "):
-                include_paths.append("rtl/" + line[len("//!include") :].strip())
-            elif line.startswith("//!wrapper "):
-                wrapper_path = "wrappers/" + line[len("//!wrapper") :].strip()
-            elif line.startswith("//!no_lint"):
-                no_lint = True
-            elif line == "":
-                pass
-            else:
-                break
-        return include_paths, import_paths, wrapper_path, no_lint
-
-
-class HeaderFile:
-    """Describes dependencies of .svh files"""
-
-    def __init__(self, path) -> None:
-        self.path = path
-        self.includes, _, _, _ = get_includes_imports(path)
-
-
-class SourceFile:
-    """Describes dependencies of .sv files"""
-
-    def __init__(self, path) -> None:
-        self.path = path
-        self.includes, self.imports, self.wrapper, self.no_lint = get_includes_imports(
-            path
-        )
-        self.dependencies = None
-
-    def _get_dependencies(
-        self,
-        source_files: Dict[str, SourceFile],
-        source_files_used: Dict[str, SourceFile],
-    ):
-        dependencies = []
-        # Add sub-dependencies to list
-        for import_path in self.imports:
-            if import_path in source_files:
-                dependencies += source_files[import_path]._get_dependencies(
-                    source_files, source_files_used
-                )
-            elif import_path in source_files_used:
-                pass
-            else:
-                raise RuntimeError(f"File {import_path} not found!")
-        # Add dependencies to list and indicate as used
-        for import_path in self.imports:
-            if import_path in source_files:
-                source_files_used[import_path] = source_files[import_path]
-                del source_files[import_path]
-                dependencies += [import_path]
-        # Add this file to the list and indicate as used
-        if self.path in source_files:
-            source_files_used[self.path] = source_files[self.path]
-            del source_files[self.path]
-            dependencies += [self.path]
-        else:
-            raise RuntimeError(
-                f"File {self.path} already imported, likely circular dependency!"
-            )
-        return dependencies
+# What the build graph was last written for, ninja regenerates the graph from it
+BUILD_CONFIG = "bin/build_config.json"
+# Everything the build graph was generated from
+BUILD_DEPFILE = "bin/build.ninja.d"
+# Environment variables the toolchain paths in the build graph are read from
+BUILD_ENVIRONMENT = ["LLVM_ROOT", "RISCV_GNU_ROOT"]
 
-    def get_dependencies(self, source_files=None):
-        "Returns a list of all the SV dependencies listed in included order"
-        if source_files is None and self.dependencies is None:
-            error(
-                f"{self.path} asked for dependencies without being given source files first!"
-            )
-        if self.dependencies is None:
-            self.dependencies = self._get_dependencies(copy.deepcopy(source_files), {})
-            if self.wrapper is not None:
-                self.dependencies += [self.wrapper]
-        return self.dependencies
 
+def write_build_ninja_rules(writer):
+    ninja_writer = NinjaWriter(writer)
+    ninja_writer.comment("Rules for reloading the build graph")
 
-def search_headers(path):
-    header_files = {}
-    for glob_path in glob.glob(os.path.join(path, "*.svh")):
-        header_files[glob_path] = HeaderFile(glob_path)
-    return header_files
+    # The graph regenerates itself whenever the scripts, the RTL folders or the
+    # compile steps of a model change, so unchanged builds never leave ninja
+    ninja_writer.rule(
+        name="build_reload",
+        command=f"{sys.executable} build.py --configure",
+        description="Regenerating build graph...",
+        depfile=BUILD_DEPFILE,
+        generator=True,
+    )
 
+    ninja_writer.newline()
 
-def search_sources(path):
-    source_files = {}
-    for glob_path in glob.glob(os.path.join(path, "*.sv")):
-        source_files[glob_path] = SourceFile(glob_path)
-    return source_files
 
+def write_build_ninja_models(writer, verilated):
+    """Includes the compile steps of every verilated model, ninja rebuilds them
+    and restarts with the new steps before building anything else"""
+    ninja_writer = NinjaWriter(writer)
+    ninja_writer.comment("Compile steps discovered after verilation")
 
-def main():
-    """Main function"""
-    rtl_folders = [
-        "rtl/std",
-        "rtl/xilinx",
-        "rtl/asic",
-        "rtl/mem",
-        "rtl/stream",
-        "rtl/riscv",
-        "rtl/gecko",
-        "rtl/gecko/cores",
+    compile_ninjas = [v.get_compile_ninja() for v in verilated]
+    for compile_ninja in compile_ninjas:
+        # The steps only exist once the model has been verilated
+        if not Path(compile_ninja).is_file():
+            Path(compile_ninja).write_text("")
+        ninja_writer.subninja(compile_ninja)
+    ninja_writer.build(
+        outputs="build.ninja",
+        rule="build_reload",
+        implicit=compile_ninjas + [BUILD_CONFIG],
+    )
+
+    ninja_writer.newline()
+
+
+def write_build_depfile(source_files):
+    """Lists every script and RTL file the build graph depends on, the folders are
+    listed so added or removed sources regenerate the graph as well"""
+    root = os.getcwd()
+    inputs = set()
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path is not None and os.path.abspath(path).startswith(root + os.sep):
+            inputs.add(os.path.relpath(path))
+    for path, source_file in source_files.items():
+        inputs.add(path)
+        inputs.update(source_file.includes)
+    for folder, _, _ in os.walk(RTL_ROOT):
+        inputs.add(folder)
+    inputs.add("riscv-tests/isa/rv32ui")
+    inputs.add(OUTPUT_SPLITS)
+    with open(BUILD_DEPFILE, "w") as file:
+        file.write("build.ninja:")
+        # Missing inputs would leave the graph dirty forever
+        for path in sorted(filter(os.path.exists, inputs)):
+            file.write(f" \\\n  {path}")
+        file.write("\n")
+
+
+def load_build_config():
+    "Returns the configuration the build graph was last written for"
+    try:
+        with open(BUILD_CONFIG, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_build_config(config):
+    "Stores the configuration, only touching the file if it changed"
+    text = json.dumps(config, indent=2)
+    if Path(BUILD_CONFIG).is_file() and Path(BUILD_CONFIG).read_text() == text:
+        return
+    Path(BUILD_CONFIG).write_text(text)
+
+
+def _match_targets(patterns, targets, kind):
+    """Returns the targets with a name matching any of the globs, every pattern has
+    to match at least one target"""
+    matched = set()
+    for pattern in patterns:
+        found = {
+            target
+            for target, names in targets.items()
+            if any(fnmatch(name, pattern) for name in names)
+        }
+        if len(found) == 0:
+            raise RuntimeError(f"No {kind} matches {pattern}!")
+        matched |= found
+    return matched
+
+
+def get_selection(args):
+    "Returns the targets selected on the command line"
+    return {"top": args.top, "module": args.module, "program": args.program}
+
+
+def select_programs(riscv_programs, selection):
+    """Returns the programs to build, every program unless some were selected or
+    only modules were selected"""
+    if len(selection["program"]) > 0:
+        targets = {
+            name: [name, program.name] for name, program in riscv_programs.items()
+        }
+        matched = _match_targets(selection["program"], targets, "program")
+        return {
+            name: program for name, program in riscv_programs.items() if name in matched
+        }
+    if len(selection["module"]) > 0 and len(selection["top"]) == 0:
+        return {}
+    return riscv_programs
+
+
+def select_sources(source_files, selection):
+    """Returns the top-level modules to verilate and the modules to lint, None lints
+    every module. Top-level modules are the ones with a testbench, every one of them
+    runs the selected programs unless some were selected. Selected modules are
+    linted along with everything they import"""
+    top_level = [
+        path
+        for path, source_file in source_files.items()
+        if Path(VerilatorProgram(source_file).cpp_file).is_file()
     ]
-    top_level = ["rtl/gecko/cores/gecko_nano.sv"]
+    if not any(len(patterns) > 0 for patterns in selection.values()):
+        return top_level, None
 
-    # Make sure bin/ folder(s) exists
-    Path("bin/").mkdir(parents=True, exist_ok=True)
-    Path("bin/obj_dir").mkdir(parents=True, exist_ok=True)
-    Path("bin/riscv-tests/").mkdir(parents=True, exist_ok=True)
-    Path("bin/verilator/").mkdir(parents=True, exist_ok=True)
+    if len(selection["top"]) > 0:
+        targets = {path: [Path(path).stem, path] for path in top_level}
+        matched = _match_targets(selection["top"], targets, "top-level module")
+        top_level = [path for path in top_level if path in matched]
+    elif len(selection["program"]) == 0:
+        # Only modules were selected, they are only linted
+        top_level = []
+    targets = {path: [Path(path).stem, path] for path in source_files}
+    lint = set()
+    for path in _match_targets(selection["module"], targets, "module"):
+        lint.add(path)
+        lint.update(
+            dependency
+            for dependency in source_files[path].get_dependencies()
+            if dependency in source_files
+        )
+    return top_level, lint
+
+
+def get_memory_groups(riscv_programs):
+    """Groups the programs by linker script, which places their stack and so decides
+    the memory they need. Each group gets a simulator with memory for its largest
+    program. The group whose linker script declares the most memory is keyed by ""
+    so its simulators keep the plain model name, the others are variants named
+    after their linker script"""
+    groups = {}
+    for name, program in riscv_programs.items():
+        groups.setdefault(program.get_linker_script(), {})[name] = program
+    if len(groups) == 0:
+        return {"": {}}
+    default = max(sorted(groups), key=get_linker_memory_size)
+    return {
+        "" if linker_script == default else Path(linker_script).stem: programs
+        for linker_script, programs in groups.items()
+    }
+
+
+def tune_output_split(v, durations, splits, jobs):
+    "Tunes the output split of the model from the compile times of the last build"
+    tuned = v.tune_output_split(durations, jobs)
+    if tuned is None:
+        info(f"No compile times to tune {v.model_name} with, build it first")
+        return
+    old_split = v.get_output_split()
+    splits[v.model_name] = tuned["output_split"]
+    info(
+        f"Output split for {v.model_name}: {old_split} -> {tuned['output_split']} "
+        f"({tuned['files']} files, {tuned['current']:.2f}s -> "
+        f"{tuned['predicted']:.2f}s predicted compile time)"
+    )
+
+
+def write_build_ninja(
+    riscv_programs,
+    source_files,
+    profiles,
+    selection,
+    launcher="",
+    restat=True,
+    tune_jobs=None,
+):
+    """Writes the build graph for the selected targets, returning the models verilated
+    for every profile. The configuration is stored so ninja can write the same graph
+    again by itself. With tune_jobs the output split of every model is first tuned
+    for compiling on that many cores"""
+    riscv_programs = select_programs(riscv_programs, selection)
+    top_level, lint = select_sources(source_files, selection)
+    groups = get_memory_groups(riscv_programs)
+    verilated = []
+    simulator_programs = {}
+    if tune_jobs is not None:
+        durations = get_step_durations(read_ninja_log())
+        splits = load_output_splits()
+    with io.StringIO() as ninja_file:
+        write_build_ninja_rules(ninja_file)
+        write_riscv_ninja_rules(ninja_file, launcher=launcher)
+        write_verilator_ninja_rules(ninja_file)
+        write_verilator_compile_ninja_rules(ninja_file, launcher=launcher)
+        for program in riscv_programs.values():
+            program.write_ninja_build(ninja_file)
+        for path, source_file in source_files.items():
+            if path not in top_level:
+                if lint is None or path in lint:
+                    v = VerilatorProgram(source_file, lint_only=True)
+                    v.write_ninja_build_verilate(ninja_file)
+                continue
+            for profile in profiles:
+                for variant, programs in groups.items():
+                    v = VerilatorProgram(source_file, profile=profile, variant=variant)
+                    if tune_jobs is not None:
+                        tune_output_split(v, durations, splits, tune_jobs)
+                        save_output_splits(splits)
+                    v.write_ninja_build_verilate(
+                        ninja_file,
+                        stats=[program.get_stats() for program in programs.values()],
+                    )
+                    verilated.append(v)
+                    simulator_programs[v.get_simulator()] = list(programs)
+        write_build_ninja_models(ninja_file, verilated)
+        # The graph is written last so it is newer than everything it was made from
+        write_build_depfile(source_files)
+        save_build_config(
+            {
+                "selection": selection,
+                "profiles": [profile.to_dict() for profile in profiles],
+                "launcher": launcher,
+                "environment": {
+                    name: os.environ.get(name) for name in BUILD_ENVIRONMENT
+                },
+                "simulators": [v.get_simulator() for v in verilated],
+                "models": {v.get_simulator(): v.get_model_hash() for v in verilated},
+                "programs": simulator_programs,
+            }
+        )
+        Path("build.ninja").write_text(ninja_file.getvalue())
+    # Ninja compares the inputs against the time it last wrote the graph itself, so
+    # it has to be told about the new graph unless it is the one regenerating it
+    if restat and Path(".ninja_log").is_file():
+        subprocess.run(
+            ["ninja", "-f", "build.ninja", "-t", "restat", "build.ninja"],
+            capture_output=True,
+            check=False,
+        )
+    return verilated
+
+
+def get_simulator_programs(config, simulator, riscv_programs):
+    "Returns the programs that are run on the simulator"
+    return {name: riscv_programs[name] for name in config["programs"][simulator]}
+
+
+def is_configured(profiles, selection, launcher):
+    "Returns if the build graph was written for the same options"
+    config = load_build_config()
+    return (
+        config is not None
+        and Path("build.ninja").is_file()
+        and config["selection"] == selection
+        and config["profiles"] == [profile.to_dict() for profile in profiles]
+        and config["launcher"] == launcher
+        and config["environment"]
+        == {name: os.environ.get(name) for name in BUILD_ENVIRONMENT}
+    )
+
+
+def run_ninja(timer=None, targets=None):
+    """Runs the build graph, or only what the targets need, recording the steps ninja
+    ran with the timer if given"""
+    old_log = read_ninja_log()
+    start = time.time()
+    subprocess.run(
+        ["ninja", "-f", "build.ninja"] + (targets or []),
+        capture_output=False,
+        check=True,
+    )
+    duration = time.time() - start
+    print(f"Time: {duration:.3}s...")
+    if timer is not None:
+        new_log = read_ninja_log()
+        # Listing the rules of the graph is only worth it if anything ran
+        rules = get_ninja_rules() if new_log != old_log else {}
+        timer.add_ninja_run(get_ninja_steps(old_log, new_log, rules))
+
+
+def get_build_launcher(args):
+    "Returns the launcher compiles are run through"
+    if args.no_cache:
+        return ""
+    return get_launcher(args.cache_dir, max_size=args.cache_size)
+
+
+def get_build_cache_stats(args):
+    "Returns the statistics of the compile cache"
+    return CompileCache(get_cache_dir(args.cache_dir)).get_stats()
+
+
+def get_pgo_training_set(riscv_programs, samples):
+    "Returns dhrystone plus an evenly spaced sample of the other programs"
+    training = {}
+    if "dhrystone" in riscv_programs:
+        training["dhrystone"] = riscv_programs["dhrystone"]
+    others = sorted(name for name in riscv_programs if name not in training)
+    step = max(1, len(others) // max(1, samples))
+    for name in others[::step][:samples]:
+        training[name] = riscv_programs[name]
+    return training
+
+
+def train_pgo_profile(
+    args, riscv_programs, source_files, selection, profiles, timer=None
+):
+    """Returns the profile-guided profile, first building an instrumented model and
+    training it when no profiles exist for the current RTL"""
+    top_level, _ = select_sources(source_files, selection)
+    base = get_profile("fast", threads=args.threads, savable=args.savable)
+    digest = hashlib.sha1(json.dumps(base.to_dict()).encode("utf-8"))
+    for path in top_level:
+        v = VerilatorProgram(source_files[path], profile=base)
+        digest.update(v.get_closure_hash().encode("utf-8"))
+    profile_dir = Path("bin/pgo") / digest.hexdigest()[:16]
+
+    trained = profile_dir / "trained"
+    if trained.is_file():
+        info(f"Reusing PGO profiles from {profile_dir}...")
+        return get_pgo_profile(base, str(profile_dir), generate=False)
+
+    info("Building instrumented simulators for PGO...")
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    instrumented = get_pgo_profile(base, str(profile_dir), generate=True)
+    verilated = write_build_ninja(
+        riscv_programs,
+        source_files,
+        profiles + [instrumented],
+        selection,
+        launcher=get_build_launcher(args),
+    )
+    run_ninja(timer)
+
+    info("Training PGO profiles...")
+    simulator_programs = load_build_config()["programs"]
+    for v in verilated:
+        if v.profile is not instrumented:
+            continue
+        training = get_pgo_training_set(
+            {
+                name: riscv_programs[name]
+                for name in simulator_programs[v.get_simulator()]
+            },
+            args.pgo_samples,
+        )
+        vlt_args = {
+            name: [f"+verilator+prof+vlt+file+{profile_dir}/V{v.model_name}_{name}.vlt"]
+            for name in training
+        }
+        run_simulations(
+            v.get_simulator(),
+            training,
+            jobs=args.jobs,
+            timeout=args.timeout,
+            args=vlt_args,
+        )
+        # Verilator takes one profile per model, the first recorded one is used so
+        # dhrystone is preferred as the most representative workload
+        recorded = [
+            profile_dir / f"V{v.model_name}_{name}.vlt"
+            for name in training
+            if (profile_dir / f"V{v.model_name}_{name}.vlt").is_file()
+        ]
+        if len(recorded) == 0:
+            raise RuntimeError(f"No PGO profile was recorded for {v.model_name}!")
+        shutil.copyfile(recorded[0], profile_dir / f"V{v.model_name}.vlt")
+    trained.touch()
+
+    # Only keep the most recent profiles around
+    for old_dir in sorted(
+        Path("bin/pgo").iterdir(), key=lambda path: path.stat().st_mtime
+    )[:-3]:
+        shutil.rmtree(old_dir)
+
+    return get_pgo_profile(base, str(profile_dir), generate=False)
+
+
+def parse_args():
+    "Parses the command line arguments"
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        "-p",
+        "--profile",
+        action="append",
+        choices=PROFILES,
+        help="simulator build profile, can be given more than once (default: debug)",
+    )
+    parser.add_argument(
+        "-t",
+        "--top",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="only build the top-level modules matching the name or glob",
+    )
+    parser.add_argument(
+        "-m",
+        "--module",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="only lint the modules matching the name or glob and what they import",
+    )
+    parser.add_argument(
+        "--program",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="only build the RISCV programs matching the name or glob",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="verilator threads used by the fast and max profiles",
+    )
+    parser.add_argument(
+        "--trace-fst",
+        action="store_true",
+        help="traced simulators write compressed FST waveforms instead of VCD",
+    )
+    parser.add_argument(
+        "--trace-max-array",
+        type=int,
+        default=None,
+        metavar="ENTRIES",
+        help="largest array the traced simulators dump, raise it to trace the memories",
+    )
+    parser.add_argument(
+        "--savable",
+        action="store_true",
+        help="build single threaded simulators that can save and restore checkpoints",
+    )
+    parser.add_argument(
+        "--pgo",
+        action="store_true",
+        help="also build a profile-guided simulator, training it when the RTL changes",
+    )
+    parser.add_argument(
+        "--pgo-samples",
+        type=int,
+        default=8,
+        help="number of riscv-tests programs run alongside dhrystone for PGO training",
+    )
+    parser.add_argument(
+        "--tune",
+        action="store_true",
+        help="tune how verilator splits each model from the compile times of the last build",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="compile without the object cache",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="object cache folder (default: $REPTILIA_CACHE_DIR or ~/.cache/reptilia)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=None,
+        help="size in bytes the object cache is bounded to",
+    )
+    parser.add_argument(
+        "--run",
+        action="store_true",
+        help="run every RISCV program on the simulators after building",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="run the programs in batches, one simulator process per job",
+    )
+    parser.add_argument(
+        "--checkpoint-cycle",
+        type=int,
+        default=None,
+        metavar="CYCLE",
+        help="run every program from a checkpoint saved at the cycle (needs --savable)",
+    )
+    parser.add_argument(
+        "--checkpoint-pc",
+        type=lambda value: int(value, 0),
+        default=None,
+        metavar="ADDRESS",
+        help="run every program from a checkpoint saved at the first jump to the address",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of simulators to run in parallel",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="wall-clock timeout in seconds for each simulation",
+    )
+    parser.add_argument(
+        "--results",
+        default="bin/results.json",
+        help="where to write the simulation results table",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="run the benchmarks on the simulators and check them for regressions",
+    )
+    parser.add_argument(
+        "--benchmark-repeat",
+        type=int,
+        default=3,
+        help="number of times each benchmark is run to measure the host speed",
+    )
+    parser.add_argument(
+        "--history",
+        default="bin/benchmarks.json",
+        help="where the benchmark history is kept",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="benchmark baseline to compare against (default: the last run)",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save this benchmark run as the baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        action="append",
+        default=[],
+        metavar="METRIC=PERCENT",
+        help="allowed regression of a benchmark metric, can be given more than once",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep rebuilding whatever each change to the sources affects",
+    )
+    parser.add_argument(
+        "--smoke",
+        default=None,
+        metavar="PROGRAM",
+        help="program run on the simulators after each rebuild in watch mode",
+    )
+    parser.add_argument(
+        "--configure",
+        action="store_true",
+        help="only write the build graph again from the last configuration (run by ninja)",
+    )
+    parser.add_argument(
+        "--report",
+        default="bin/build_report.json",
+        help="where to write the build timing report",
+    )
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="previous build timing report to compare against",
+    )
+    args = parser.parse_args()
+    if args.profile is None:
+        args.profile = ["debug"]
+    if args.save_baseline and args.baseline is None:
+        parser.error("--save-baseline needs --baseline to know where to save it")
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    for threshold in args.threshold:
+        metric, _, percent = threshold.partition("=")
+        if metric not in thresholds:
+            parser.error(f"unknown benchmark metric {metric}")
+        thresholds[metric] = float(percent)
+    args.threshold = thresholds
+    args.checkpoint = (
+        args.checkpoint_cycle is not None or args.checkpoint_pc is not None
+    )
+    if args.checkpoint and not args.savable:
+        parser.error("checkpoints need simulators built with --savable")
+    if args.checkpoint and args.batch:
+        parser.error("checkpoints cannot be restored in batch mode")
+    if args.watch and (args.pgo or args.tune):
+        parser.error("--watch cannot be combined with --pgo or --tune")
+    if args.smoke is not None and not args.watch:
+        parser.error("--smoke only applies to --watch")
+    return args
 
+
+def get_riscv_programs():
+    "Returns every RISCV program the build compiles"
     riscv_programs = {}
 
-    info("Compiling RISCV programs...")
     riscv_programs["dhrystone"] = RiscvProgram(
         "dhrystone/dhrystone",
         [
@@ -181,26 +723,19 @@ def main():
             linker_script="tests/gecko_assembled.ld",
             include_folders=["riscv-tests/isa/macros/scalar/", "tests/"],
         )
+    return riscv_programs
 
-    with open("build_riscv.ninja", "w") as ninja_file:
-        write_riscv_ninja_rules(ninja_file)
-        for program in riscv_programs.values():
-            program.write_ninja_build(ninja_file)
-
-    subprocess.run(
-        ["ninja", "-f", "build_riscv.ninja"], capture_output=False, check=True
-    )
-
-    for program in riscv_programs.values():
-        program.get_program_stats()
-        # program.print_info()
 
+def scan_sources():
+    "Finds every RTL source and resolves their dependencies"
     info("Finding RTL dependencies...")
+    source_cache = SourceCache(SOURCES_CACHE)
     header_files = {}
     source_files = {}
-    for folder in rtl_folders:
-        header_files = {**header_files, **search_headers(folder)}
-        source_files = {**source_files, **search_sources(folder)}
+    for folder in search_folders(RTL_ROOT, cache=source_cache):
+        header_files = {**header_files, **search_headers(folder, cache=source_cache)}
+        source_files = {**source_files, **search_sources(folder, cache=source_cache)}
+    source_cache.save()
 
     info("Verifying RTL dependencies...")
     for path, source_file in source_files.items():
@@ -216,50 +751,382 @@ def main():
                     f"""File {path} imports {import_path} which does not exist!
                         {source_files.keys()}"""
                 )
+    import_graph = ImportGraph(source_files)
     for _, source_file in source_files.items():
-        source_file.get_dependencies(source_files=source_files)
+        source_file.get_dependencies(graph=import_graph)
+    return source_files
 
-    info("Verilating RTL...")
-    verilated = []
-    with open("build_verilator.ninja", "w") as ninja_file:
-        write_verilator_ninja_rules(ninja_file)
-        for path, source_file in source_files.items():
-            lint_only = path not in top_level
-            verilator_args = None
-            if not lint_only and len(riscv_programs) > 0:
-                _, program = next(iter(riscv_programs.items()))
-                verilator_args = [f"-GMEMORY_ADDR_WIDTH={program.address_width}"]
-            v = VerilatorProgram(source_file, lint_only=lint_only)
-            v.write_ninja_build_verilate(ninja_file, verilator_args=verilator_args)
-            if not lint_only:
-                verilated.append(v)
 
-    subprocess.run(
-        ["ninja", "-f", "build_verilator.ninja"],
-        capture_output=False,
-        check=True,
+def configure():
+    "Writes the build graph again from the stored configuration"
+    config = load_build_config()
+    if config is None:
+        raise RuntimeError("The build was never configured, run ./build.py first!")
+    # Ninja can be run from a shell without the toolchain variables
+    for name, value in config["environment"].items():
+        if value is not None:
+            os.environ[name] = value
+    write_build_ninja(
+        get_riscv_programs(),
+        scan_sources(),
+        [VerilatorProfile(**profile) for profile in config["profiles"]],
+        config["selection"],
+        launcher=config["launcher"],
+        restat=False,
     )
 
-    info("Merging obj_dir...")
-    for path in Path("obj_dir").rglob("*.*"):
-        new_path = Path("bin") / path
-        if not new_path.is_file() or not filecmp(str(path), str(new_path)):
-            filecopy(str(path), str(new_path))
 
-    info("Compiling RTL...")
-    with open("build_verilator_compile.ninja", "w") as ninja_file:
-        write_verilator_compile_ninja_rules(ninja_file)
-        for v in verilated:
-            v.write_ninja_build_verilate_compile(ninja_file)
+def update_sources(changed, source_files, source_cache):
+    """Parses the changed RTL sources again in place, returning False if sources were
+    added or removed or their special comments changed, then every source has to be
+    scanned again"""
+    headers = {
+        path for source_file in source_files.values() for path in source_file.includes
+    }
+    for path in changed:
+        if not path.startswith(RTL_ROOT + os.sep) or not path.endswith((".sv", ".svh")):
+            continue
+        known = path in source_files or path in headers
+        if not os.path.isfile(path):
+            if known:
+                return False
+            continue
+        if path.endswith(".svh"):
+            continue
+        if not known:
+            return False
+        old_file = source_files[path]
+        source_file = SourceFile(path, cache=source_cache)
+        if (
+            source_file.includes != old_file.includes
+            or source_file.imports != old_file.imports
+            or source_file.wrapper != old_file.wrapper
+            or source_file.no_lint != old_file.no_lint
+        ):
+            return False
+        source_file.dependencies = old_file.dependencies
+        source_files[path] = source_file
+    source_cache.save()
+    return True
 
-    start = time.time()
-    subprocess.run(
-        ["ninja", "-f", "build_verilator_compile.ninja", "-v"],
-        capture_output=False,
-        check=True,
+
+def get_including_sources(source_files, headers, source_cache):
+    "Returns the sources that include the headers, directly or through other headers"
+    headers = set(headers)
+    included = {
+        path for source_file in source_files.values() for path in source_file.includes
+    }
+    found = True
+    while found:
+        found = False
+        for path in included - headers:
+            if os.path.isfile(path) and headers & set(
+                HeaderFile(path, source_cache).includes
+            ):
+                headers.add(path)
+                found = True
+    return {
+        path
+        for path, source_file in source_files.items()
+        if headers & set(source_file.includes)
+    }
+
+
+def get_watch_targets(
+    changed,
+    source_files,
+    graph,
+    verilated,
+    lint,
+    riscv_programs,
+    simulator_programs,
+    source_cache,
+):
+    """Returns the outputs of the build graph the changed files can affect, ninja
+    works out which of them are actually out of date"""
+    sources = set()
+    for path in changed:
+        if path in source_files or path in graph.wrapped:
+            sources |= graph.get_dependents(path)
+    headers = [path for path in changed if path.endswith(".svh")]
+    for path in get_including_sources(source_files, headers, source_cache):
+        sources |= graph.get_dependents(path)
+
+    targets = set()
+    top_level = {v.path for v in verilated}
+    for v in verilated:
+        if v.path in sources or v.cpp_file in changed or v.cosim_file in changed:
+            targets.add(v.get_simulator())
+            if v.get_cosim_library() is not None:
+                targets.add(v.get_cosim_library())
+    for path in sources:
+        if (
+            path in source_files
+            and path not in top_level
+            and not source_files[path].no_lint
+            and (lint is None or path in lint)
+        ):
+            targets.add(VerilatorProgram(source_files[path], lint_only=True).get_log())
+
+    build_files = {
+        name: set(program.get_build_files() + [program.get_linker_script()])
+        for name, program in riscv_programs.items()
+    }
+    # Anything else under tests/ is a header some of the programs include
+    shared = any(
+        path.startswith("tests" + os.sep)
+        and not any(path in files for files in build_files.values())
+        for path in changed
     )
-    duration = time.time() - start
-    print(f"Time: {duration:.3}s...")
+    programs = {
+        name for name, files in build_files.items() if shared or changed & files
+    }
+    for name in programs:
+        targets.add(riscv_programs[name].get_stats())
+    # The memory of the simulators is sized for the programs run on them
+    for simulator, names in simulator_programs.items():
+        if programs & set(names):
+            targets.add(simulator)
+    return sorted(targets)
+
+
+def run_smoke_test(name, riscv_programs, timeout=None):
+    "Runs the program on every simulator it is built for"
+    config = load_build_config()
+    for simulator in config["simulators"]:
+        if name not in config["programs"][simulator]:
+            continue
+        result = run_simulation(
+            simulator, name, riscv_programs[name].get_binary(), timeout=timeout
+        )
+        report = info if result.passed() else error
+        report(f"{name} on {simulator}: {result.status} ({result.cycles} cycles)")
+
+
+def watch_build(args, riscv_programs, profiles, selection, launcher):
+    """Rebuilds only what each change to the sources affects until interrupted. The
+    sources are kept in memory so only the changed ones are parsed again, and the
+    build graph is written here so ninja never has to scan them itself"""
+    riscv_programs = select_programs(riscv_programs, selection)
+    if args.smoke is not None and args.smoke not in riscv_programs:
+        raise RuntimeError(f"Smoke test {args.smoke} is not one of the built programs!")
+    # Changes made during the first build are picked up once it is done
+    watcher = get_watcher()
+    source_files = scan_sources()
+    source_cache = SourceCache(SOURCES_CACHE)
+    graph = ImportGraph(source_files)
+    scanned = True
+    info("Writing build graph...")
+    verilated = write_build_ninja(
+        riscv_programs, source_files, profiles, selection, launcher=launcher
+    )
+    info("Building...")
+    try:
+        try:
+            run_ninja()
+        except subprocess.CalledProcessError:
+            error("Build failed!")
+        while True:
+            info("Watching for changes...")
+            changed = {os.path.normpath(path) for path in watcher.wait()}
+            start = time.time()
+            rtl_changed = any(path.startswith(RTL_ROOT + os.sep) for path in changed)
+            try:
+                if rtl_changed and (
+                    not scanned
+                    or not update_sources(changed, source_files, source_cache)
+                ):
+                    # Sources broken mid-edit are scanned again after the next change
+                    scanned = False
+                    source_files = scan_sources()
+                    source_cache = SourceCache(SOURCES_CACHE)
+                    graph = ImportGraph(source_files)
+                    scanned = True
+            except RuntimeError as exception:
+                error(str(exception))
+                continue
+            _, lint = select_sources(source_files, selection)
+            targets = get_watch_targets(
+                changed,
+                source_files,
+                graph,
+                verilated,
+                lint,
+                riscv_programs,
+                load_build_config()["programs"],
+                source_cache,
+            )
+            if len(targets) == 0:
+                debug(f"Nothing is built from {', '.join(sorted(changed))}")
+                continue
+            # The graph lists every RTL file as an input, writing it again here keeps
+            # ninja from scanning all of them to regenerate it
+            if rtl_changed:
+                verilated = write_build_ninja(
+                    riscv_programs, source_files, profiles, selection, launcher=launcher
+                )
+            info(f"Rebuilding {len(targets)} targets...")
+            try:
+                run_ninja(targets=targets)
+            except subprocess.CalledProcessError:
+                error("Build failed!")
+                continue
+            if args.smoke is not None and any(
+                target.endswith("_simulator")
+                or target == riscv_programs[args.smoke].get_stats()
+                for target in targets
+            ):
+                run_smoke_test(args.smoke, riscv_programs, timeout=args.timeout)
+            info(f"Change handled in {time.time() - start:.3}s")
+    except KeyboardInterrupt:
+        info("Stopped watching")
+    finally:
+        watcher.close()
+
+
+def main():
+    """Main function"""
+    args = parse_args()
+    # Make sure bin/ folder(s) exists
+    Path("bin/").mkdir(parents=True, exist_ok=True)
+    Path("bin/riscv-tests/").mkdir(parents=True, exist_ok=True)
+    Path("bin/verilator/").mkdir(parents=True, exist_ok=True)
+    if args.configure:
+        configure()
+        return
+
+    timer = BuildTimer()
+    # Read the previous report before this build replaces it
+    previous = None if args.compare is None else load_report(args.compare)
+
+    selection = get_selection(args)
+    riscv_programs = get_riscv_programs()
+    timer.lap("programs")
+
+    profiles = [
+        get_profile(
+            name,
+            threads=args.threads,
+            trace_fst=args.trace_fst,
+            savable=args.savable,
+            trace_max_array=args.trace_max_array,
+        )
+        for name in args.profile
+    ]
+    launcher = get_build_launcher(args)
+    if args.watch:
+        watch_build(args, riscv_programs, profiles, selection, launcher)
+        return
+    if args.pgo or args.tune or not is_configured(profiles, selection, launcher):
+        source_files = scan_sources()
+        timer.lap("dependency_scan")
+
+        if args.pgo:
+            profiles.append(
+                train_pgo_profile(
+                    args, riscv_programs, source_files, selection, profiles, timer
+                )
+            )
+            timer.lap("pgo_training")
+
+        info("Writing build graph...")
+        write_build_ninja(
+            riscv_programs,
+            source_files,
+            profiles,
+            selection,
+            launcher=launcher,
+            tune_jobs=os.cpu_count() if args.tune else None,
+        )
+        timer.lap("build_graph")
+    # Otherwise the graph is current, ninja regenerates it if any of its inputs change
+    riscv_programs = select_programs(riscv_programs, selection)
+
+    info("Building...")
+    cache_stats = get_build_cache_stats(args)
+    run_ninja(timer)
+    if not args.no_cache:
+        new_cache_stats = get_build_cache_stats(args)
+        hits = new_cache_stats["hits"] - cache_stats["hits"]
+        misses = new_cache_stats["misses"] - cache_stats["misses"]
+        info(f"Compile cache: {hits} hits, {misses} misses")
+
+    for program in riscv_programs.values():
+        program.load_program_stats()
+    timer.lap("ninja")
+    # Read after ninja since it rewrites the configuration when it regenerates
+    config = load_build_config()
+    simulators = config["simulators"]
+
+    results = []
+    if args.run:
+        info("Running RISCV programs...")
+        store = CheckpointStore()
+        for simulator in simulators:
+            programs = get_simulator_programs(config, simulator, riscv_programs)
+            restore_args = None
+            if args.checkpoint:
+                restore_args = get_restore_args(
+                    store,
+                    simulator,
+                    config["models"][simulator],
+                    programs,
+                    cycle=args.checkpoint_cycle,
+                    pc=args.checkpoint_pc,
+                    timeout=args.timeout,
+                    jobs=args.jobs,
+                )
+            results += run_simulations(
+                simulator,
+                programs,
+                jobs=args.jobs,
+                timeout=args.timeout,
+                args=restore_args,
+                batch=args.batch,
+            )
+        write_results(results, args.results)
+        timer.lap("simulation")
+
+    regressions = []
+    if args.benchmark:
+        info("Running benchmarks...")
+        history = load_history(args.history)
+        baselines = [] if args.baseline is None else load_baseline(args.baseline)
+        for simulator in simulators:
+            entry = run_benchmarks(
+                simulator,
+                get_simulator_programs(config, simulator, riscv_programs),
+                repeat=args.benchmark_repeat,
+                timeout=args.timeout,
+            )
+            # Simulators without a saved baseline compare against their last run
+            baseline = get_baseline(baselines, entry["simulator"])
+            if baseline is None:
+                baseline = get_baseline(history, entry["simulator"])
+            regressions += compare_benchmarks(entry, baseline, args.threshold)
+            history.append(entry)
+            if args.save_baseline and args.baseline is not None:
+                write_baseline(entry, args.baseline)
+        write_history(history, args.history)
+        timer.lap("benchmark")
+
+    report = timer.get_report()
+    write_report(report, args.report)
+    print_report(report, previous)
+
+    if args.run:
+        failed = [result.name for result in results if not result.passed()]
+        if len(results) == 0:
+            error("No programs were run!")
+            sys.exit(1)
+        if len(failed) > 0:
+            error(f"{len(failed)} of {len(results)} programs failed!")
+            sys.exit(1)
+        info(f"All {len(results)} programs passed")
+
+    if len(regressions) > 0:
+        error(f"{len(regressions)} benchmark metrics regressed!")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
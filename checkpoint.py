@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"Helper functions for saving simulator checkpoints and running programs from them"
+
+from __future__ import annotations
+
+import os
+import hashlib
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from util import info, debug
+
+# Checkpoints kept before the least recently used ones are removed
+DEFAULT_MAX_CHECKPOINTS = 32
+
+
+def _hash_program(binary):
+    return hashlib.sha1(Path(binary).read_bytes()).hexdigest()
+
+
+def get_checkpoint_point(cycle=None, pc=None):
+    "Returns the name of the point a checkpoint is taken at"
+    if pc is not None:
+        return f"pc{pc:08x}"
+    return f"cycle{0 if cycle is None else cycle}"
+
+
+class CheckpointStore:
+    """Keeps checkpoints of savable simulators keyed by the model and the program
+    they were saved from, a checkpoint is never reused once either one changes"""
+
+    def __init__(self, path="bin/checkpoints", max_checkpoints=None) -> None:
+        self.path = Path(path)
+        self.max_checkpoints = (
+            DEFAULT_MAX_CHECKPOINTS if max_checkpoints is None else max_checkpoints
+        )
+
+    def get_path(self, model_hash, binary, cycle=None, pc=None):
+        "Returns where the checkpoint of the program on the model is stored"
+        point = get_checkpoint_point(cycle=cycle, pc=pc)
+        return str(
+            self.path / f"{model_hash[:16]}_{_hash_program(binary)[:16]}_{point}.ckpt"
+        )
+
+    def get(self, model_hash, binary, cycle=None, pc=None):
+        "Returns the stored checkpoint, or None if it was never saved"
+        path = self.get_path(model_hash, binary, cycle=cycle, pc=pc)
+        if not os.path.isfile(path):
+            return None
+        # The modification time orders the checkpoints for eviction
+        os.utime(path)
+        return path
+
+    def save(self, simulator, model_hash, binary, cycle=None, pc=None, timeout=None):
+        """Runs the program on the simulator until the cycle or the jump to pc and
+        saves a checkpoint there. Returns None if the program finished before
+        reaching that point"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(model_hash, binary, cycle=cycle, pc=pc)
+        command = [simulator, "--binary", binary, "--no-wave", "--save", path]
+        if pc is not None:
+            command += ["--save-pc", hex(pc)]
+        elif cycle is not None:
+            command += ["--save-cycle", str(cycle)]
+        try:
+            subprocess.run(command, capture_output=True, check=False, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            pass
+        # The run from reset reports whatever stopped the program early
+        if not os.path.isfile(path):
+            debug(
+                f"{binary} never reached {get_checkpoint_point(cycle=cycle, pc=pc)} "
+                f"on {simulator}, running it from reset"
+            )
+            return None
+        return path
+
+    def get_or_save(
+        self, simulator, model_hash, binary, cycle=None, pc=None, timeout=None
+    ):
+        """Returns the stored checkpoint, saving it first if it does not exist yet, or
+        None if the program never reaches the point"""
+        path = self.get(model_hash, binary, cycle=cycle, pc=pc)
+        if path is None:
+            info(f"Saving checkpoint of {binary} on {simulator}...")
+            path = self.save(
+                simulator, model_hash, binary, cycle=cycle, pc=pc, timeout=timeout
+            )
+        return path
+
+    def evict(self, keep=()):
+        """Removes the least recently used checkpoints past the maximum, except the
+        ones to keep"""
+        checkpoints = sorted(
+            self.path.glob("*.ckpt"), key=lambda path: path.stat().st_mtime
+        )
+        excess = max(0, len(checkpoints) - self.max_checkpoints)
+        for path in [path for path in checkpoints if str(path) not in keep][:excess]:
+            path.unlink()
+
+
+def get_restore_args(
+    store, simulator, model_hash, programs, cycle=None, pc=None, timeout=None, jobs=None
+):
+    """Returns the simulator arguments that start every program from its checkpoint,
+    for run_simulations. Missing checkpoints are saved in parallel, and programs that
+    never reach the point are left to run from reset"""
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = {
+            name: executor.submit(
+                store.get_or_save,
+                simulator,
+                model_hash,
+                program.get_binary(),
+                cycle=cycle,
+                pc=pc,
+                timeout=timeout,
+            )
+            for name, program in programs.items()
+        }
+        checkpoints = {name: future.result() for name, future in futures.items()}
+    # Saving happens in parallel, so eviction waits until every checkpoint exists
+    # and never removes one this run is about to restore
+    store.evict(keep={path for path in checkpoints.values() if path is not None})
+    return {
+        name: ["--restore", path]
+        for name, path in checkpoints.items()
+        if path is not None
+    }
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Content-addressed object cache used as a compiler launcher by the ninja rules,
+objects are keyed on the preprocessed source, the compiler, and the flags
+"""
+
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import argparse
+import subprocess
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "reptilia")
+DEFAULT_MAX_SIZE = 5 << 30
+
+# Flags whose value is the next argument
+_VALUE_FLAGS = {"-o", "-MF", "-MT", "-MQ", "-x", "-include", "-isystem", "-target"}
+_SOURCE_SUFFIXES = {".c", ".cc", ".cpp", ".cxx", ".S"}
+
+# Outputs of these flags depend on more than the preprocessed source (the host CPU
+# or the recorded profiles), so those compiles always run uncached
+_UNCACHEABLE_FLAGS = ("-march=native", "-mtune=native", "-fprofile-use")
+
+
+def get_cache_dir(cache_dir=None):
+    "Returns the cache folder, configurable with $REPTILIA_CACHE_DIR"
+    if cache_dir is None:
+        cache_dir = os.environ.get("REPTILIA_CACHE_DIR", DEFAULT_CACHE_DIR)
+    return os.path.expanduser(cache_dir)
+
+
+def get_launcher(cache_dir=None, max_size=None):
+    "Returns the command prefix that runs a compile through the cache"
+    launcher = (
+        f"{sys.executable} compile_cache.py --cache-dir {get_cache_dir(cache_dir)}"
+    )
+    if max_size is not None:
+        launcher += f" --max-size {max_size}"
+    return launcher + " --"
+
+
+class _Compile:
+    "Describes the parts of a compile command the cache needs to know about"
+
+    def __init__(self, command) -> None:
+        self.command = command
+        self.output = None
+        self.depfile = None
+        self.source = None
+        self.has_target = False
+        sources = []
+        compile_only = False
+        i = 1
+        while i < len(command):
+            arg = command[i]
+            if arg in _VALUE_FLAGS and i + 1 < len(command):
+                if arg == "-o":
+                    self.output = command[i + 1]
+                elif arg == "-MF":
+                    self.depfile = command[i + 1]
+                elif arg in ("-MT", "-MQ"):
+                    self.has_target = True
+                i += 2
+                continue
+            if arg == "-c":
+                compile_only = True
+            elif not arg.startswith("-") and Path(arg).suffix in _SOURCE_SUFFIXES:
+                sources.append(arg)
+            i += 1
+        self.cacheable = (
+            compile_only
+            and self.output is not None
+            and len(sources) == 1
+            and not any(arg.startswith(_UNCACHEABLE_FLAGS) for arg in command)
+        )
+        if len(sources) == 1:
+            self.source = sources[0]
+
+    def get_preprocess_command(self):
+        "Returns the command that preprocesses the source and writes the depfile"
+        command = []
+        skip = False
+        for arg in self.command:
+            if skip:
+                skip = False
+            elif arg == "-o":
+                skip = True
+            elif arg != "-c":
+                command.append(arg)
+        command.append("-E")
+        if self.depfile is not None and not self.has_target:
+            command += ["-MT", self.output]
+        return command
+
+    def get_flags(self):
+        "Returns the flags without the paths that differ between checkouts"
+        flags = []
+        skip = False
+        for arg in self.command[1:]:
+            if skip:
+                skip = False
+            elif arg in ("-o", "-MF", "-MT", "-MQ"):
+                skip = True
+            elif arg != self.source:
+                flags.append(arg)
+        return flags
+
+
+class CompileCache:
+    "Size-bounded object cache, least recently used objects are evicted first"
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.objects_dir = self.cache_dir / "objects"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+
+    def _update_stats(self, hits=0, misses=0, uncached=0, added_size=0):
+        "Updates the shared statistics, evicting objects if the cache grew too big"
+        with open(self.cache_dir / "lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = self.get_stats()
+            stats["hits"] += hits
+            stats["misses"] += misses
+            stats["uncached"] += uncached
+            stats["size"] += added_size
+            if stats["size"] > self.max_size:
+                stats["size"] = self._evict()
+            temp_path = self.cache_dir / "stats.json.tmp"
+            temp_path.write_text(json.dumps(stats))
+            os.replace(temp_path, self.cache_dir / "stats.json")
+
+    def _evict(self):
+        "Removes the least recently used objects until the cache is below 90% full"
+        entries = []
+        for path in self.objects_dir.rglob("*.o"):
+            stat = path.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            size -= entry_size
+        return size
+
+    def get_stats(self):
+        "Returns the hit and miss statistics of the cache"
+        try:
+            return json.loads((self.cache_dir / "stats.json").read_text())
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0, "uncached": 0, "size": 0}
+
+    def clear(self):
+        "Removes every cached object and resets the statistics"
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+
+    def _get_key(self, compile_command, preprocessed):
+        digest = hashlib.sha256()
+        compiler = os.path.realpath(
+            shutil.which(compile_command.command[0]) or compile_command.command[0]
+        )
+        stat = os.stat(compiler)
+        digest.update(f"{compiler}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        digest.update("\0".join(compile_command.get_flags()).encode())
+        # Line markers only carry the checkout path, drop them unless it ends up in
+        # the object as debug information
+        if "-g" not in compile_command.command:
+            preprocessed = b"\n".join(
+                line for line in preprocessed.split(b"\n") if not line.startswith(b"# ")
+            )
+        digest.update(preprocessed)
+        return digest.hexdigest()
+
+    def compile(self, command):
+        "Runs the compile command, reusing a cached object when possible"
+        compile_command = _Compile(command)
+        if not compile_command.cacheable:
+            self._update_stats(uncached=1)
+            return subprocess.run(command, check=False).returncode
+
+        preprocess = subprocess.run(
+            compile_command.get_preprocess_command(), capture_output=True, check=False
+        )
+        if preprocess.returncode != 0:
+            # Let the real compile report the error
+            self._update_stats(uncached=1)
+            return subprocess.run(command, check=False).returncode
+
+        key = self._get_key(compile_command, preprocess.stdout)
+        cached_path = self.objects_dir / key[:2] / f"{key[2:]}.o"
+        if cached_path.is_file():
+            shutil.copyfile(cached_path, compile_command.output)
+            # Refresh the entry for least recently used eviction
+            os.utime(cached_path)
+            self._update_stats(hits=1)
+            return 0
+
+        result = subprocess.run(command, check=False)
+        if result.returncode != 0:
+            return result.returncode
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cached_path.with_suffix(f".{os.getpid()}.tmp")
+        shutil.copyfile(compile_command.output, temp_path)
+        os.replace(temp_path, cached_path)
+        self._update_stats(misses=1, added_size=cached_path.stat().st_size)
+        return 0
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--cache-dir", default=None, help="folder the cache lives in")
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE,
+        help="size in bytes the cache is bounded to",
+    )
+    parser.add_argument("--stats", action="store_true", help="print the statistics")
+    parser.add_argument("--clear", action="store_true", help="empty the cache")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="compile command")
+    args = parser.parse_args()
+
+    cache = CompileCache(get_cache_dir(args.cache_dir), max_size=args.max_size)
+    if args.clear:
+        cache.clear()
+    if args.stats:
+        stats = cache.get_stats()
+        print(
+            f"{stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['uncached']} uncached, {stats['size'] / (1 << 20):.1f} MiB"
+        )
+    command = args.command
+    if len(command) > 0 and command[0] == "--":
+        command = command[1:]
+    if len(command) > 0:
+        sys.exit(cache.compile(command))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"Python interface for driving the verilated gecko_nano model in batches of cycles"
+
+from __future__ import annotations
+
+import ctypes
+
+# Conditions run() stops early on, can be combined
+STOP_ON_EXIT = 1
+STOP_ON_TTY_OUT = 2
+
+_SIGNATURES = {
+    "gecko_nano_create": ([], ctypes.c_void_p),
+    "gecko_nano_destroy": ([ctypes.c_void_p], None),
+    "gecko_nano_open_trace": ([ctypes.c_void_p, ctypes.c_char_p], ctypes.c_int),
+    "gecko_nano_memory_bytes": ([ctypes.c_void_p], ctypes.c_uint64),
+    "gecko_nano_load_memory": (
+        [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint64, ctypes.c_uint64],
+        ctypes.c_int,
+    ),
+    "gecko_nano_reset": ([ctypes.c_void_p, ctypes.c_uint64], None),
+    "gecko_nano_run": (
+        [ctypes.c_void_p, ctypes.c_uint64, ctypes.c_int],
+        ctypes.c_uint64,
+    ),
+    "gecko_nano_tty_write": (
+        [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint64],
+        None,
+    ),
+    "gecko_nano_tty_pending": ([ctypes.c_void_p], ctypes.c_uint64),
+    "gecko_nano_tty_read": (
+        [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint64],
+        ctypes.c_uint64,
+    ),
+    "gecko_nano_cycles": ([ctypes.c_void_p], ctypes.c_uint64),
+    "gecko_nano_finished": ([ctypes.c_void_p], ctypes.c_int),
+    "gecko_nano_exit_flag": ([ctypes.c_void_p], ctypes.c_int),
+    "gecko_nano_error_flag": ([ctypes.c_void_p], ctypes.c_int),
+    "gecko_nano_exit_code": ([ctypes.c_void_p], ctypes.c_int),
+}
+
+_LIBRARIES = {}
+
+
+def _load_library(path):
+    "Loads the co-simulation library once, declaring the signature of every call"
+    library = _LIBRARIES.get(path)
+    if library is None:
+        library = ctypes.CDLL(path)
+        for name, (argtypes, restype) in _SIGNATURES.items():
+            function = getattr(library, name)
+            function.argtypes = argtypes
+            function.restype = restype
+        _LIBRARIES[path] = library
+    return library
+
+
+class GeckoNano:
+    """Verilated gecko_nano model loaded from the co-simulation library, only the
+    number of cycles to run crosses into C++ so the cycle loop runs at full speed"""
+
+    def __init__(self, library="bin/libgecko_nano_cosim.so", vcd=None) -> None:
+        self.library = _load_library(library)
+        self.sim = self.library.gecko_nano_create()
+        if vcd is not None and not self.library.gecko_nano_open_trace(
+            self.sim, vcd.encode("utf-8")
+        ):
+            raise RuntimeError(f"{library} was built without tracing!")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        "Finishes the model and frees it"
+        if self.sim is not None:
+            self.library.gecko_nano_destroy(self.sim)
+            self.sim = None
+
+    def get_memory_size(self):
+        "Returns the size of the memory in bytes"
+        return self.library.gecko_nano_memory_bytes(self.sim)
+
+    def load_memory(self, data, offset=0):
+        "Copies the bytes into memory starting at the word aligned byte offset"
+        data = bytes(data)
+        if self.library.gecko_nano_load_memory(self.sim, data, len(data), offset):
+            raise RuntimeError(
+                f"{len(data)} bytes at {offset} do not fit in "
+                f"{self.get_memory_size()} bytes of memory!"
+            )
+
+    def load_binary(self, path):
+        "Loads a raw program binary into the start of memory"
+        with open(path, "rb") as file:
+            self.load_memory(file.read())
+
+    def reset(self, cycles=20):
+        "Holds the model in reset, dropping any buffered tty input and output"
+        self.library.gecko_nano_reset(self.sim, cycles)
+
+    def run(self, n_cycles, stop_on=STOP_ON_EXIT):
+        """Runs up to n_cycles, stopping early on any of the stop_on conditions,
+        and returns the number of cycles run"""
+        return self.library.gecko_nano_run(self.sim, n_cycles, stop_on)
+
+    def tty_write(self, data):
+        "Queues bytes for the core to read from the tty"
+        data = bytes(data)
+        self.library.gecko_nano_tty_write(self.sim, data, len(data))
+
+    def tty_read(self):
+        "Returns every byte the core wrote to the tty since the last read"
+        pending = self.library.gecko_nano_tty_pending(self.sim)
+        buffer = ctypes.create_string_buffer(pending)
+        count = self.library.gecko_nano_tty_read(self.sim, buffer, pending)
+        return buffer.raw[:count]
+
+    @property
+    def cycles(self):
+        "Cycles run since the model was created, including reset"
+        return self.library.gecko_nano_cycles(self.sim)
+
+    @property
+    def finished(self):
+        "If the model called $finish"
+        return bool(self.library.gecko_nano_finished(self.sim))
+
+    @property
+    def exit_flag(self):
+        "If the core signalled that the program exited"
+        return bool(self.library.gecko_nano_exit_flag(self.sim))
+
+    @property
+    def error_flag(self):
+        "If the core signalled an error"
+        return bool(self.library.gecko_nano_error_flag(self.sim))
+
+    @property
+    def exit_code(self):
+        "Exit code of the program, valid once exit_flag is set"
+        return self.library.gecko_nano_exit_code(self.sim)
+
+
+def run_program(binary, library="bin/libgecko_nano_cosim.so", max_cycles=100000):
+    """Runs a program to completion like the testbench does, returning the exit
+    code (None if it did not exit), the tty output and the cycles it took"""
+    with GeckoNano(library) as sim:
+        sim.load_binary(binary)
+        sim.reset()
+        sim.run(max_cycles)
+        exit_code = sim.exit_code if sim.exit_flag and not sim.error_flag else None
+        return exit_code, sim.tty_read(), sim.cycles
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"Generates float32 test vectors for the FPU in NumPy batches and checks results against them"
+
+from __future__ import annotations
+
+import argparse
+
+import numpy as np
+
+from util import info, error
+
+VECTOR_MAGIC = b"FVEC"
+VECTOR_VERSION = 1
+
+# Operation of each vector, a float2int result is a signed integer
+OPERATIONS = {
+    "add": 0,
+    "mult": 1,
+    "divide": 2,
+    "sqrt": 3,
+    "int2float": 4,
+    "float2int": 5,
+}
+
+# Fixed-size vectors a testbench streams through the FPU, the results are written
+# back as one little-endian word per vector in the same order
+VECTOR_DTYPE = np.dtype(
+    [
+        ("operation", "u1"),
+        ("reserved", "u1", (3,)),
+        ("a", "<u4"),
+        ("b", "<u4"),
+        ("expected", "<u4"),
+    ]
+)
+_HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S4"),
+        ("version", "<u4"),
+        ("record_size", "<u4"),
+        ("count", "<u4"),
+    ]
+)
+
+_SIGN = np.uint32(0x8000_0000)
+_EXPONENT = np.uint32(0x7F80_0000)
+_MANTISSA = np.uint32(0x007F_FFFF)
+
+# Chance of each class of operand, plain random encodings rarely hit the corners
+_OPERAND_CLASSES = {
+    "normal": 0.55,
+    "bits": 0.15,
+    "denormal": 0.1,
+    "zero": 0.04,
+    "infinity": 0.04,
+    "nan": 0.04,
+    "large": 0.04,
+    "small": 0.04,
+}
+
+
+def random_operands(rng, count):
+    """Returns float32 encodings drawn from every class of operand, including
+    denormals, signed zeros, infinities, quiet and signalling NaNs"""
+    bits = rng.integers(0, 1 << 32, size=count, dtype=np.uint32)
+    sign = bits & _SIGN
+    mantissa = rng.integers(0, 1 << 23, size=count, dtype=np.uint32)
+    classes = rng.choice(
+        len(_OPERAND_CLASSES), size=count, p=list(_OPERAND_CLASSES.values())
+    )
+    exponents = {
+        # Normal numbers near one keep most results representable
+        "normal": rng.integers(64, 192, size=count, dtype=np.uint32),
+        "denormal": np.zeros(count, dtype=np.uint32),
+        "zero": np.zeros(count, dtype=np.uint32),
+        "infinity": np.full(count, 255, dtype=np.uint32),
+        "nan": np.full(count, 255, dtype=np.uint32),
+        # Products and quotients of these overflow or underflow
+        "large": rng.integers(200, 255, size=count, dtype=np.uint32),
+        "small": rng.integers(1, 56, size=count, dtype=np.uint32),
+    }
+    operands = bits.copy()
+    for index, name in enumerate(_OPERAND_CLASSES):
+        if name == "bits":
+            continue
+        selected = classes == index
+        if name == "zero" or name == "infinity":
+            operand_mantissa = 0
+        elif name == "denormal" or name == "nan":
+            # Zero would turn these into zeros and infinities
+            operand_mantissa = np.maximum(mantissa[selected], 1)
+        else:
+            operand_mantissa = mantissa[selected]
+        operands[selected] = (
+            sign[selected] | (exponents[name][selected] << 23) | operand_mantissa
+        )
+    return operands
+
+
+def _is_nan(bits):
+    return ((bits & _EXPONENT) == _EXPONENT) & ((bits & _MANTISSA) != 0)
+
+
+def _float2int(bits):
+    "Converts rounding towards zero, saturating like fcvt.w.s"
+    values = bits.view(np.float32).astype(np.float64)
+    result = np.trunc(np.nan_to_num(values, nan=2.0**31, posinf=2.0**31))
+    result = np.clip(result, -(2.0**31), 2.0**31 - 1)
+    return result.astype(np.int64).astype(np.int32).view(np.uint32)
+
+
+def get_reference(operations, a, b):
+    """Computes the expected result of every vector in bulk, NumPy rounds float32
+    to nearest even and keeps denormals like the IEEE 754 standard"""
+    expected = np.zeros(len(operations), dtype=np.uint32)
+    fa = a.view(np.float32)
+    fb = b.view(np.float32)
+    with np.errstate(all="ignore"):
+        for name, function in (
+            ("add", lambda x, y: x + y),
+            ("mult", lambda x, y: x * y),
+            ("divide", lambda x, y: x / y),
+            ("sqrt", lambda x, _: np.sqrt(x)),
+        ):
+            selected = operations == OPERATIONS[name]
+            expected[selected] = (
+                function(fa[selected], fb[selected]).astype(np.float32).view(np.uint32)
+            )
+        selected = operations == OPERATIONS["int2float"]
+        expected[selected] = (
+            a[selected].view(np.int32).astype(np.float32).view(np.uint32)
+        )
+        selected = operations == OPERATIONS["float2int"]
+        expected[selected] = _float2int(a[selected])
+    return expected
+
+
+def generate_vectors(rng, count, operations=None):
+    "Returns count vectors spread evenly over the operations"
+    if operations is None:
+        operations = list(OPERATIONS)
+    codes = np.array([OPERATIONS[name] for name in operations], dtype=np.uint8)
+    vectors = np.zeros(count, dtype=VECTOR_DTYPE)
+    vectors["operation"] = codes[rng.integers(0, len(codes), size=count)]
+    vectors["a"] = random_operands(rng, count)
+    vectors["b"] = random_operands(rng, count)
+    # Integer operands are better covered by plain random words
+    integers = vectors["operation"] == OPERATIONS["int2float"]
+    vectors["a"][integers] = rng.integers(
+        0, 1 << 32, size=int(integers.sum()), dtype=np.uint32
+    )
+    vectors["expected"] = get_reference(
+        vectors["operation"], vectors["a"], vectors["b"]
+    )
+    return vectors
+
+
+def write_vectors(path, count, seed=0, operations=None, batch_size=1 << 20):
+    "Writes the vectors in batches so millions of them never have to fit in memory"
+    rng = np.random.default_rng(seed)
+    header = np.zeros(1, dtype=_HEADER_DTYPE)
+    header["magic"] = VECTOR_MAGIC
+    header["version"] = VECTOR_VERSION
+    header["record_size"] = VECTOR_DTYPE.itemsize
+    header["count"] = count
+    with open(path, "wb") as file:
+        header.tofile(file)
+        for start in range(0, count, batch_size):
+            generate_vectors(
+                rng, min(batch_size, count - start), operations=operations
+            ).tofile(file)
+
+
+def load_vectors(path):
+    "Memory-maps the vectors as a structured array without reading them in"
+    header = np.fromfile(path, dtype=_HEADER_DTYPE, count=1)
+    if len(header) == 0 or header["magic"][0] != VECTOR_MAGIC:
+        raise RuntimeError(f"{path} is not an FPU vector file!")
+    if header["record_size"][0] != VECTOR_DTYPE.itemsize:
+        raise RuntimeError(f"{path} has {header['record_size'][0]} byte vectors!")
+    return np.memmap(
+        path,
+        dtype=VECTOR_DTYPE,
+        mode="r",
+        offset=_HEADER_DTYPE.itemsize,
+        shape=(int(header["count"][0]),),
+    )
+
+
+def compare_results(vectors, results, flush_denormals=False):
+    """Returns which results differ from the expected ones. Every NaN matches every
+    other NaN since the FPU is free to pick its own, and with flush_denormals
+    denormal results only have to match as zeros of the same sign"""
+    expected = np.asarray(vectors["expected"])
+    results = np.asarray(results, dtype=np.uint32)
+    floats = vectors["operation"] != OPERATIONS["float2int"]
+    matched = results == expected
+    matched |= floats & _is_nan(expected) & _is_nan(results)
+    if flush_denormals:
+        denormal = floats & ((expected & _EXPONENT) == 0)
+        matched |= (
+            denormal
+            & ((results & ~_SIGN) == 0)
+            & ((results & _SIGN) == (expected & _SIGN))
+        )
+    return ~matched
+
+
+def check_results(vectors, results, flush_denormals=False, show=10):
+    "Prints the mismatches of each operation, returning the number of mismatches"
+    mismatched = compare_results(vectors, results, flush_denormals=flush_denormals)
+    operations = np.asarray(vectors["operation"])
+    for name, code in OPERATIONS.items():
+        selected = operations == code
+        total = int(selected.sum())
+        if total == 0:
+            continue
+        count = int((mismatched & selected).sum())
+        report = error if count > 0 else info
+        report(f"{name}: {count} of {total} mismatched")
+    for index in np.flatnonzero(mismatched)[:show]:
+        vector = vectors[index]
+        name = next(
+            name for name, code in OPERATIONS.items() if code == vector["operation"]
+        )
+        error(
+            f"  {name} a={vector['a']:08x} b={vector['b']:08x}: expected "
+            f"{vector['expected']:08x}, got {int(results[index]):08x}"
+        )
+    return int(mismatched.sum())
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    generate_parser = subparsers.add_parser(
+        "generate", help="write test vectors with their expected results"
+    )
+    generate_parser.add_argument("-o", "--output", required=True)
+    generate_parser.add_argument("-n", "--count", type=int, default=1 << 20)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    generate_parser.add_argument(
+        "--operation",
+        action="append",
+        choices=list(OPERATIONS),
+        help="only generate the operation, can be given more than once",
+    )
+    check_parser = subparsers.add_parser(
+        "check", help="compare the results a testbench wrote against the vectors"
+    )
+    check_parser.add_argument("vectors", help="vector file")
+    check_parser.add_argument("results", help="one 32-bit result per vector")
+    check_parser.add_argument(
+        "--flush-denormals",
+        action="store_true",
+        help="accept zeros for denormal results",
+    )
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        write_vectors(
+            args.output, args.count, seed=args.seed, operations=args.operation
+        )
+    elif args.command == "check":
+        vectors = load_vectors(args.vectors)
+        results = np.fromfile(args.results, dtype="<u4")
+        if len(results) != len(vectors):
+            raise RuntimeError(
+                f"{args.results} has {len(results)} results for {len(vectors)} vectors!"
+            )
+        mismatches = check_results(
+            vectors,
+            results,
+            flush_denormals=args.flush_denormals,
+        )
+        if mismatches > 0:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
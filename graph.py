@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"Helper class for resolving the import graph of SystemVerilog sources"
+
+from __future__ import annotations
+
+from typing import Dict, List
+
+_UNVISITED = 0
+_VISITING = 1
+_VISITED = 2
+
+
+class ImportGraph:
+    """Import graph of SystemVerilog sources, sorted once so every query is answered
+    from memoized results"""
+
+    def __init__(self, source_files: Dict[str, object]) -> None:
+        self.source_files = source_files
+        self.order = self._sort()
+        self.index = {path: i for i, path in enumerate(self.order)}
+        self.dependents = {path: [] for path in self.order}
+        for path in self.order:
+            for import_path in source_files[path].imports:
+                self.dependents[import_path].append(path)
+        self.wrapped = {}
+        for path, source_file in source_files.items():
+            if source_file.wrapper is not None:
+                self.wrapped.setdefault(source_file.wrapper, []).append(path)
+        self.closures = {}
+        self.resolved = 0
+        self.dependencies = {}
+
+    def _sort(self) -> List[str]:
+        "Topologically sorts the sources, every file comes after everything it imports"
+        state = {path: _UNVISITED for path in self.source_files}
+        order = []
+        for root in self.source_files:
+            if state[root] != _UNVISITED:
+                continue
+            # Iterative depth first search, each frame is a file and its next import
+            stack = [(root, 0)]
+            state[root] = _VISITING
+            while len(stack) > 0:
+                path, next_import = stack[-1]
+                imports = self.source_files[path].imports
+                if next_import == len(imports):
+                    stack.pop()
+                    state[path] = _VISITED
+                    order.append(path)
+                    continue
+                stack[-1] = (path, next_import + 1)
+                import_path = imports[next_import]
+                if import_path not in state:
+                    raise RuntimeError(
+                        f"File {path} imports {import_path} which does not exist!"
+                    )
+                if state[import_path] == _VISITING:
+                    cycle = [frame_path for frame_path, _ in stack]
+                    cycle = cycle[cycle.index(import_path) :] + [import_path]
+                    raise RuntimeError(f"Circular import: {' -> '.join(cycle)}")
+                if state[import_path] == _UNVISITED:
+                    state[import_path] = _VISITING
+                    stack.append((import_path, 0))
+        return order
+
+    def get_closure(self, path) -> frozenset:
+        "Returns the set of files this file transitively imports, including itself"
+        # Files are resolved in sorted order so every import is already memoized
+        while self.resolved <= self.index[path]:
+            unresolved = self.order[self.resolved]
+            closure = {unresolved}
+            for import_path in self.source_files[unresolved].imports:
+                closure |= self.closures[import_path]
+            self.closures[unresolved] = frozenset(closure)
+            self.resolved += 1
+        return self.closures[path]
+
+    def get_dependencies(self, path) -> List[str]:
+        "Returns every file this file transitively imports in a valid compile order"
+        dependencies = self.dependencies.get(path)
+        if dependencies is None:
+            dependencies = sorted(self.get_closure(path), key=self.index.__getitem__)
+            self.dependencies[path] = dependencies
+        return dependencies
+
+    def get_dependents(self, path) -> set:
+        "Returns every file that transitively imports this file, including itself"
+        paths = self.wrapped.get(path, [path])
+        found = set(paths)
+        stack = list(paths)
+        while len(stack) > 0:
+            for dependent in self.dependents.get(stack.pop(), []):
+                if dependent not in found:
+                    found.add(dependent)
+                    stack.append(dependent)
+        return found
+
+    def get_affected(self, path, top_levels) -> List[str]:
+        "Returns the top levels that have to be rebuilt when this file changes"
+        dependents = self.get_dependents(path)
+        return [top_level for top_level in top_levels if top_level in dependents]
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+Reference RV32I instruction set simulator, writes the register writes of a program
+in the testbench trace format so they can be checked against the RTL
+"""
+
+from __future__ import annotations
+
+import struct
+import argparse
+
+import numpy as np
+
+from util import info, error
+from trace_analysis import (
+    KIND_REGISTER,
+    FLAG_UNPREDICTABLE,
+    TRACE_DTYPE,
+    compare_register_writes,
+    write_trace_header,
+)
+
+_MASK = 0xFFFFFFFF
+_SIGN = 0x80000000
+
+_WORD = struct.Struct("<I")
+_HALF = struct.Struct("<H")
+_SIGNED_HALF = struct.Struct("<h")
+_SIGNED_BYTE = struct.Struct("<b")
+
+# CSRs the core handles specially, see gecko_system
+_CSR_EXIT_CODE = 0x800
+_CSR_TTY_OUT = 0x801
+_CSR_TTY_IN = 0x802
+# Counters depend on the timing of the core so their values are never checked
+_CSR_COUNTERS = set(range(0xC00, 0xC08)) | {0xC80, 0xC81, 0xC82}
+
+
+def _sign_extend(value, bits):
+    return (value & ((1 << bits) - 1)) - ((value << 1) & (1 << bits))
+
+
+class Rv32iSimulator:
+    """RV32I simulator that decodes every instruction into a closure once and
+    caches it by address, the dispatch loop only looks up and calls closures"""
+
+    def __init__(self, memory_size=1 << 16) -> None:
+        self.memory = bytearray(memory_size)
+        self.regs = [0] * 32
+        self.pc = 0
+        self.instret = 0
+        self.cache = {}
+        self.exit_code = 0
+        self.exited = False
+        self.error = None
+        self.tty_in = bytearray()
+        self.tty_out = bytearray()
+
+    def load_binary(self, path):
+        "Loads a raw program binary into the start of memory"
+        with open(path, "rb") as file:
+            data = file.read()
+        if len(data) > len(self.memory):
+            self.memory.extend(bytes(len(data) - len(self.memory)))
+        self.memory[: len(data)] = data
+        self.cache.clear()
+
+    def _store(self, address, value, size):
+        memory = self.memory
+        if size == 4:
+            _WORD.pack_into(memory, address, value & _MASK)
+        elif size == 2:
+            _HALF.pack_into(memory, address, value & 0xFFFF)
+        else:
+            memory[address] = value & 0xFF
+        # Stores over decoded instructions throw the decoded closures away
+        cache = self.cache
+        if cache:
+            cache.pop(address & ~3, None)
+            cache.pop((address + size - 1) & ~3, None)
+
+    def _read_csr(self, csr):
+        if csr in _CSR_COUNTERS:
+            return self.instret & _MASK if csr < 0xC03 else 0
+        if csr == _CSR_EXIT_CODE:
+            return self.exit_code
+        if csr == _CSR_TTY_IN:
+            if len(self.tty_in) == 0:
+                return 0
+            return self.tty_in.pop(0)
+        return 0
+
+    def _write_csr(self, csr, value):
+        if csr == _CSR_EXIT_CODE:
+            self.exit_code = value & 0xFF
+        elif csr == _CSR_TTY_OUT:
+            self.tty_out.append(value & 0xFF)
+
+    def _decode(self, pc):
+        """Returns a closure that executes the instruction and returns the next pc
+        (None to stop), the register it writes, and the flags of that write"""
+        regs = self.regs
+        memory = self.memory
+        inst = _WORD.unpack_from(memory, pc)[0]
+        opcode = inst & 0x7F
+        rd = (inst >> 7) & 0x1F
+        funct3 = (inst >> 12) & 0x7
+        rs1 = (inst >> 15) & 0x1F
+        rs2 = (inst >> 20) & 0x1F
+        funct7 = inst >> 25
+        imm_i = _sign_extend(inst >> 20, 12)
+        next_pc = pc + 4
+
+        def nop():
+            return next_pc
+
+        if opcode == 0x37:  # LUI
+            value = inst & 0xFFFFF000
+            if rd == 0:
+                return nop, 0, 0
+
+            def lui():
+                regs[rd] = value
+                return next_pc
+
+            return lui, rd, 0
+
+        if opcode == 0x17:  # AUIPC
+            value = (pc + (inst & 0xFFFFF000)) & _MASK
+            if rd == 0:
+                return nop, 0, 0
+
+            def auipc():
+                regs[rd] = value
+                return next_pc
+
+            return auipc, rd, 0
+
+        if opcode == 0x6F:  # JAL
+            imm = _sign_extend(
+                ((inst >> 31) & 1) << 20
+                | ((inst >> 12) & 0xFF) << 12
+                | ((inst >> 20) & 1) << 11
+                | ((inst >> 21) & 0x3FF) << 1,
+                21,
+            )
+            target = (pc + imm) & _MASK
+            if rd == 0:
+                return (lambda: target), 0, 0
+
+            def jal():
+                regs[rd] = next_pc
+                return target
+
+            return jal, rd, 0
+
+        if opcode == 0x67:  # JALR
+
+            def jalr():
+                target = (regs[rs1] + imm_i) & ~1 & _MASK
+                if rd != 0:
+                    regs[rd] = next_pc
+                return target
+
+            return jalr, rd, 0
+
+        if opcode == 0x63:  # Branches
+            imm = _sign_extend(
+                ((inst >> 31) & 1) << 12
+                | ((inst >> 7) & 1) << 11
+                | ((inst >> 25) & 0x3F) << 5
+                | ((inst >> 8) & 0xF) << 1,
+                13,
+            )
+            target = (pc + imm) & _MASK
+            compare = {
+                0: lambda a, b: a == b,
+                1: lambda a, b: a != b,
+                4: lambda a, b: (a ^ _SIGN) < (b ^ _SIGN),
+                5: lambda a, b: (a ^ _SIGN) >= (b ^ _SIGN),
+                6: lambda a, b: a < b,
+                7: lambda a, b: a >= b,
+            }.get(funct3)
+            if compare is None:
+                return self._illegal(pc, inst), 0, 0
+
+            def branch():
+                return target if compare(regs[rs1], regs[rs2]) else next_pc
+
+            return branch, 0, 0
+
+        if opcode == 0x03:  # Loads
+            load = {
+                0: lambda address: _SIGNED_BYTE.unpack_from(memory, address)[0] & _MASK,
+                1: lambda address: _SIGNED_HALF.unpack_from(memory, address)[0] & _MASK,
+                2: lambda address: _WORD.unpack_from(memory, address)[0],
+                4: lambda address: memory[address],
+                5: lambda address: _HALF.unpack_from(memory, address)[0],
+            }.get(funct3)
+            if load is None:
+                return self._illegal(pc, inst), 0, 0
+            if rd == 0:
+                return nop, 0, 0
+
+            def load_register():
+                regs[rd] = load((regs[rs1] + imm_i) & _MASK)
+                return next_pc
+
+            return load_register, rd, 0
+
+        if opcode == 0x23:  # Stores
+            imm = _sign_extend((funct7 << 5) | rd, 12)
+            size = {0: 1, 1: 2, 2: 4}.get(funct3)
+            if size is None:
+                return self._illegal(pc, inst), 0, 0
+            store = self._store
+
+            def store_register():
+                store((regs[rs1] + imm) & _MASK, regs[rs2], size)
+                return next_pc
+
+            return store_register, 0, 0
+
+        if opcode in (0x13, 0x33):  # Register-immediate and register-register
+            operation = self._decode_alu(opcode, funct3, funct7, imm_i, rs2)
+            if operation is None:
+                return self._illegal(pc, inst), 0, 0
+            if rd == 0:
+                return nop, 0, 0
+            if opcode == 0x13:
+                operand = imm_i & _MASK
+
+                def alu_immediate():
+                    regs[rd] = operation(regs[rs1], operand)
+                    return next_pc
+
+                return alu_immediate, rd, 0
+
+            def alu():
+                regs[rd] = operation(regs[rs1], regs[rs2])
+                return next_pc
+
+            return alu, rd, 0
+
+        if opcode == 0x0F:  # FENCE
+            return nop, 0, 0
+
+        if opcode == 0x73:  # System
+            return self._decode_system(pc, inst, rd, funct3, rs1)
+
+        return self._illegal(pc, inst), 0, 0
+
+    @staticmethod
+    def _decode_alu(opcode, funct3, funct7, imm_i, rs2):
+        "Returns the function computing the result of an ALU operation"
+        if funct3 == 0:
+            if opcode == 0x33 and funct7 == 0x20:
+                return lambda a, b: (a - b) & _MASK
+            if opcode == 0x13 or funct7 == 0:
+                return lambda a, b: (a + b) & _MASK
+            return None
+        if funct3 in (1, 5):
+            if opcode == 0x13:
+                # The shift amount is part of the immediate
+                shift = rs2
+                funct7 = (imm_i >> 5) & 0x7F
+                if funct3 == 1 and funct7 == 0:
+                    return lambda a, b: (a << shift) & _MASK
+                if funct3 == 5 and funct7 == 0:
+                    return lambda a, b: a >> shift
+                if funct3 == 5 and funct7 == 0x20:
+                    return lambda a, b: ((a ^ _SIGN) - _SIGN >> shift) & _MASK
+                return None
+            if funct3 == 1 and funct7 == 0:
+                return lambda a, b: (a << (b & 0x1F)) & _MASK
+            if funct3 == 5 and funct7 == 0:
+                return lambda a, b: a >> (b & 0x1F)
+            if funct3 == 5 and funct7 == 0x20:
+                return lambda a, b: ((a ^ _SIGN) - _SIGN >> (b & 0x1F)) & _MASK
+            return None
+        if opcode == 0x33 and funct7 != 0:
+            return None
+        return {
+            2: lambda a, b: int((a ^ _SIGN) < (b ^ _SIGN)),
+            3: lambda a, b: int(a < b),
+            4: lambda a, b: a ^ b,
+            6: lambda a, b: a | b,
+            7: lambda a, b: a & b,
+        }[funct3]
+
+    def _decode_system(self, pc, inst, rd, funct3, rs1):
+        regs = self.regs
+        next_pc = pc + 4
+        if funct3 == 0:
+            if inst == 0x00100073:  # EBREAK
+
+                def ebreak():
+                    self.exited = True
+                    return None
+
+                return ebreak, 0, 0
+            if inst == 0x00000073:  # ECALL
+                return (lambda: next_pc), 0, 0
+            return self._illegal(pc, inst), 0, 0
+        if funct3 == 4:
+            return self._illegal(pc, inst), 0, 0
+
+        csr = inst >> 20
+        immediate = funct3 >= 5
+        kind = funct3 & 3
+        read_csr = self._read_csr
+        write_csr = self._write_csr
+
+        def csr_operation():
+            old = read_csr(csr)
+            source = rs1 if immediate else regs[rs1]
+            if kind == 1:
+                write_csr(csr, source)
+            elif rs1 != 0:
+                write_csr(csr, old | source if kind == 2 else old & ~source & _MASK)
+            if rd != 0:
+                regs[rd] = old
+            return next_pc
+
+        return csr_operation, rd, FLAG_UNPREDICTABLE if csr in _CSR_COUNTERS else 0
+
+    def _illegal(self, pc, inst):
+        def illegal():
+            self.error = f"Illegal instruction 0x{inst:08x} at 0x{pc:08x}"
+            return None
+
+        return illegal
+
+    def run(self, max_steps=None, trace=None, chunk_size=1 << 16):
+        """Runs until the program exits or fails, writing every register write to
+        the trace file if one is given. Returns the number of instructions run"""
+        regs = self.regs
+        cache = self.cache
+        decode = self._decode
+        records = []
+        pc = self.pc
+        count = self.instret
+        limit = None if max_steps is None else count + max_steps
+        try:
+            while limit is None or count < limit:
+                entry = cache.get(pc)
+                if entry is None:
+                    entry = cache[pc] = decode(pc)
+                execute, rd, flags = entry
+                self.instret = count
+                next_pc = execute()
+                count += 1
+                if rd != 0 and trace is not None:
+                    records.append((count, pc, regs[rd], KIND_REGISTER, rd, flags, 0))
+                    if len(records) >= chunk_size:
+                        np.array(records, dtype=TRACE_DTYPE).tofile(trace)
+                        records.clear()
+                if next_pc is None:
+                    break
+                pc = next_pc
+        except (IndexError, struct.error):
+            self.error = f"Memory access out of range at 0x{pc:08x}"
+        if trace is not None and len(records) > 0:
+            np.array(records, dtype=TRACE_DTYPE).tofile(trace)
+        self.pc = pc
+        self.instret = count
+        return count
+
+
+def run_program(binary, trace_path=None, memory_size=1 << 16, max_steps=None):
+    "Runs a program binary on a fresh simulator, returning the simulator"
+    simulator = Rv32iSimulator(memory_size=memory_size)
+    simulator.load_binary(binary)
+    if trace_path is None:
+        simulator.run(max_steps=max_steps)
+        return simulator
+    with open(trace_path, "wb") as trace:
+        write_trace_header(trace)
+        simulator.run(max_steps=max_steps, trace=trace)
+    return simulator
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("binary", help="raw program binary (bin/<name>.bin)")
+    parser.add_argument("-o", "--trace", default=None, help="trace to write")
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="trace of the same program from the simulator to check against",
+    )
+    parser.add_argument(
+        "--memory-size", type=int, default=1 << 16, help="memory size in bytes"
+    )
+    parser.add_argument(
+        "--max-steps", type=int, default=None, help="instructions to run at most"
+    )
+    args = parser.parse_args()
+
+    trace_path = args.trace
+    if trace_path is None and args.compare is not None:
+        trace_path = args.binary + ".iss.trace"
+    simulator = run_program(
+        args.binary,
+        trace_path=trace_path,
+        memory_size=args.memory_size,
+        max_steps=args.max_steps,
+    )
+    if len(simulator.tty_out) > 0:
+        print(simulator.tty_out.decode("utf-8", errors="replace"), end="")
+    if simulator.error is not None:
+        error(simulator.error)
+    elif simulator.exited:
+        info(
+            f"Exited with {simulator.exit_code} after {simulator.instret} instructions"
+        )
+    else:
+        info(f"Stopped after {simulator.instret} instructions")
+
+    if args.compare is not None:
+        divergence = compare_register_writes(trace_path, args.compare)
+        if divergence is not None:
+            raise SystemExit(1)
+        info("Register writes match")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,22 @@
 "Helper class for compiling RISCV programs"
 
 import os
+import re
+import sys
+import json
+import mmap
+import struct
+import argparse
 from pathlib import Path
 
 from ninja.misc.ninja_syntax import Writer as NinjaWriter
 
-from util import debug, calculate_address_width, convert_hex_file
+from util import debug, calculate_address_width, convert_hex
 
 
-def write_riscv_ninja_rules(writer):
+def write_riscv_ninja_rules(writer, launcher=""):
+    """Writes the rules for building RISCV programs, compiles are run through the
+    launcher (the compile cache) if one is given"""
     ninja_writer = NinjaWriter(writer)
     ninja_writer.comment("Rules for RISCV compilation")
 
@@ -21,16 +29,24 @@ def write_riscv_ninja_rules(writer):
     command += " $opt"
     command += " $includes"
 
-    # Create rule for assembling RISCV object files
+    # Create rule for assembling RISCV object files, plain assembly is never
+    # preprocessed so it has no dependencies to track and nothing to cache on
     ninja_writer.rule(
         name="riscv_assemble",
         command=f"{command} -o $out -c $in -Wno-unused-command-line-argument",
     )
 
+    # Create rule for assembling preprocessed RISCV object files
+    ninja_writer.rule(
+        name="riscv_assemble_cpp",
+        command=f"{launcher} {command} -o $out -c $in -Wno-unused-command-line-argument -MMD -MF $out.d".strip(),
+        depfile="$out.d",
+    )
+
     # Create rule for compiling RISCV object files
     ninja_writer.rule(
         name="riscv_compile",
-        command=f"{command} -o $out -c $in -Wno-unused-command-line-argument -MMD -MF $out.d",
+        command=f"{launcher} {command} -o $out -c $in -Wno-unused-command-line-argument -MMD -MF $out.d".strip(),
         depfile="$out.d",
     )
 
@@ -40,38 +56,188 @@ def write_riscv_ninja_rules(writer):
         command=f"{command} -T $linker -nostartfiles -o $out $in",
     )
 
-    # Create rule for converting object files to raw binaries
-    ninja_writer.rule(
-        name="riscv_objcopy",
-        command=f"{clang_path}/llvm-objcopy -O binary $in $out",
-    )
-
     # Create rule for dissassembling object files
     ninja_writer.rule(
         name="riscv_objdump",
         command=f"{clang_path}/llvm-objdump -d $in > $out",
     )
 
-    # Create rule for extracting symbols from object files
+    # Create rule for extracting the raw binary and hex from linked programs and
+    # collecting program stats
     ninja_writer.rule(
-        name="riscv_objdump_symbols",
-        command=f"{clang_path}/llvm-objdump -t $in > $out",
+        name="riscv_stats",
+        command=f"{sys.executable} riscv.py stats $name --data-width $data_width",
     )
 
     ninja_writer.newline()
 
 
+_ELF_HEADER = struct.Struct("<16sHHIIIIIHHHHHH")
+_ELF_HEADER_FIELDS = (
+    "ident",
+    "type",
+    "machine",
+    "version",
+    "entry",
+    "phoff",
+    "shoff",
+    "flags",
+    "ehsize",
+    "phentsize",
+    "phnum",
+    "shentsize",
+    "shnum",
+    "shstrndx",
+)
+_ELF_SECTION = struct.Struct("<IIIIIIIIII")
+_ELF_SEGMENT = struct.Struct("<IIIIIIII")
+_ELF_SYMBOL = struct.Struct("<IIIBBH")
+
+_SHT_SYMTAB = 2
+_SHT_NOBITS = 8
+_SHF_ALLOC = 0x2
+_PT_LOAD = 1
+
+
+class ElfSection:
+    "Describes a section of an ELF file"
+
+    def __init__(self, name, section_type, flags, address, offset, size, link):
+        # Offset into the section name table until the names are resolved
+        self.name = name
+        self.type = section_type
+        self.flags = flags
+        self.address = address
+        self.offset = offset
+        self.size = size
+        self.link = link
+
+    def get_contents(self, data):
+        "Returns the contents of the section within the file"
+        return data[self.offset : self.offset + self.size]
+
+    def is_loaded(self):
+        "Returns if the section has contents that are loaded into memory"
+        return (
+            self.flags & _SHF_ALLOC != 0 and self.type != _SHT_NOBITS and self.size > 0
+        )
+
+
+class ElfFile:
+    """Minimal reader for little-endian ELF32 files, parses the section layout and
+    symbol table of linked programs and extracts their loadable image"""
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.sections = []
+        self.symbols = {}
+        self.image_address = 0
+        self.image = b""
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self._parse(memoryview(data))
+
+    def _parse(self, data):
+        header = dict(zip(_ELF_HEADER_FIELDS, _ELF_HEADER.unpack_from(data, 0)))
+        ident = header["ident"]
+        if ident[:4] != b"\x7fELF":
+            raise RuntimeError(f"{self.path} is not an ELF file!")
+        if ident[4] != 1 or ident[5] != 1:
+            raise RuntimeError(f"{self.path} is not a little-endian ELF32 file!")
+
+        raw_sections = [
+            _ELF_SECTION.unpack_from(data, header["shoff"] + i * header["shentsize"])
+            for i in range(header["shnum"])
+        ]
+        self.sections = [
+            ElfSection(raw[0], raw[1], raw[2], raw[3], raw[4], raw[5], raw[6])
+            for raw in raw_sections
+        ]
+        if len(self.sections) > 0:
+            names = bytes(self.sections[header["shstrndx"]].get_contents(data))
+            for section in self.sections:
+                section.name = _get_string(names, section.name)
+
+        for section in self.sections:
+            if section.type != _SHT_SYMTAB:
+                continue
+            strings = bytes(self.sections[section.link].get_contents(data))
+            symbols = section.get_contents(data)
+            # Local symbols come first so globals win when names collide
+            for name, value, _, _, _, _ in _ELF_SYMBOL.iter_unpack(symbols):
+                if name != 0:
+                    self.symbols[_get_string(strings, name)] = value
+
+        segments = [
+            _ELF_SEGMENT.unpack_from(data, header["phoff"] + i * header["phentsize"])
+            for i in range(header["phnum"])
+        ]
+        self._extract_image(data, segments)
+
+    def _extract_image(self, data, segments):
+        "Lays out the loaded sections at their load addresses like objcopy does"
+        loaded = []
+        for section in self.sections:
+            if not section.is_loaded():
+                continue
+            # Sections are loaded at the physical address of their segment
+            address = section.address
+            for p_type, p_offset, _, p_paddr, p_filesz, _, _, _ in segments:
+                if (
+                    p_type == _PT_LOAD
+                    and p_offset <= section.offset < p_offset + p_filesz
+                ):
+                    address = p_paddr + section.offset - p_offset
+                    break
+            loaded.append((address, section))
+        if len(loaded) == 0:
+            return
+        self.image_address = min(address for address, _ in loaded)
+        end = max(address + section.size for address, section in loaded)
+        image = bytearray(end - self.image_address)
+        for address, section in loaded:
+            start = address - self.image_address
+            image[start : start + section.size] = section.get_contents(data)
+        self.image = bytes(image)
+
+
+def _get_string(strings, offset):
+    return strings[offset : strings.index(b"\0", offset)].decode("utf-8")
+
+
+# Rules for the build files that are not C sources
+_BUILD_RULES = {".s": "riscv_assemble", ".S": "riscv_assemble_cpp"}
+
+_MEMORY_LENGTH = re.compile(r"LENGTH\s*=\s*(\d+)\s*([KM]?)")
+
+
+def get_linker_memory_size(linker_script):
+    """Returns the bytes of memory the linker script declares, scripts without a
+    MEMORY region only place the program and count as 0"""
+    with open(linker_script, "r") as file:
+        lengths = _MEMORY_LENGTH.findall(file.read())
+    scale = {"": 1, "K": 1 << 10, "M": 1 << 20}
+    return sum(int(length) * scale[unit] for length, unit in lengths)
+
+
 class RiscvProgram:
     "Compiles RISCV programs using clang"
 
     def __init__(
-        self, name, build_files, linker_script=None, include_folders=None, opt=None
+        self,
+        name,
+        build_files,
+        linker_script=None,
+        include_folders=None,
+        opt=None,
+        data_width=32,
     ) -> None:
         self.name = name
         self.build_files = build_files
         self.linker_script = linker_script
         self.include_folders = include_folders
         self.opt = opt
+        self.data_width = data_width
         self.program_size = None
         self.memory_size = None
         self.address_width = None
@@ -92,15 +258,38 @@ class RiscvProgram:
         )
 
     def get_program_stats(self):
-        with open(f"bin/{self.name}.symbols", "r") as file:
-            for line in file.readlines():
-                if "__stack" in line:
-                    self.memory_size = int(line.split(" ")[0], 16)
-                    self.address_width = calculate_address_width(self.memory_size)
-
-        self.program_size = convert_hex_file(
-            "bin/" + self.name + ".bin", "bin/" + self.name + ".mem"
-        )
+        """Extracts the binary and hex from the linked program and records the
+        memory the program needs"""
+        elf = ElfFile(self.get_elf())
+        if "__stack" in elf.symbols:
+            self.memory_size = elf.symbols["__stack"]
+        else:
+            # Programs without a stack only need room up to the end of their bss
+            self.memory_size = max(elf.symbols.get("_end", len(elf.image)), 4)
+        self.address_width = calculate_address_width(self.memory_size)
+
+        with open(self.get_binary(), "wb") as file:
+            file.write(elf.image)
+        with open(f"bin/{self.name}.mem", "w") as file:
+            self.program_size = convert_hex(elf.image, file, word_width=self.data_width)
+
+        with open(self.get_stats(), "w") as file:
+            json.dump(
+                {
+                    "program_size": self.program_size,
+                    "memory_size": self.memory_size,
+                    "address_width": self.address_width,
+                },
+                file,
+            )
+
+    def load_program_stats(self):
+        "Loads the stats recorded by the build"
+        with open(self.get_stats(), "r") as file:
+            stats = json.load(file)
+        self.program_size = stats["program_size"]
+        self.memory_size = stats["memory_size"]
+        self.address_width = stats["address_width"]
 
     def get_build_files(self):
         "Returns the build files"
@@ -110,6 +299,18 @@ class RiscvProgram:
         "Returns the linker script"
         return self.linker_script
 
+    def get_elf(self):
+        "Returns the path of the linked program"
+        return f"bin/{self.name}.o"
+
+    def get_binary(self):
+        "Returns the path of the raw binary loaded by the simulators"
+        return f"bin/{self.name}.bin"
+
+    def get_stats(self):
+        "Returns the path of the program stats recorded by the build"
+        return f"bin/{self.name}.stats"
+
     def write_ninja_build(self, writer):
         "Writes the ninja rules for building this program"
         ninja_writer = NinjaWriter(writer)
@@ -120,9 +321,7 @@ class RiscvProgram:
             object_file = Path(f"bin/{self.name}/{build_file}").with_suffix(".o")
             ninja_writer.build(
                 outputs=str(object_file),
-                rule="riscv_assemble"
-                if Path(f"{build_file}").suffix in [".s", ".S"]
-                else "riscv_compile",
+                rule=_BUILD_RULES.get(Path(build_file).suffix, "riscv_compile"),
                 inputs=build_file,
                 variables={
                     "opt": self.opt,
@@ -132,26 +331,43 @@ class RiscvProgram:
             object_files.append(str(object_file))
 
         ninja_writer.build(
-            outputs=f"bin/{self.name}.o",
+            outputs=self.get_elf(),
             rule="riscv_link",
             inputs=object_files,
             variables={"linker": f"{self.linker_script}", "opt": self.opt},
             implicit=[f"{self.linker_script}"],
         )
-        ninja_writer.build(
-            outputs=f"bin/{self.name}.bin",
-            rule="riscv_objcopy",
-            inputs=f"bin/{self.name}.o",
-        )
         ninja_writer.build(
             outputs=f"bin/{self.name}.s",
             rule="riscv_objdump",
-            inputs=f"bin/{self.name}.o",
+            inputs=self.get_elf(),
         )
         ninja_writer.build(
-            outputs=f"bin/{self.name}.symbols",
-            rule="riscv_objdump_symbols",
-            inputs=f"bin/{self.name}.o",
+            outputs=self.get_stats(),
+            rule="riscv_stats",
+            inputs=self.get_elf(),
+            implicit=["riscv.py", "util.py"],
+            implicit_outputs=[self.get_binary(), f"bin/{self.name}.mem"],
+            variables={"name": self.name, "data_width": str(self.data_width)},
         )
 
         ninja_writer.newline()
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    stats_parser = subparsers.add_parser(
+        "stats", help="convert a built program to hex and record its stats"
+    )
+    stats_parser.add_argument("name", help="program name, relative to bin/")
+    stats_parser.add_argument("--data-width", type=int, default=32)
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        RiscvProgram(args.name, [], data_width=args.data_width).get_program_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -514,6 +514,11 @@ module gecko_decode
     logic [4:0]  debug_register_addr /*verilator public*/;
     logic [31:0] debug_jump_address /*verilator public*/;
     logic [31:0] debug_register_data /*verilator public*/;
+    logic        debug_jump_resolved /*verilator public*/;
+    logic        debug_jump_taken /*verilator public*/;
+    logic        debug_jump_unconditional /*verilator public*/;
+    logic        debug_jump_mispredicted /*verilator public*/;
+    logic [31:0] debug_jump_pc /*verilator public*/;
 
     always_comb debug_jump_valid = jump_command.valid && 
                                   !jump_cmd_in.mispredicted && 
@@ -523,4 +528,11 @@ module gecko_decode
     always_comb debug_register_addr = writeback_in.addr;
     always_comb debug_register_data = writeback_in.value;
 
+    // Every control flow instruction that was not squashed, taken or not
+    always_comb debug_jump_resolved = jump_command.valid && !jump_cmd_in.mispredicted;
+    always_comb debug_jump_taken = jump_cmd_in.branched || jump_cmd_in.jumped;
+    always_comb debug_jump_unconditional = jump_cmd_in.jumped;
+    always_comb debug_jump_mispredicted = jump_cmd_in.update_pc;
+    always_comb debug_jump_pc = jump_cmd_in.current_pc;
+
 endmodule
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"Helper functions for running RISCV programs on Verilator simulators"
+
+import os
+import re
+import json
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from util import info, error
+
+_FINISHED_PATTERN = re.compile(r"Gecko finished: (-?\d+)!")
+_CYCLES_PATTERN = re.compile(r"(\d+) cycles in (\d+) us")
+_RESULT_PATTERN = re.compile(
+    r"^Result: (\S+) (\w+) (-?\d+) (\d+) (\d+)$", flags=re.MULTILINE
+)
+
+
+class SimulationResult:
+    "Describes the outcome of running a single program on a simulator"
+
+    def __init__(self, name, status, exit_code=None, cycles=None, sim_time_us=None):
+        self.name = name
+        self.simulator = None
+        self.status = status
+        self.exit_code = exit_code
+        self.cycles = cycles
+        self.sim_time_us = sim_time_us
+        self.wall_time = None
+        self.output = ""
+
+    def passed(self):
+        "Returns if the program finished with a zero exit code"
+        return self.status == "pass"
+
+    def to_dict(self):
+        "Returns the machine-readable form of this result"
+        return {
+            "name": self.name,
+            "simulator": self.simulator,
+            "status": self.status,
+            "exit_code": self.exit_code,
+            "cycles": self.cycles,
+            "sim_time_us": self.sim_time_us,
+            "wall_time": self.wall_time,
+        }
+
+
+def parse_simulator_output(name, output):
+    "Parses the testbench output into a simulation result"
+    exit_code = None
+    status = "crash"
+    finished = _FINISHED_PATTERN.search(output)
+    if finished is not None:
+        exit_code = int(finished.group(1))
+        status = "pass" if exit_code == 0 else "fail"
+    elif "Gecko error!" in output:
+        status = "error"
+    elif "Simulator timed out!" in output:
+        status = "timeout"
+
+    result = SimulationResult(name, status, exit_code=exit_code)
+    cycles = _CYCLES_PATTERN.search(output)
+    if cycles is not None:
+        result.cycles = int(cycles.group(1))
+        result.sim_time_us = int(cycles.group(2))
+    result.output = output
+    return result
+
+
+def run_simulation(simulator, name, binary, args=None, timeout=None):
+    "Runs a single binary on the simulator and returns the parsed result"
+    command = [simulator, "--binary", binary, "--vcd", f"bin/{name}.vcd"]
+    if args is not None:
+        command += args
+
+    start = time.time()
+    try:
+        process = subprocess.run(
+            command, capture_output=True, check=False, timeout=timeout
+        )
+        output = process.stdout.decode("utf-8", errors="replace")
+        result = parse_simulator_output(name, output)
+        if process.returncode != 0 and result.status == "pass":
+            result.status = "crash"
+    except subprocess.TimeoutExpired as exception:
+        output = (exception.stdout or b"").decode("utf-8", errors="replace")
+        result = parse_simulator_output(name, output)
+        result.status = "timeout"
+    result.simulator = simulator
+    result.wall_time = time.time() - start
+    return result
+
+
+def parse_batch_output(output):
+    "Parses the result line of every program of a batch run, by program name"
+    results = {}
+    for match in _RESULT_PATTERN.finditer(output):
+        name, status, exit_code, cycles, sim_time_us = match.groups()
+        results[name] = SimulationResult(
+            name,
+            status,
+            exit_code=int(exit_code) if status in ("pass", "fail") else None,
+            cycles=int(cycles),
+            sim_time_us=int(sim_time_us),
+        )
+    return results
+
+
+def run_batch(simulator, programs, manifest, timeout=None):
+    """Runs the programs one after another in a single simulator process, the model
+    is built once and only reset between programs. Programs without a result
+    crashed the simulator, or timed out if it was stopped"""
+    with open(manifest, "w") as file:
+        for name, program in programs.items():
+            file.write(f"{name} {program.get_binary()}\n")
+
+    missing = "crash"
+    try:
+        process = subprocess.run(
+            [simulator, "--manifest", manifest],
+            capture_output=True,
+            check=False,
+            timeout=timeout,
+        )
+        output = process.stdout.decode("utf-8", errors="replace")
+    except subprocess.TimeoutExpired as exception:
+        output = (exception.stdout or b"").decode("utf-8", errors="replace")
+        missing = "timeout"
+
+    parsed = parse_batch_output(output)
+    results = []
+    for name in programs:
+        result = parsed.get(name, SimulationResult(name, missing))
+        result.simulator = simulator
+        results.append(result)
+    return results
+
+
+def _run_batches(simulator, programs, jobs, timeout):
+    "Shards the programs across one batch simulator process per job"
+    names = list(programs)
+    shards = [names[i::jobs] for i in range(min(jobs, len(names)))]
+    os.makedirs("bin/manifests", exist_ok=True)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                run_batch,
+                simulator,
+                {name: programs[name] for name in shard},
+                f"bin/manifests/{os.path.basename(simulator)}_{i}.txt",
+                timeout=None if timeout is None else timeout * len(shard),
+            )
+            for i, shard in enumerate(shards)
+        ]
+        results = {
+            result.name: result for future in futures for result in future.result()
+        }
+    return [results[name] for name in names]
+
+
+def run_simulations(
+    simulator, programs, jobs=None, timeout=None, args=None, batch=False
+):
+    """Runs every program on the simulator in parallel, the pool only waits on the
+    simulator processes so threads are enough to keep every core busy. Extra
+    simulator arguments can be given for each program name. In batch mode each job
+    runs its share of the programs in one simulator process instead"""
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    if batch:
+        if args is not None:
+            raise RuntimeError("Simulator arguments cannot be given in batch mode!")
+        results = _run_batches(simulator, programs, jobs, timeout)
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(
+                    run_simulation,
+                    simulator,
+                    name,
+                    program.get_binary(),
+                    args=None if args is None else args.get(name),
+                    timeout=timeout,
+                )
+                for name, program in programs.items()
+            ]
+            results = [future.result() for future in futures]
+
+    for result in results:
+        if result.passed():
+            info(f"{result.name}: {result.status} ({result.cycles} cycles)")
+        else:
+            error(f"{result.name}: {result.status}")
+    return results
+
+
+def write_results(results, path):
+    "Writes the simulation results as a JSON table"
+    with open(path, "w") as file:
+        json.dump(
+            {
+                "passed": sum(1 for result in results if result.passed()),
+                "failed": sum(1 for result in results if not result.passed()),
+                "results": [result.to_dict() for result in results],
+            },
+            file,
+            indent=2,
+        )
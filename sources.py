@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"Helper classes for finding SystemVerilog sources and their dependencies"
+
+from __future__ import annotations
+
+import os
+import glob
+import json
+import time
+import hashlib
+
+from util import debug, error
+
+_DIRECTIVES = ("//!import ", "//!include ", "//!wrapper ", "//!no_lint")
+
+# Marks sources that still include their headers the old way, with relative paths
+# for the linter, their folders are left out of the build
+_LEGACY_MARKER = "`ifdef __LINTER__"
+
+# Files modified this close to being parsed could change again without their
+# mtime changing, so they are always parsed again on the next run
+_RACY_SECONDS = 2
+
+
+def _read_header(path):
+    """Reads only the leading special comments of the file, returning the lines and
+    a hash of them"""
+    header = []
+    with open(path, "r") as file:
+        for line in file:
+            if line.startswith(_DIRECTIVES):
+                header.append(line)
+            elif line == "":
+                pass
+            else:
+                break
+    digest = hashlib.sha1("".join(header).encode("utf-8")).hexdigest()
+    return header, digest
+
+
+def _parse_header(header):
+    include_paths = []
+    import_paths = []
+    wrapper_path = None
+    no_lint = False
+    for line in header:
+        if line.startswith("//!import "):
+            import_paths.append("rtl/" + line[len("//!import") :].strip())
+        elif line.startswith("//!include "):
+            include_paths.append("rtl/" + line[len("//!include") :].strip())
+        elif line.startswith("//!wrapper "):
+            wrapper_path = "wrappers/" + line[len("//!wrapper") :].strip()
+        elif line.startswith("//!no_lint"):
+            no_lint = True
+    return include_paths, import_paths, wrapper_path, no_lint
+
+
+def _has_legacy_marker(path):
+    with open(path, "r") as file:
+        return _LEGACY_MARKER in file.read()
+
+
+def get_includes_imports(path):
+    """Parses special comments in the file to find dependencies"""
+    header, _ = _read_header(path)
+    return _parse_header(header)
+
+
+class SourceCache:
+    """Persistent cache of the special comments parsed from each file, entries are
+    keyed by path and only trusted while the mtime and size are unchanged"""
+
+    VERSION = 2
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path, "r") as file:
+                cached = json.load(file)
+            if cached.get("version") == SourceCache.VERSION:
+                self.entries = cached["entries"]
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def _lookup(self, path):
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if (
+            entry is not None
+            and entry["mtime"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            return entry
+        header, digest = _read_header(path)
+        include_paths, import_paths, wrapper_path, no_lint = _parse_header(header)
+        racy = time.time() - stat.st_mtime_ns / 1e9 < _RACY_SECONDS
+        entry = {
+            "mtime": None if racy else stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": digest,
+            "includes": include_paths,
+            "imports": import_paths,
+            "wrapper": wrapper_path,
+            "no_lint": no_lint,
+            # Only found by reading the whole file, so it is kept with the rest
+            "legacy": _has_legacy_marker(path),
+        }
+        self.entries[path] = entry
+        self.dirty = True
+        return entry
+
+    def get_includes_imports(self, path):
+        """Returns the parsed special comments of the file, only reading the file
+        when the cached entry is out of date"""
+        entry = self._lookup(path)
+        return (
+            list(entry["includes"]),
+            list(entry["imports"]),
+            entry["wrapper"],
+            entry["no_lint"],
+        )
+
+    def is_legacy(self, path):
+        "Returns if the file still uses the old includes"
+        return self._lookup(path)["legacy"]
+
+    def get_header_hash(self, path):
+        "Returns the hash of the special comments of the file"
+        return self._lookup(path)["hash"]
+
+    def save(self):
+        "Writes the cache back to disk if anything changed"
+        if not self.dirty:
+            return
+        # Forget files that were deleted since they were cached
+        self.entries = {
+            path: entry for path, entry in self.entries.items() if os.path.isfile(path)
+        }
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"version": SourceCache.VERSION, "entries": self.entries}, file)
+        os.replace(temp_path, self.path)
+        self.dirty = False
+
+
+def _get_includes_imports(path, cache):
+    if cache is None:
+        return get_includes_imports(path)
+    return cache.get_includes_imports(path)
+
+
+def _is_legacy(path, cache):
+    if cache is None:
+        return _has_legacy_marker(path)
+    return cache.is_legacy(path)
+
+
+class HeaderFile:
+    """Describes dependencies of .svh files"""
+
+    def __init__(self, path, cache=None) -> None:
+        self.path = path
+        self.includes, _, _, _ = _get_includes_imports(path, cache)
+
+
+class SourceFile:
+    """Describes dependencies of .sv files"""
+
+    def __init__(self, path, cache=None) -> None:
+        self.path = path
+        (
+            self.includes,
+            self.imports,
+            self.wrapper,
+            self.no_lint,
+        ) = _get_includes_imports(path, cache)
+        self.dependencies = None
+
+    def get_dependencies(self, graph=None):
+        "Returns a list of all the SV dependencies listed in included order"
+        if graph is None and self.dependencies is None:
+            error(
+                f"{self.path} asked for dependencies without being given the import graph first!"
+            )
+        if self.dependencies is None:
+            self.dependencies = list(graph.get_dependencies(self.path))
+            if self.wrapper is not None:
+                self.dependencies += [self.wrapper]
+        return self.dependencies
+
+
+def search_headers(path, cache=None):
+    header_files = {}
+    for glob_path in glob.glob(os.path.join(path, "*.svh")):
+        header_files[glob_path] = HeaderFile(glob_path, cache=cache)
+    return header_files
+
+
+def search_sources(path, cache=None):
+    source_files = {}
+    for glob_path in glob.glob(os.path.join(path, "*.sv")):
+        source_files[glob_path] = SourceFile(glob_path, cache=cache)
+    return source_files
+
+
+def _get_legacy_reason(paths, cache=None):
+    "Returns why the sources cannot be built, or None if they all can be"
+    for path in paths:
+        if _is_legacy(path, cache):
+            return f"{path} uses {_LEGACY_MARKER} includes"
+        _, import_paths, _, _ = _get_includes_imports(path, cache)
+        for import_path in import_paths:
+            if not os.path.isfile(import_path):
+                return f"{path} imports {import_path} which does not exist"
+    return None
+
+
+def search_folders(path, cache=None):
+    """Returns every folder under path with SystemVerilog sources, skipping folders
+    that have not been moved over to the special comments yet"""
+    folders = []
+    for folder, _, files in sorted(os.walk(path)):
+        paths = [
+            os.path.join(folder, file)
+            for file in sorted(files)
+            if file.endswith((".sv", ".svh"))
+        ]
+        if len(paths) == 0:
+            continue
+        reason = _get_legacy_reason(paths, cache=cache)
+        if reason is not None:
+            debug(f"Skipping {folder}, {reason}")
+            continue
+        folders.append(folder)
+    return folders
@@ -0,0 +1,202 @@
+#include <stdint.h>
+#include <string.h>
+#include <deque>
+#include <vector>
+
+#include "Vgecko_nano.h"
+#include "Vgecko_nano_gecko_nano_wrapper.h"
+#include "Vgecko_nano_gecko_nano__M10_TBz2_TCz3.h"
+#include "Vgecko_nano_mem_sequential_double__pi1.h"
+#include "Vgecko_nano_xilinx_block_ram_double__pi3.h"
+#if VM_TRACE_FST
+#include "verilated_fst_c.h"
+typedef VerilatedFstC WaveFile;
+#elif VM_TRACE
+#include "verilated_vcd_c.h"
+typedef VerilatedVcdC WaveFile;
+#endif
+#include "verilated.h"
+
+// Conditions gecko_nano_run stops early on, can be combined
+#define GECKO_STOP_ON_EXIT 1
+#define GECKO_STOP_ON_TTY_OUT 2
+
+// Cycles the exit code takes to settle after the exit flag is raised
+#define GECKO_EXIT_CYCLES 10
+
+// Shared library interface for driving the model from Python with ctypes, the
+// cycle loop stays in here so the cost of a call is paid once per batch
+struct GeckoNano {
+    Vgecko_nano *dut;
+#if VM_TRACE
+    WaveFile *trace;
+#endif
+    uint64_t cycles;
+    std::deque<uint8_t> tty_in;
+    std::vector<uint8_t> tty_out;
+};
+
+static void gecko_nano_tick(GeckoNano *sim) {
+    sim->dut->clk = 1;
+    sim->dut->eval();
+#if VM_TRACE
+    if (sim->trace != NULL) {
+        sim->trace->dump((vluint64_t) (10 * sim->cycles + 5));
+    }
+#endif
+    sim->dut->clk = 0;
+    sim->dut->eval();
+#if VM_TRACE
+    if (sim->trace != NULL) {
+        sim->trace->dump((vluint64_t) (10 * sim->cycles + 10));
+    }
+#endif
+    sim->cycles++;
+}
+
+static void gecko_nano_cycle(GeckoNano *sim) {
+    sim->dut->tty_in_valid = !sim->tty_in.empty();
+    sim->dut->tty_in_data = sim->tty_in.empty() ? 0 : sim->tty_in.front();
+    bool sent = sim->dut->tty_in_valid && sim->dut->tty_in_ready;
+    gecko_nano_tick(sim);
+    if (sent) {
+        sim->tty_in.pop_front();
+    }
+    if (sim->dut->tty_out_valid) {
+        sim->tty_out.push_back((uint8_t) sim->dut->tty_out_data);
+    }
+}
+
+static auto gecko_nano_memory(GeckoNano *sim) {
+    return sim->dut->gecko_nano_wrapper->inst->mem->gen_xilinx__DOT__xilinx_block_ram_double_inst;
+}
+
+extern "C" {
+
+GeckoNano *gecko_nano_create(void) {
+    GeckoNano *sim = new GeckoNano();
+#if VM_TRACE
+    Verilated::traceEverOn(true);
+    sim->trace = NULL;
+#endif
+    sim->dut = new Vgecko_nano();
+    sim->dut->tty_in_valid = 0;
+    sim->dut->tty_out_ready = 1;
+    sim->cycles = 0;
+    return sim;
+}
+
+void gecko_nano_destroy(GeckoNano *sim) {
+#if VM_TRACE
+    if (sim->trace != NULL) {
+        sim->trace->close();
+        delete sim->trace;
+    }
+#endif
+    // Finishing the model writes out any profiles it recorded
+    sim->dut->final();
+    delete sim->dut;
+    delete sim;
+}
+
+// Returns if tracing is supported, models built without it (the fast
+// profiles) never trace
+int gecko_nano_open_trace(GeckoNano *sim, const char *path) {
+#if VM_TRACE
+    if (sim->trace == NULL) {
+        sim->trace = new WaveFile;
+        sim->dut->trace(sim->trace, 99);
+        sim->trace->open(path);
+    }
+    return 1;
+#else
+    return 0;
+#endif
+}
+
+uint64_t gecko_nano_memory_bytes(GeckoNano *sim) {
+    auto memory = gecko_nano_memory(sim);
+    return ((uint64_t) 1 << memory->ADDR_WIDTH) * (memory->DATA_WIDTH / 8);
+}
+
+// Copies little-endian words into memory starting at a byte offset, returns
+// non-zero if they do not fit
+int gecko_nano_load_memory(GeckoNano *sim, const uint8_t *data, uint64_t length, uint64_t offset) {
+    if (offset % 4 != 0 || offset + length > gecko_nano_memory_bytes(sim)) {
+        return 1;
+    }
+    auto memory = gecko_nano_memory(sim);
+    for (uint64_t i = 0; i < length; i += 4) {
+        uint8_t word[4] = {0, 0, 0, 0};
+        memcpy(word, &data[i], (length - i) < 4 ? (length - i) : 4);
+        memory->data[(offset + i) / 4] = word[0] | (word[1] << 8) | (word[2] << 16) | ((uint32_t) word[3] << 24);
+    }
+    return 0;
+}
+
+void gecko_nano_reset(GeckoNano *sim, uint64_t cycles) {
+    sim->dut->rst = 1;
+    for (uint64_t i = 0; i < cycles; i++) {
+        gecko_nano_tick(sim);
+    }
+    sim->dut->rst = 0;
+    sim->tty_in.clear();
+    sim->tty_out.clear();
+}
+
+// Runs up to n_cycles, returning the number of cycles that were run
+uint64_t gecko_nano_run(GeckoNano *sim, uint64_t n_cycles, int stop_on) {
+    uint64_t start = sim->cycles;
+    while (sim->cycles - start < n_cycles) {
+        gecko_nano_cycle(sim);
+        if (Verilated::gotFinish()) {
+            break;
+        } else if ((stop_on & GECKO_STOP_ON_EXIT) && sim->dut->exit_flag) {
+            for (int i = 0; i < GECKO_EXIT_CYCLES; i++) {
+                gecko_nano_cycle(sim);
+            }
+            break;
+        } else if ((stop_on & GECKO_STOP_ON_TTY_OUT) && sim->dut->tty_out_valid) {
+            break;
+        }
+    }
+    return sim->cycles - start;
+}
+
+void gecko_nano_tty_write(GeckoNano *sim, const uint8_t *data, uint64_t length) {
+    sim->tty_in.insert(sim->tty_in.end(), data, data + length);
+}
+
+uint64_t gecko_nano_tty_pending(GeckoNano *sim) {
+    return sim->tty_out.size();
+}
+
+// Drains up to length bytes of tty output into the buffer
+uint64_t gecko_nano_tty_read(GeckoNano *sim, uint8_t *data, uint64_t length) {
+    uint64_t count = sim->tty_out.size() < length ? sim->tty_out.size() : length;
+    memcpy(data, sim->tty_out.data(), count);
+    sim->tty_out.erase(sim->tty_out.begin(), sim->tty_out.begin() + count);
+    return count;
+}
+
+uint64_t gecko_nano_cycles(GeckoNano *sim) {
+    return sim->cycles;
+}
+
+int gecko_nano_finished(GeckoNano *sim) {
+    return Verilated::gotFinish();
+}
+
+int gecko_nano_exit_flag(GeckoNano *sim) {
+    return sim->dut->exit_flag;
+}
+
+int gecko_nano_error_flag(GeckoNano *sim) {
+    return sim->dut->error_flag;
+}
+
+int gecko_nano_exit_code(GeckoNano *sim) {
+    return sim->dut->exit_code;
+}
+
+}
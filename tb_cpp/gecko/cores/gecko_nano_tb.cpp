@@ -1,5 +1,9 @@
+#include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <chrono>
+#include <climits>
+#include <cstdio>
 #include <filesystem>
 #include <iostream>
 #include <fstream>
@@ -14,46 +18,272 @@
 #include "Vgecko_nano_gecko_decode__pi8.h"
 #include "Vgecko_nano_mem_sequential_double__pi1.h"
 #include "Vgecko_nano_xilinx_block_ram_double__pi3.h"
+#if VM_TRACE_FST
+#include "verilated_fst_c.h"
+typedef VerilatedFstC WaveFile;
+#elif VM_TRACE
 #include "verilated_vcd_c.h"
+typedef VerilatedVcdC WaveFile;
+#endif
+#if VM_SAVABLE
+#include "verilated_save.h"
+#endif
 #include "verilated.h"
 
+// Fixed-size records of the binary execution trace, read by trace_analysis.py
+#define TRACE_MAGIC "GTRC"
+#define TRACE_VERSION 1
+#define TRACE_KIND_JUMP 1
+#define TRACE_KIND_REGISTER 2
+#define TRACE_FLAG_TAKEN 1
+#define TRACE_FLAG_MISPREDICTED 2
+#define TRACE_FLAG_UNCONDITIONAL 4
+
+#pragma pack(push, 1)
+struct TraceHeader {
+    char magic[4];
+    uint32_t version;
+    uint32_t record_size;
+    uint32_t reserved;
+};
+
+struct TraceRecord {
+    uint64_t cycle;
+    uint32_t pc;    // Address of the jump, unknown for register writes
+    uint32_t value; // Jump target or the value written
+    uint8_t kind;
+    uint8_t rd;
+    uint8_t flags;
+    uint8_t reserved;
+};
+#pragma pack(pop)
+
+// Buffers records and writes them out in large blocks
+class TraceWriter {
+  public:
+    FILE *file;
+    std::vector<TraceRecord> buffer;
+
+    TraceWriter(const char *path) {
+        file = fopen(path, "wb");
+        buffer.reserve(1 << 16);
+        TraceHeader header;
+        memcpy(header.magic, TRACE_MAGIC, 4);
+        header.version = TRACE_VERSION;
+        header.record_size = sizeof(TraceRecord);
+        header.reserved = 0;
+        fwrite(&header, sizeof(header), 1, file);
+    }
+
+    ~TraceWriter(void) {
+        flush();
+        fclose(file);
+    }
+
+    void write(uint64_t cycle, uint8_t kind, uint32_t pc, uint8_t rd, uint32_t value, uint8_t flags) {
+        buffer.push_back({cycle, pc, value, kind, rd, flags, 0});
+        if (buffer.size() == buffer.capacity()) {
+            flush();
+        }
+    }
+
+    void flush(void) {
+        fwrite(buffer.data(), sizeof(TraceRecord), buffer.size(), file);
+        buffer.clear();
+    }
+};
+
+#if VM_TRACE && !VM_TRACE_FST
+// Keeps the VCD output of the last two ring buffer segments in memory until
+// they are saved, reopening the trace starts a new segment
+class MemoryVcdFile : public VerilatedVcdFile {
+  public:
+    std::string previous;
+    std::string current;
+
+    bool open(const std::string &name) override {
+        previous.swap(current);
+        current.clear();
+        return true;
+    }
+
+    void close(void) override {}
+
+    ssize_t write(const char *bufp, ssize_t len) override {
+        current.append(bufp, len);
+        return len;
+    }
+};
+#endif
+
+// Returns the path with a suffix added before its extension
+static std::string add_suffix(const std::string &path, const std::string &suffix) {
+    size_t dot = path.rfind('.');
+    if (dot == std::string::npos || path.find('/', dot) != std::string::npos) {
+        return path + suffix;
+    }
+    return path.substr(0, dot) + suffix + path.substr(dot);
+}
+
 template<class Module>
 class Testbench {
   public:
     Module *dut;
-    VerilatedVcdC *trace;
+#if VM_TRACE
+    WaveFile *trace;
+#if !VM_TRACE_FST
+    MemoryVcdFile *memory;
+#endif
+#endif
     unsigned long cycles;
+    std::string trace_path;
+    bool tracing;
+    // Cycles in each ring buffer segment, zero dumps every cycle to the file
+    unsigned long ring_cycles;
+    unsigned long segment_start;
 
     Testbench(void) {
+#if VM_TRACE
         Verilated::traceEverOn(true);
-        dut = new Module();
         trace = NULL;
+#if !VM_TRACE_FST
+        memory = NULL;
+#endif
+#endif
+        dut = new Module();
         cycles = 0;
+        tracing = false;
+        ring_cycles = 0;
+        segment_start = 0;
     }
 
     ~Testbench(void) {
+        closeTrace();
         delete dut;
-        if (trace != NULL) {
-            trace->close();
-            delete trace;
-            trace = NULL;
-        }
     }
 
-    void openTrace(const char *vcdname) {
+    // Prepares the waveform, nothing is dumped until startTrace is called. With a
+    // ring buffer only the last ring_cycles to 2 * ring_cycles cycles are kept.
+    // Models built without tracing (the fast profiles) silently skip the trace
+    void openTrace(const char *path, unsigned long ring = 0) {
+#if VM_TRACE
         if (trace == NULL) {
-            trace = new VerilatedVcdC;
+            trace_path = std::string(path);
+            ring_cycles = ring;
+#if VM_TRACE_FST
+            trace = new WaveFile;
+#else
+            // The ring buffer is kept in memory and only written out when saved
+            if (ring_cycles > 0) {
+                memory = new MemoryVcdFile;
+            }
+            trace = new WaveFile(memory);
+#endif
             dut->trace(trace, 99);
-            trace->open(vcdname);
         }
+#endif
+    }
+
+    void startTrace(void) {
+#if VM_TRACE
+        if (trace != NULL && !tracing) {
+            if (!trace->isOpen()) {
+                trace->open(trace_path.c_str());
+                segment_start = cycles;
+            }
+            tracing = true;
+        }
+#endif
+    }
+
+    void stopTrace(void) {
+        tracing = false;
+    }
+
+    // Starts a new ring buffer segment, dropping the oldest one
+    void rotateTrace(void) {
+#if VM_TRACE
+        trace->close();
+#if VM_TRACE_FST
+        std::rename(trace_path.c_str(), add_suffix(trace_path, ".prev").c_str());
+#endif
+        trace->open(trace_path.c_str());
+        segment_start = cycles;
+#endif
+    }
+
+    // Writes out the ring buffer, the older segment is saved next to the trace
+    void saveTrace(void) {
+#if VM_TRACE
+        if (trace == NULL || !trace->isOpen()) {
+            return;
+        }
+        trace->close();
+        tracing = false;
+#if !VM_TRACE_FST
+        if (memory != NULL) {
+            std::ofstream(trace_path, std::ios::binary) << memory->current;
+            if (!memory->previous.empty()) {
+                std::ofstream(add_suffix(trace_path, ".prev"), std::ios::binary) << memory->previous;
+            }
+        }
+#endif
+        ring_cycles = 0;
+#endif
     }
 
     void closeTrace(void) {
+#if VM_TRACE
         if (trace != NULL) {
-            trace->close();
+            if (trace->isOpen()) {
+                trace->close();
+            }
+            // Ring buffers that were never saved are thrown away
+            if (ring_cycles > 0) {
+#if VM_TRACE_FST
+                std::remove(trace_path.c_str());
+                std::remove(add_suffix(trace_path, ".prev").c_str());
+#endif
+            }
             delete trace;
             trace = NULL;
+#if !VM_TRACE_FST
+            delete memory;
+            memory = NULL;
+#endif
         }
+#endif
+    }
+
+    // Checkpoints hold the state of the model and the cycle count, only models
+    // verilated with --savable can save them
+    void saveCheckpoint(const char *path) {
+#if VM_SAVABLE
+        VerilatedSave os;
+        os.open(path);
+        vluint64_t saved_cycles = cycles;
+        os << saved_cycles;
+        os << *dut;
+        os.close();
+#endif
+    }
+
+    bool restoreCheckpoint(const char *path) {
+#if VM_SAVABLE
+        VerilatedRestore os;
+        os.open(path);
+        if (!os.isOpen()) {
+            return false;
+        }
+        vluint64_t saved_cycles;
+        os >> saved_cycles;
+        os >> *dut;
+        os.close();
+        cycles = saved_cycles;
+        return true;
+#else
+        return false;
+#endif
     }
 
     void reset() {
@@ -67,18 +297,117 @@ class Testbench {
     void tick(void) {
         dut->clk = 1;
         dut->eval();
-        if (trace != NULL) {
+#if VM_TRACE
+        if (tracing) {
             trace->dump((vluint64_t) (10 * cycles + 5));
         }
+#endif
         dut->clk = 0;
         dut->eval();
-        if (trace != NULL) {
+#if VM_TRACE
+        if (tracing) {
             trace->dump((vluint64_t) (10 * cycles + 10));
         }
+#endif
         cycles++;
+#if VM_TRACE
+        if (tracing && ring_cycles > 0 && cycles - segment_start >= ring_cycles) {
+            rotateTrace();
+        }
+#endif
     }
 };
 
+// Cycles a program may run for before it is reported as timed out
+#define MAX_CYCLES 100000
+
+// Cycles the exit code takes to settle after the exit flag is raised
+#define EXIT_CYCLES 10
+
+static std::vector<unsigned char> read_program(const std::string &path) {
+    std::ifstream program_input(path, std::ios::binary);
+    return std::vector<unsigned char>(std::istreambuf_iterator<char>(program_input), {});
+}
+
+// Zeroes the memory and copies the program into it, returns false if it does not fit
+static bool load_program(Vgecko_nano *dut, const std::vector<unsigned char> &program) {
+    auto memory = dut->gecko_nano_wrapper->inst->mem->gen_xilinx__DOT__xilinx_block_ram_double_inst;
+    size_t words = (size_t) 1 << memory->ADDR_WIDTH;
+    if (program.size() > words * (memory->DATA_WIDTH / 8)) {
+        return false;
+    }
+    for (size_t i = 0; i < words; i++) {
+        uint32_t word = 0;
+        for (size_t j = 0; j < 4 && (i * 4) + j < program.size(); j++) {
+            word |= (uint32_t) program[(i * 4) + j] << (8 * j);
+        }
+        memory->data[i] = word;
+    }
+    return true;
+}
+
+// Runs every program in the manifest, one "<name> <binary>" per line, on the same
+// model so the model is only built once. Each program gets a single result line:
+// "Result: <name> <status> <exit code> <cycles> <us>". Nothing is traced and the
+// tty output is dropped
+static int run_batch(const std::string &manifest_path) {
+    std::ifstream manifest(manifest_path);
+    if (!manifest.is_open()) {
+        printf("Could not open manifest %s!\n", manifest_path.c_str());
+        return 1;
+    }
+
+    Testbench<Vgecko_nano> *tb = new Testbench<Vgecko_nano>();
+    tb->dut->tty_out_ready = 1;
+
+    std::string name;
+    std::string binary;
+    while (manifest >> name >> binary) {
+        const auto start_time = std::chrono::system_clock::now();
+        unsigned long start_cycles = tb->cycles;
+        const char *status = "crash";
+        int exit_code = 0;
+
+        // Reset clears the core along with its register file and load_program
+        // rewrites all of memory, only the cycle counter carries over so the
+        // cycles of each program are counted from where the last one stopped
+        Verilated::gotFinish(false);
+        tb->reset();
+        tb->dut->tty_in_valid = 1;
+        if (load_program(tb->dut, read_program(binary))) {
+            status = "timeout";
+            for (int i = 0; i < MAX_CYCLES; i++) {
+                tb->tick();
+                if (Verilated::gotFinish()) {
+                    status = "crash";
+                    break;
+                } else if (tb->dut->exit_flag) {
+                    if (tb->dut->error_flag) {
+                        status = "error";
+                    } else {
+                        for (int j = 0; j < EXIT_CYCLES; j++) {
+                            tb->tick();
+                        }
+                        exit_code = tb->dut->exit_code;
+                        status = exit_code == 0 ? "pass" : "fail";
+                    }
+                    break;
+                }
+            }
+        }
+
+        auto elapsed = std::chrono::system_clock::now() - start_time;
+        uint64_t duration = std::chrono::duration_cast<std::chrono::microseconds>(elapsed).count();
+        printf("Result: %s %s %d %lu %lu\n", name.c_str(), status, exit_code,
+               tb->cycles - start_cycles, (unsigned long) duration);
+        fflush(stdout);
+    }
+
+    tb->dut->final();
+    delete tb;
+    return 0;
+}
+
 int main(int argc, char **argv) {
     // Initialize Verilators variables
     Verilated::commandArgs(argc, argv);
@@ -86,7 +415,24 @@ int main(int argc, char **argv) {
     std::filesystem::create_directories("bin/debug/");
 
     std::string program_path = std::string("");
+    std::string vcd_path = std::string("bin/gecko_nano.vcd");
+    std::string trace_path = std::string("");
+    std::string manifest_path = std::string("");
+    // Checkpoints are saved at a cycle or at the first jump to an address
+    std::string save_path = std::string("");
+    unsigned long save_cycle = 0;
+    bool save_pc_trigger = false;
+    uint32_t save_pc = 0;
+    std::string restore_path = std::string("");
     bool debug = false;
+    // Waveform capture, by default every cycle is dumped
+    bool wave = true;
+    unsigned long wave_start = 0;
+    unsigned long wave_stop = ULONG_MAX;
+    bool wave_pc_trigger = false;
+    uint32_t wave_pc = 0;
+    bool wave_exit_trigger = false;
+    unsigned long wave_ring = 0;
     for (int i = 1; i < argc; i++) {
         std::string s = std::string(argv[i]);
         if (s == "--debug" || s == "-d") {
@@ -98,16 +444,100 @@ int main(int argc, char **argv) {
                 i++;
             }
         }
+        if (s == "--manifest") {
+            if (i + 1 < argc) {
+                manifest_path = std::string(argv[i + 1]);
+                i++;
+            }
+        }
+        if (s == "--save") {
+            if (i + 1 < argc) {
+                save_path = std::string(argv[i + 1]);
+                i++;
+            }
+        }
+        if (s == "--save-cycle") {
+            if (i + 1 < argc) {
+                save_cycle = strtoul(argv[i + 1], NULL, 0);
+                i++;
+            }
+        }
+        if (s == "--save-pc") {
+            if (i + 1 < argc) {
+                save_pc_trigger = true;
+                save_pc = strtoul(argv[i + 1], NULL, 0);
+                i++;
+            }
+        }
+        if (s == "--restore") {
+            if (i + 1 < argc) {
+                restore_path = std::string(argv[i + 1]);
+                i++;
+            }
+        }
+        if (s == "--trace") {
+            if (i + 1 < argc) {
+                trace_path = std::string(argv[i + 1]);
+                i++;
+            }
+        }
+        if (s == "--vcd") {
+            if (i + 1 < argc) {
+                vcd_path = std::string(argv[i + 1]);
+                i++;
+            }
+        }
+        if (s == "--no-wave") {
+            wave = false;
+        }
+        if (s == "--wave-start") {
+            if (i + 1 < argc) {
+                wave_start = strtoul(argv[i + 1], NULL, 0);
+                i++;
+            }
+        }
+        if (s == "--wave-stop") {
+            if (i + 1 < argc) {
+                wave_stop = strtoul(argv[i + 1], NULL, 0);
+                i++;
+            }
+        }
+        if (s == "--wave-pc") {
+            if (i + 1 < argc) {
+                wave_pc_trigger = true;
+                wave_pc = strtoul(argv[i + 1], NULL, 0);
+                i++;
+            }
+        }
+        if (s == "--wave-exit") {
+            wave_exit_trigger = true;
+        }
+        if (s == "--wave-ring") {
+            if (i + 1 < argc) {
+                wave_ring = strtoul(argv[i + 1], NULL, 0);
+                i++;
+            }
+        }
     }
 
-    if (program_path == "") {
+    if (manifest_path != "") {
+        return run_batch(manifest_path);
+    }
+
+#if !VM_SAVABLE
+    if (save_path != "" || restore_path != "") {
+        printf("Simulator was built without --savable!\n");
+        return 1;
+    }
+#endif
+
+    // A restored checkpoint already holds the program
+    if (program_path == "" && restore_path == "") {
         printf("No program given!\n");
         return 1;
     }
 
-    std::ifstream program_input(program_path, std::ios::binary);
-    std::vector<unsigned char> program_buffer(
-            std::istreambuf_iterator<char>(program_input), {});
+    std::vector<unsigned char> program_buffer = read_program(program_path);
 
     std::ofstream trace_pc;
     std::ofstream trace_reg;
@@ -119,36 +549,67 @@ int main(int argc, char **argv) {
         trace_reg << "reg, addr" << std::endl;
     }
 
+#if VM_TRACE_FST
+    if (vcd_path.size() > 4 && vcd_path.substr(vcd_path.size() - 4) == ".vcd") {
+        vcd_path = vcd_path.substr(0, vcd_path.size() - 4) + ".fst";
+    }
+#endif
+
+    TraceWriter *trace_writer = NULL;
+    if (trace_path != "") {
+        trace_writer = new TraceWriter(trace_path.c_str());
+    }
+
     const auto start_time = std::chrono::system_clock::now();
     Testbench<Vgecko_nano> *tb = new Testbench<Vgecko_nano>();
-    tb->openTrace("bin/gecko_nano.vcd");
-    tb->reset();
+    if (wave) {
+        tb->openTrace(vcd_path.c_str(), wave_ring);
+    }
+    // Without a ring buffer a trigger starts the capture, with one the capture
+    // runs from the start and a trigger saves the cycles leading up to it
+    bool wave_armed = wave_ring > 0 || !(wave_pc_trigger || wave_exit_trigger);
+    if (restore_path != "") {
+        if (!tb->restoreCheckpoint(restore_path.c_str())) {
+            printf("Could not restore checkpoint %s!\n", restore_path.c_str());
+            return 1;
+        }
+    }
+    if (wave_armed && tb->cycles >= wave_start) {
+        tb->startTrace();
+    }
+    if (restore_path == "") {
+        tb->reset();
+    }
 
     tb->dut->tty_in_valid = 1;
     tb->dut->tty_out_ready = 1;
 
-    int memory_address_width = tb->dut->gecko_nano_wrapper->inst->mem->gen_xilinx__DOT__xilinx_block_ram_double_inst->ADDR_WIDTH;
-    int memory_data_width = tb->dut->gecko_nano_wrapper->inst->mem->gen_xilinx__DOT__xilinx_block_ram_double_inst->DATA_WIDTH;
-
-    int memory_bytes = (1 << memory_address_width) * (memory_data_width / 8);
-
-    if (program_buffer.size() > memory_bytes) {
+    if (restore_path == "" && !load_program(tb->dut, program_buffer)) {
         printf("Program will not fit in memory!\n");
         return 1;
     }
 
-    // Load program into memory
-    for (int i = 0; i < (program_buffer.size() / 4); i += 1) {
-        uint32_t word = program_buffer[(i * 4) + 0] |
-                       (program_buffer[(i * 4) + 1] << 8) |
-                       (program_buffer[(i * 4) + 2] << 16) |
-                       (program_buffer[(i * 4) + 3] << 24);
-        tb->dut->gecko_nano_wrapper->inst->mem->gen_xilinx__DOT__xilinx_block_ram_double_inst->data[i] = word;
-    }
+    bool saved = false;
 
     // Tick the clock until we are done
-    for (int i = 0; i < 100000; i++) {
+    for (int i = 0; i < MAX_CYCLES; i++) {
         tb->tick();
+        if (wave) {
+            auto decode = tb->dut->gecko_nano_wrapper->inst->core->gecko_decode_inst;
+            bool triggered = (wave_pc_trigger && decode->debug_jump_valid && decode->debug_jump_address == wave_pc) ||
+                             (wave_exit_trigger && tb->dut->exit_flag);
+            if (triggered && wave_ring > 0) {
+                tb->saveTrace();
+                wave = false;
+            } else if (triggered) {
+                wave_armed = true;
+            }
+            if (wave && wave_armed && tb->cycles >= wave_start && tb->cycles < wave_stop) {
+                tb->startTrace();
+            } else {
+                tb->stopTrace();
+            }
+        }
         if (tb->dut->tty_out_valid) {
             char c = (char) tb->dut->tty_out_data;
             printf("%c", c);
@@ -169,14 +630,39 @@ int main(int argc, char **argv) {
                              "0x" << std::setfill('0') << std::hex << std::setw(8) << register_data << std::endl;
             }
         }
+        if (trace_writer != NULL) {
+            auto decode = tb->dut->gecko_nano_wrapper->inst->core->gecko_decode_inst;
+            if (decode->debug_jump_resolved) {
+                uint8_t flags = (decode->debug_jump_taken ? TRACE_FLAG_TAKEN : 0) |
+                                (decode->debug_jump_mispredicted ? TRACE_FLAG_MISPREDICTED : 0) |
+                                (decode->debug_jump_unconditional ? TRACE_FLAG_UNCONDITIONAL : 0);
+                trace_writer->write(tb->cycles, TRACE_KIND_JUMP, decode->debug_jump_pc, 0,
+                                    decode->debug_jump_address, flags);
+            }
+            if (decode->debug_register_write) {
+                trace_writer->write(tb->cycles, TRACE_KIND_REGISTER, 0, decode->debug_register_addr,
+                                    decode->debug_register_data, 0);
+            }
+        }
+        if (save_path != "") {
+            auto decode = tb->dut->gecko_nano_wrapper->inst->core->gecko_decode_inst;
+            if (save_pc_trigger ? (decode->debug_jump_valid && decode->debug_jump_address == save_pc)
+                                : tb->cycles >= save_cycle) {
+                tb->saveCheckpoint(save_path.c_str());
+                printf("\nCheckpoint saved at cycle %lu!\n", tb->cycles);
+                saved = true;
+                break;
+            }
+        }
         if (Verilated::gotFinish()) {
             printf("\nSimulator finished!\n");
             break;
         } else if (tb->dut->exit_flag) {
             if (tb->dut->error_flag) {
+                tb->saveTrace();
                 printf("\nGecko error!\n");
             } else {
-                for (int i = 0; i < 10; i++) {
+                for (int i = 0; i < EXIT_CYCLES; i++) {
                     tb->tick();
                 }
                 printf("\nGecko finished: %d!\n", tb->dut->exit_code);
@@ -190,7 +676,12 @@ int main(int argc, char **argv) {
         trace_reg.close();
     }
 
-    if (!Verilated::gotFinish() && !tb->dut->exit_flag) {
+    if (trace_writer != NULL) {
+        delete trace_writer;
+    }
+
+    if (!saved && !Verilated::gotFinish() && !tb->dut->exit_flag) {
+        tb->saveTrace();
         printf("\nSimulator timed out!\n");
     }
 
@@ -201,5 +692,9 @@ int main(int argc, char **argv) {
     uint64_t duration = std::chrono::duration_cast<std::chrono::microseconds>(elapsed).count();
     printf("%lu cycles in %lld us\n", tb->cycles, duration);
 
+    // Finishing the model writes out any profiles it recorded
+    tb->dut->final();
+    delete tb;
+
     exit(EXIT_SUCCESS);
 }
\ No newline at end of file
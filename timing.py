@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"Helper classes for timing each stage of the build and reporting the hotspots"
+
+from __future__ import annotations
+
+import json
+import time
+import subprocess
+
+from util import info
+
+# Stage each ninja rule is reported under
+RULE_STAGES = {
+    "riscv_assemble": "firmware_compile",
+    "riscv_assemble_cpp": "firmware_compile",
+    "riscv_compile": "firmware_compile",
+    "riscv_link": "firmware_link",
+    "riscv_objdump": "firmware_disassemble",
+    "riscv_stats": "hex_conversion",
+    "verilator_lint": "lint",
+    "verilator_parameters": "verilate",
+    "verilator_verilate": "verilate",
+    "verilator_model": "model_sync",
+    "verilator_compile": "cpp_compile",
+    "verilator_link": "cpp_link",
+    "verilator_shared": "cpp_link",
+    "build_reload": "reload",
+}
+
+
+def read_ninja_log(path=".ninja_log"):
+    "Returns the entries of the ninja log, or nothing if ninja has not run yet"
+    try:
+        with open(path, "r") as file:
+            return [line.rstrip("\n") for line in file if not line.startswith("#")]
+    except OSError:
+        return []
+
+
+def get_step_durations(log):
+    "Returns how long the last step that built each output took, in seconds"
+    durations = {}
+    for entry in log:
+        fields = entry.split("\t")
+        if len(fields) < 5:
+            continue
+        start, end, _, output = fields[:4]
+        durations[output] = (int(end) - int(start)) / 1000
+    return durations
+
+
+def get_ninja_rules(build_file="build.ninja"):
+    "Returns the rule that builds each output of the build graph"
+    process = subprocess.run(
+        ["ninja", "-f", build_file, "-t", "targets", "all"],
+        capture_output=True,
+        check=True,
+    )
+    rules = {}
+    for line in process.stdout.decode("utf-8").splitlines():
+        output, _, rule = line.rpartition(": ")
+        rules[output] = rule
+    return rules
+
+
+def get_ninja_steps(old_log, new_log, rules):
+    """Returns the steps ninja ran between the two logs, outputs of the same edge
+    share their times and command hash so they are merged into one step"""
+    old_entries = set(old_log)
+    steps = {}
+    for entry in new_log:
+        if entry in old_entries:
+            continue
+        fields = entry.split("\t")
+        if len(fields) < 5:
+            continue
+        start, end, _, output, command_hash = fields[:5]
+        key = (start, end, command_hash)
+        if key in steps:
+            continue
+        rule = rules.get(output, "unknown")
+        steps[key] = {
+            "output": output,
+            "rule": rule,
+            "stage": RULE_STAGES.get(rule, "other"),
+            "start": int(start) / 1000,
+            "end": int(end) / 1000,
+            "duration": (int(end) - int(start)) / 1000,
+        }
+    return list(steps.values())
+
+
+def _get_span(steps):
+    "Returns the wall-clock time covered by the steps, counting overlaps once"
+    span = 0.0
+    span_start, span_end = None, None
+    for step in sorted(steps, key=lambda step: step["start"]):
+        if span_end is None or step["start"] > span_end:
+            if span_end is not None:
+                span += span_end - span_start
+            span_start, span_end = step["start"], step["end"]
+        else:
+            span_end = max(span_end, step["end"])
+    if span_end is not None:
+        span += span_end - span_start
+    return span
+
+
+class BuildTimer:
+    """Records the wall-clock time of each phase of the build script and the steps
+    of every ninja run it makes"""
+
+    def __init__(self) -> None:
+        self.start = time.time()
+        self.last = self.start
+        self.phases = {}
+        self.runs = []
+
+    def lap(self, name):
+        """Records the time since the last lap as the named phase, phases recorded
+        more than once are summed"""
+        now = time.time()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def add_ninja_run(self, steps):
+        "Records the steps of one ninja run"
+        self.runs.append(steps)
+
+    def get_report(self, slowest=20):
+        "Returns the timing report as a JSON-compatible dictionary"
+        stages = {}
+        for steps in self.runs:
+            by_stage = {}
+            for step in steps:
+                by_stage.setdefault(step["stage"], []).append(step)
+            # Each ninja run has its own clock so spans are measured per run
+            for stage, stage_steps in by_stage.items():
+                total = stages.setdefault(
+                    stage, {"steps": 0, "cpu_time": 0.0, "wall_time": 0.0}
+                )
+                total["steps"] += len(stage_steps)
+                total["cpu_time"] += sum(step["duration"] for step in stage_steps)
+                total["wall_time"] += _get_span(stage_steps)
+        steps = sorted(
+            (step for run in self.runs for step in run),
+            key=lambda step: step["duration"],
+            reverse=True,
+        )
+        return {
+            "time": time.time(),
+            "total": time.time() - self.start,
+            "phases": self.phases,
+            "stages": stages,
+            "slowest": [
+                {
+                    "output": step["output"],
+                    "rule": step["rule"],
+                    "duration": step["duration"],
+                }
+                for step in steps[:slowest]
+            ],
+        }
+
+
+def write_report(report, path):
+    "Writes the timing report as JSON"
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+def load_report(path):
+    "Reads a previously written timing report"
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def _format_delta(new, old):
+    if old is None:
+        return f"{new:8.2f}s"
+    delta = new - old
+    percent = f" ({delta / old:+.0%})" if old > 0 else ""
+    return f"{new:8.2f}s {delta:+.2f}s{percent}"
+
+
+def print_report(report, previous=None, slowest=5):
+    """Prints the phase and stage times of the report, and the change from the
+    previous report if one is given"""
+    old_phases = {} if previous is None else previous.get("phases", {})
+    old_stages = {} if previous is None else previous.get("stages", {})
+
+    old_total = None if previous is None else previous.get("total")
+    info(f"Build took {_format_delta(report['total'], old_total).strip()}")
+    for name, duration in report["phases"].items():
+        info(f"  {name:<20} {_format_delta(duration, old_phases.get(name))}")
+    for name, stage in sorted(
+        report["stages"].items(), key=lambda item: item[1]["wall_time"], reverse=True
+    ):
+        old_stage = old_stages.get(name, {})
+        info(
+            f"  {name:<20} {_format_delta(stage['wall_time'], old_stage.get('wall_time'))}"
+            f" wall, {stage['cpu_time']:.2f}s over {stage['steps']} steps"
+        )
+    for step in report["slowest"][:slowest]:
+        info(f"  {step['duration']:8.2f}s {step['output']} ({step['rule']})")
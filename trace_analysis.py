@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"Profiles programs from the binary execution traces the testbench writes with --trace"
+
+from __future__ import annotations
+
+import re
+import json
+import argparse
+from collections import deque
+
+import numpy as np
+
+from util import info, error
+
+TRACE_MAGIC = b"GTRC"
+TRACE_VERSION = 1
+
+KIND_JUMP = 1
+KIND_REGISTER = 2
+
+FLAG_TAKEN = 1
+FLAG_MISPREDICTED = 2
+FLAG_UNCONDITIONAL = 4
+# Register writes whose value depends on the timing of the core (counter CSRs)
+FLAG_UNPREDICTABLE = 8
+
+# Mirrors the packed TraceRecord written by the testbench
+TRACE_DTYPE = np.dtype(
+    [
+        ("cycle", "<u8"),
+        ("pc", "<u4"),
+        ("value", "<u4"),
+        ("kind", "u1"),
+        ("rd", "u1"),
+        ("flags", "u1"),
+        ("reserved", "u1"),
+    ]
+)
+_HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S4"),
+        ("version", "<u4"),
+        ("record_size", "<u4"),
+        ("reserved", "<u4"),
+    ]
+)
+
+# Register writes a core may reorder between different registers before a write
+# that never comes is reported as missing
+_COMPARE_WINDOW = 64
+
+_SYMBOL_PATTERN = re.compile(r"^([0-9a-f]+) <([^>]+)>:$")
+
+
+def load_trace(path):
+    "Memory-maps the trace as a structured array without reading it in"
+    header = np.fromfile(path, dtype=_HEADER_DTYPE, count=1)
+    if len(header) == 0 or header["magic"][0] != TRACE_MAGIC:
+        raise RuntimeError(f"{path} is not an execution trace!")
+    if header["version"][0] != TRACE_VERSION:
+        raise RuntimeError(f"{path} is trace version {header['version'][0]}!")
+    if header["record_size"][0] != TRACE_DTYPE.itemsize:
+        raise RuntimeError(f"{path} has {header['record_size'][0]} byte records!")
+    try:
+        return np.memmap(
+            path, dtype=TRACE_DTYPE, mode="r", offset=_HEADER_DTYPE.itemsize
+        )
+    except ValueError:
+        # Empty traces cannot be mapped
+        return np.empty(0, dtype=TRACE_DTYPE)
+
+
+def write_trace_header(file):
+    "Writes the header every trace starts with"
+    header = np.zeros(1, dtype=_HEADER_DTYPE)
+    header["magic"] = TRACE_MAGIC
+    header["version"] = TRACE_VERSION
+    header["record_size"] = TRACE_DTYPE.itemsize
+    header.tofile(file)
+
+
+def _iter_register_writes(trace, chunk_size=1 << 16):
+    "Yields the register writes of the trace a chunk at a time"
+    for start in range(0, len(trace), chunk_size):
+        chunk = trace[start : start + chunk_size]
+        chunk = chunk[chunk["kind"] == KIND_REGISTER]
+        yield from zip(
+            chunk["cycle"].tolist(),
+            chunk["pc"].tolist(),
+            chunk["rd"].tolist(),
+            chunk["value"].tolist(),
+            chunk["flags"].tolist(),
+        )
+
+
+def compare_register_writes(expected_path, actual_path, window=_COMPARE_WINDOW):
+    """Streams the register writes of both traces and reports the first write that
+    differs, returning None if they match. Writes to different registers can retire
+    out of order in the core so every register is matched in its own order. The
+    expected trace comes from the ISS, whose records count retired instructions
+    (instret) where the testbench records the cycle"""
+    expected = _iter_register_writes(load_trace(expected_path))
+    actual = _iter_register_writes(load_trace(actual_path))
+    pending = [deque() for _ in range(32)]
+    buffered = 0
+    history = deque(maxlen=8)
+
+    def diverged(index, write, reason, actual_write=None):
+        instret, pc, rd, value, _ = write
+        error(f"Traces diverge at register write {index} ({reason}):")
+        for old_instret, old_pc, old_rd, old_value, _ in history:
+            info(
+                f"  instret {old_instret:>10} 0x{old_pc:08x}: "
+                f"x{old_rd} = 0x{old_value:08x}"
+            )
+        info(f"  instret {instret:>10} 0x{pc:08x}: x{rd} = 0x{value:08x} expected")
+        if actual_write is not None:
+            info(
+                f"  cycle   {actual_write[0]:>10} 0x{actual_write[1]:08x}: "
+                f"x{actual_write[2]} = 0x{actual_write[3]:08x} in the simulator"
+            )
+        return {
+            "index": index,
+            "reason": reason,
+            "instret": instret,
+            "cycle": None if actual_write is None else actual_write[0],
+            "pc": pc,
+            "rd": rd,
+            "expected": value,
+            "actual": None if actual_write is None else actual_write[3],
+        }
+
+    index = 0
+    for index, write in enumerate(expected):
+        rd = write[2]
+        queue = pending[rd]
+        while len(queue) == 0:
+            if buffered >= window:
+                return diverged(index, write, "write missing")
+            actual_write = next(actual, None)
+            if actual_write is None:
+                return diverged(index, write, "simulator trace ended")
+            pending[actual_write[2]].append(actual_write)
+            buffered += 1
+        actual_write = queue.popleft()
+        buffered -= 1
+        if actual_write[3] != write[3] and not write[4] & FLAG_UNPREDICTABLE:
+            return diverged(index, write, "wrong value", actual_write)
+        history.append(write)
+
+    extra = buffered + sum(1 for _ in actual)
+    if extra > 0:
+        error(f"Simulator trace has {extra} register writes past the expected end")
+        return {"index": index + 1, "reason": "extra writes", "extra": extra}
+    return None
+
+
+def load_symbols(path):
+    "Returns the sorted start addresses and names of the functions in a disassembly"
+    addresses = []
+    names = []
+    with open(path, "r") as file:
+        for line in file:
+            symbol = _SYMBOL_PATTERN.match(line.strip())
+            if symbol is not None:
+                addresses.append(int(symbol.group(1), 16))
+                names.append(symbol.group(2))
+    order = np.argsort(addresses, kind="stable")
+    return np.array(addresses, dtype=np.uint64)[order], [names[i] for i in order]
+
+
+def get_branch_stats(trace, top=10):
+    "Returns the taken and mispredict rates of the control flow instructions"
+    jumps = trace[trace["kind"] == KIND_JUMP]
+    flags = jumps["flags"]
+    taken = (flags & FLAG_TAKEN) != 0
+    mispredicted = (flags & FLAG_MISPREDICTED) != 0
+    conditional = (flags & FLAG_UNCONDITIONAL) == 0
+
+    pcs, inverse, counts = np.unique(
+        jumps["pc"], return_inverse=True, return_counts=True
+    )
+    mispredicts = np.bincount(inverse, weights=mispredicted, minlength=len(pcs))
+    worst = np.argsort(mispredicts, kind="stable")[::-1][:top]
+
+    def rate(part, whole):
+        return float(part) / whole if whole > 0 else 0.0
+
+    return {
+        "resolved": int(len(jumps)),
+        "taken_rate": rate(taken.sum(), len(jumps)),
+        "mispredict_rate": rate(mispredicted.sum(), len(jumps)),
+        "branches": int(conditional.sum()),
+        "branch_taken_rate": rate((taken & conditional).sum(), conditional.sum()),
+        "branch_mispredict_rate": rate(
+            (mispredicted & conditional).sum(), conditional.sum()
+        ),
+        "worst_branches": [
+            {
+                "pc": int(pcs[i]),
+                "executed": int(counts[i]),
+                "mispredicted": int(mispredicts[i]),
+            }
+            for i in worst
+            if mispredicts[i] > 0
+        ],
+    }
+
+
+def get_basic_blocks(trace, start_pc=0):
+    """Returns every basic block executed with how often it ran and the cycles spent
+    in it. Every taken jump ends the block that started at the previous target, the
+    code after the final taken jump is not part of any block"""
+    jumps = trace[(trace["kind"] == KIND_JUMP) & ((trace["flags"] & FLAG_TAKEN) != 0)]
+    if len(jumps) == 0:
+        return {
+            "start": np.empty(0, dtype=np.uint64),
+            "end": np.empty(0, dtype=np.uint64),
+            "count": np.empty(0, dtype=np.int64),
+            "cycles": np.empty(0, dtype=np.float64),
+        }
+    starts = np.concatenate(([start_pc], jumps["value"][:-1])).astype(np.uint64)
+    ends = jumps["pc"].astype(np.uint64)
+    first_cycle = trace["cycle"][0]
+    cycles = np.diff(jumps["cycle"].astype(np.int64), prepend=np.int64(first_cycle))
+    valid = ends >= starts
+    keys = (starts[valid] << np.uint64(32)) | ends[valid]
+    blocks, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    return {
+        "start": blocks >> np.uint64(32),
+        "end": blocks & np.uint64(0xFFFFFFFF),
+        "count": counts,
+        "cycles": np.bincount(inverse, weights=cycles[valid], minlength=len(blocks)),
+    }
+
+
+def get_hot_pcs(blocks, top=20):
+    "Returns the most executed instructions by expanding the basic blocks"
+    if len(blocks["start"]) == 0:
+        return []
+    lengths = ((blocks["end"] - blocks["start"]) // np.uint64(4) + np.uint64(1)).astype(
+        np.int64
+    )
+    # Offsets of every instruction within its block
+    offsets = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    pcs = np.repeat(blocks["start"], lengths) + (offsets * 4).astype(np.uint64)
+    counts = np.repeat(blocks["count"], lengths)
+    unique_pcs, inverse = np.unique(pcs, return_inverse=True)
+    executed = np.bincount(inverse, weights=counts)
+    hottest = np.argsort(executed, kind="stable")[::-1][:top]
+    return [{"pc": int(unique_pcs[i]), "executed": int(executed[i])} for i in hottest]
+
+
+def get_function_cycles(blocks, symbols):
+    "Attributes the cycles and instructions of every basic block to its function"
+    addresses, names = symbols
+    if len(blocks["start"]) == 0 or len(addresses) == 0:
+        return []
+    functions = np.searchsorted(addresses, blocks["start"], side="right") - 1
+    known = functions >= 0
+    lengths = (blocks["end"] - blocks["start"]) // np.uint64(4) + np.uint64(1)
+    cycles = np.bincount(
+        functions[known], weights=blocks["cycles"][known], minlength=len(names)
+    )
+    instructions = np.bincount(
+        functions[known],
+        weights=(lengths * blocks["count"].astype(np.uint64))[known],
+        minlength=len(names),
+    )
+    total = cycles.sum()
+    order = np.argsort(cycles, kind="stable")[::-1]
+    return [
+        {
+            "function": names[i],
+            "cycles": int(cycles[i]),
+            "instructions": int(instructions[i]),
+            "share": float(cycles[i] / total) if total > 0 else 0.0,
+        }
+        for i in order
+        if cycles[i] > 0
+    ]
+
+
+def analyze_trace(trace_path, disassembly_path=None, top=20):
+    "Returns the full profile of the trace as a JSON-compatible dictionary"
+    trace = load_trace(trace_path)
+    blocks = get_basic_blocks(trace)
+    profile = {
+        "records": int(len(trace)),
+        "cycles": int(trace["cycle"][-1] - trace["cycle"][0]) if len(trace) > 0 else 0,
+        "branches": get_branch_stats(trace, top=top),
+        "basic_blocks": int(len(blocks["start"])),
+        "hot_blocks": [
+            {
+                "start": int(blocks["start"][i]),
+                "end": int(blocks["end"][i]),
+                "count": int(blocks["count"][i]),
+                "cycles": int(blocks["cycles"][i]),
+            }
+            for i in np.argsort(blocks["cycles"], kind="stable")[::-1][:top]
+        ],
+        "hot_pcs": get_hot_pcs(blocks, top=top),
+    }
+    if disassembly_path is not None:
+        profile["functions"] = get_function_cycles(
+            blocks, load_symbols(disassembly_path)
+        )[:top]
+    return profile
+
+
+def print_profile(profile, top=10):
+    "Prints the most important parts of the profile"
+    branches = profile["branches"]
+    info(f"{profile['records']} records over {profile['cycles']} cycles")
+    info(
+        f"{branches['resolved']} jumps and branches, "
+        f"{branches['taken_rate']:.1%} taken, "
+        f"{branches['mispredict_rate']:.1%} mispredicted"
+    )
+    info(
+        f"{branches['branches']} conditional branches, "
+        f"{branches['branch_taken_rate']:.1%} taken, "
+        f"{branches['branch_mispredict_rate']:.1%} mispredicted"
+    )
+    for branch in branches["worst_branches"][:top]:
+        info(
+            f"  0x{branch['pc']:08x}: {branch['mispredicted']} of "
+            f"{branch['executed']} mispredicted"
+        )
+    info(f"{profile['basic_blocks']} basic blocks, hottest instructions:")
+    for pc in profile["hot_pcs"][:top]:
+        info(f"  0x{pc['pc']:08x}: {pc['executed']}")
+    if "functions" in profile:
+        info("Cycles by function:")
+        for function in profile["functions"][:top]:
+            info(
+                f"  {function['function']:<32} {function['cycles']:>10} "
+                f"({function['share']:.1%}), {function['instructions']} instructions"
+            )
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("trace", help="binary trace written by the testbench")
+    parser.add_argument(
+        "-d",
+        "--disassembly",
+        default=None,
+        help="disassembly of the program (bin/<name>.s) for per-function cycles",
+    )
+    parser.add_argument("--top", type=int, default=10, help="entries to show")
+    parser.add_argument(
+        "-o", "--output", default=None, help="write the profile as JSON"
+    )
+    args = parser.parse_args()
+
+    profile = analyze_trace(args.trace, args.disassembly, top=max(args.top, 20))
+    print_profile(profile, top=args.top)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(profile, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,26 +26,60 @@ def error(msg, flush=True, end="\n"):
     print(Fore.RED + "ERROR:   " + Style.RESET_ALL + msg, flush=flush, end=end)
 
 
-def convert_hex(src_file, dest_file):
+def _get_word_bytes(word_width):
+    if word_width <= 0 or word_width % 8 != 0:
+        raise ValueError(f"Word width {word_width} is not a whole number of bytes!")
+    return word_width // 8
+
+
+def convert_hex(src_bytes, dest_file, word_width=32):
     "Convert binary values to hex values readmemh can understand"
+    word_bytes = _get_word_bytes(word_width)
+    src_bytes = memoryview(src_bytes).cast("B")
+    len_bytes = len(src_bytes)
+    if len_bytes == 0:
+        return 0
+    # Zero pad the last word, readmemh reads it as the same value as a short word
+    tail = len_bytes % word_bytes
+    if tail != 0:
+        src_bytes = bytes(src_bytes) + bytes(word_bytes - tail)
+    # Reversing the whole buffer makes every word big-endian but in reverse order,
+    # so hex encode it one word per line and flip the line order back
+    words = src_bytes[::-1].hex("\n", word_bytes).split("\n")
+    words.reverse()
+    dest_file.write("\n".join(words))
+    dest_file.write("\n")
+    return len_bytes
+
+
+def convert_hex_stream(src_file, dest_file, word_width=32, chunk_size=1 << 20):
+    "Convert a binary stream to hex values readmemh can understand in chunks"
+    # Keep chunks word aligned so only the final chunk can need padding
+    word_bytes = _get_word_bytes(word_width)
+    chunk_size = max(word_bytes, chunk_size - (chunk_size % word_bytes))
     len_bytes = 0
-    word = ""
-    for src_byte in src_file:
-        word = "%02x" % (src_byte) + word
-        if len(word) >= 8:
-            dest_file.write(word + "\n")
-            word = ""
-        len_bytes += 1
-    if len(word) > 0:
-        dest_file.write(word + "\n")
+    leftover = b""
+    while True:
+        chunk = src_file.read(chunk_size)
+        if not chunk:
+            break
+        if leftover:
+            chunk = leftover + chunk
+        # Short reads (pipes) can split a word, carry it over to the next chunk
+        aligned = len(chunk) - (len(chunk) % word_bytes)
+        leftover = chunk[aligned:]
+        len_bytes += convert_hex(
+            memoryview(chunk)[:aligned], dest_file, word_width=word_width
+        )
+    len_bytes += convert_hex(leftover, dest_file, word_width=word_width)
     return len_bytes
 
 
-def convert_hex_file(src_filename, dest_filename):
+def convert_hex_file(src_filename, dest_filename, word_width=32):
     "Convert binary file to hex file readmemh can understand"
     with open(src_filename, mode="rb") as src_file:
         with open(dest_filename, mode="w") as dest_file:
-            return convert_hex(src_file.read(), dest_file)
+            return convert_hex_stream(src_file, dest_file, word_width=word_width)
 
 
 def calculate_address_width(size_bytes):
@@ -1,13 +1,213 @@
 #!/usr/bin/env python3
 "Helper class for compiling Verilator programs"
 
+import io
 import os
+import sys
+import math
+import json
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from functools import lru_cache
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from ninja.misc.ninja_syntax import Writer as NinjaWriter
 
 
-def _split_makefile_variable(line, global_file=False):
+class VerilatorProfile:
+    "Describes the flags a verilated model is built and compiled with"
+
+    def __init__(
+        self,
+        name,
+        verilate_flags,
+        fast_flags,
+        slow_flags,
+        link_flags,
+        trace=False,
+        trace_fst=False,
+        savable=False,
+    ) -> None:
+        self.name = name
+        self.verilate_flags = verilate_flags
+        self.fast_flags = fast_flags
+        self.slow_flags = slow_flags
+        self.link_flags = link_flags
+        self.trace = trace
+        self.trace_fst = trace_fst
+        self.savable = savable
+        # The debug profile keeps the original paths so existing scripts still work
+        self.suffix = "" if name == "debug" else f"_{name}"
+
+    def get_cpp_flags(self):
+        "Returns the flags every compile and link step of the model needs"
+        trace_fst = 1 if self.trace and self.trace_fst else 0
+        return (
+            f"-DVM_TRACE={1 if self.trace else 0} -DVM_TRACE_FST={trace_fst}"
+            f" -DVM_SAVABLE={1 if self.savable else 0} -pthread"
+        )
+
+    def get_libraries(self):
+        "Returns the libraries the model is linked against"
+        return "-lz" if self.trace and self.trace_fst else ""
+
+    def to_dict(self):
+        "Returns the profile in the form it is stored in"
+        return {
+            "name": self.name,
+            "verilate_flags": self.verilate_flags,
+            "fast_flags": self.fast_flags,
+            "slow_flags": self.slow_flags,
+            "link_flags": self.link_flags,
+            "trace": self.trace,
+            "trace_fst": self.trace_fst,
+            "savable": self.savable,
+        }
+
+    def save(self, path):
+        "Stores the profile, only touching the file if the profile changed"
+        text = json.dumps(self.to_dict(), indent=2)
+        if Path(path).is_file() and Path(path).read_text() == text:
+            return
+        Path(path).write_text(text)
+
+    @staticmethod
+    def load(path):
+        "Loads a stored profile"
+        with open(path, "r") as file:
+            return VerilatorProfile(**json.load(file))
+
+
+PROFILES = ["debug", "fast", "max"]
+
+# Largest array the traced models dump, verilator's own default. Memories are far
+# larger and dumping every word of them makes the waveforms megabytes per cycle
+DEFAULT_TRACE_MAX_ARRAY = 32
+
+# Size of each generated file, in verilator's statement count, until it is tuned
+DEFAULT_OUTPUT_SPLIT = 10000
+# Output split tuned for each model
+OUTPUT_SPLITS = "bin/verilator/output_splits.json"
+
+
+def get_profile(name, threads=1, trace_fst=False, savable=False, trace_max_array=None):
+    """Returns the named build profile, threads only applies to the untraced profiles
+    and trace_fst and trace_max_array to the traced ones. Savable models can
+    checkpoint their state but are always single threaded"""
+    savable_flags = ""
+    if savable:
+        savable_flags = " --savable"
+        threads = 1
+    if name == "debug":
+        trace = "--trace-fst" if trace_fst else "--trace"
+        if trace_max_array is None:
+            trace_max_array = DEFAULT_TRACE_MAX_ARRAY
+        return VerilatorProfile(
+            name,
+            f"{trace} --trace-structs --trace-max-array {trace_max_array}"
+            f"{savable_flags}",
+            fast_flags="-O2",
+            slow_flags="",
+            link_flags="-O2",
+            trace=True,
+            trace_fst=trace_fst,
+            savable=savable,
+        )
+    fast = f"-O3 --x-assign fast --x-initial fast --threads {threads}{savable_flags}"
+    if name == "fast":
+        return VerilatorProfile(
+            name,
+            fast,
+            fast_flags="-O3",
+            slow_flags="-O1",
+            link_flags="-O3",
+            savable=savable,
+        )
+    if name == "max":
+        return VerilatorProfile(
+            name,
+            fast,
+            fast_flags="-O3 -march=native",
+            slow_flags="-O2 -march=native",
+            link_flags="-O3 -march=native",
+            savable=savable,
+        )
+    raise ValueError(f"Unknown build profile {name}, expected one of {PROFILES}!")
+
+
+def get_pgo_profile(base, profile_dir, generate):
+    """Returns the profile-guided variant of a profile, either instrumented to record
+    profiles into profile_dir or optimized using the profiles recorded there"""
+    # gcc names its profiles after the object paths, so both passes share one profile
+    # and one obj_dir and only the flags change between them
+    profile_dir = os.path.abspath(profile_dir)
+    if generate:
+        verilate_flags = f"{base.verilate_flags} --prof-pgo"
+        pgo_flags = f"-fprofile-generate={profile_dir} -fprofile-update=atomic"
+    else:
+        # Each model is built from the profile recorded for itself, variants run
+        # different programs so they are trained separately
+        verilate_flags = f"{base.verilate_flags} {profile_dir}/V$model.vlt"
+        pgo_flags = f"-fprofile-use={profile_dir} -fprofile-partial-training"
+        pgo_flags += " -Wno-missing-profile -Wno-coverage-mismatch"
+    return VerilatorProfile(
+        "pgo",
+        verilate_flags,
+        fast_flags=f"{base.fast_flags} {pgo_flags}",
+        slow_flags=f"{base.slow_flags} {pgo_flags}",
+        link_flags=f"{base.link_flags} {pgo_flags}",
+        trace=base.trace,
+        trace_fst=base.trace_fst,
+        savable=base.savable,
+    )
+
+
+def load_output_splits(path=OUTPUT_SPLITS):
+    "Reads the tuned output split of each model"
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_output_splits(splits, path=OUTPUT_SPLITS):
+    "Stores the tuned output split of each model"
+    with open(path, "w") as file:
+        json.dump(splits, file, indent=2)
+
+
+def _fit_compile_times(sizes, durations):
+    """Fits the compile time of a source as a fixed overhead (startup and header
+    parsing) plus a time per byte of generated code"""
+    mean_size = sum(sizes) / len(sizes)
+    mean_duration = sum(durations) / len(durations)
+    variance = sum((size - mean_size) ** 2 for size in sizes)
+    if variance == 0:
+        return 0.0, mean_duration / mean_size
+    rate = (
+        sum(
+            (size - mean_size) * (duration - mean_duration)
+            for size, duration in zip(sizes, durations)
+        )
+        / variance
+    )
+    rate = max(rate, 1e-12)
+    return max(mean_duration - rate * mean_size, 0.0), rate
+
+
+def predict_compile_time(n_files, total_size, overhead, rate, imbalance, jobs):
+    """Predicts the wall-clock time of compiling the code split into n_files on jobs
+    cores, the last wave waits on the largest file"""
+    size = total_size / n_files
+    waves = math.ceil(n_files / jobs)
+    return (waves - 1) * (overhead + rate * size) + overhead + imbalance * rate * size
+
+
+def _split_makefile_variable(line, obj_dir, global_file=False):
     variables = []
     line = line.split("+=")[1].strip()
     for variable in line.split(" "):
@@ -17,7 +217,7 @@ def _split_makefile_variable(line, global_file=False):
         if global_file:
             variable = os.path.expandvars(f"verilator/include/{variable}.cpp")
         else:
-            variable = f"obj_dir/{variable}.cpp"
+            variable = f"{obj_dir}/{variable}.cpp"
         variables.append(variable)
     return variables
 
@@ -30,7 +230,6 @@ def write_verilator_ninja_rules(writer):
     verilator = "VERILATOR_ROOT=verilator/ verilator/bin/verilator"
 
     flags = "--prefix V$name -Irtl/ +define+__SYNTH_ONLY__=1"
-    trace = "--trace --trace-structs --output-split 10000 --trace-max-array 1000000"
     # " --trace-max-width 1000000"
 
     # Create rule for linting SystemVerilog modules
@@ -42,13 +241,29 @@ def write_verilator_ninja_rules(writer):
     # Create rule for verilating SystemVerilog modules
     ninja_writer.rule(
         name="verilator_verilate",
-        command=f"{verilator} --cc {trace} {flags} $args $in > $out",
+        command=f"rm -rf $mdir && {verilator} --cc --Mdir $mdir $profile {flags} $args $in > $out",
+    )
+
+    # Create rule for turning program stats into top-level parameters
+    ninja_writer.rule(
+        name="verilator_parameters",
+        command=f"{sys.executable} verilator.py parameters $in -o $out",
+    )
+
+    # Create rule for merging a verilated model and writing its compile steps,
+    # the build steps are only rewritten when they change
+    ninja_writer.rule(
+        name="verilator_model",
+        command=f"{sys.executable} verilator.py model $top --profile $profile_file $variant",
+        restat=True,
     )
 
     ninja_writer.newline()
 
 
-def write_verilator_compile_ninja_rules(writer):
+def write_verilator_compile_ninja_rules(writer, launcher=""):
+    """Writes the rules for compiling verilated models, compiles are run through the
+    launcher (the compile cache) if one is given"""
     ninja_writer = NinjaWriter(writer)
     ninja_writer.comment("Rules for Verilator compilation")
 
@@ -64,40 +279,276 @@ def write_verilator_compile_ninja_rules(writer):
     flags += " -std=c++17"
     flags += " -Wc++11-extensions"
 
-    includes = "-Ibin/obj_dir/ -Iverilator/include -Iverilator/include/vltstd"
+    # The model folder and profile flags are set by each model's compile steps
+    includes = "-I$obj_dir/ -Iverilator/include -Iverilator/include/vltstd"
 
     # Create rule for compiling verilated source code
     ninja_writer.rule(
         name="verilator_compile",
-        command=f"g++ {includes} {flags} $args -c $in -o $out -MMD -MF $out.d",
+        command=f"{launcher} g++ {includes} {flags} $profile $args $pch -c $in -o $out -MMD -MF $out.d".strip(),
+        depfile="$out.d",
+    )
+
+    # Create rule for precompiling the headers every verilated source includes, it
+    # has to be built with the same flags as the sources that use it
+    ninja_writer.rule(
+        name="verilator_pch",
+        command=f"g++ {includes} {flags} $profile $args -x c++-header $in -o $out -MMD -MF $out.d",
         depfile="$out.d",
     )
 
     # Create rule for linking verilated source code
     ninja_writer.rule(
         name="verilator_link",
-        command=f"g++ {includes} {flags} $args $in -o $out",
+        command=f"g++ {includes} {flags} $profile $args $in $libs -o $out",
+    )
+
+    # Create rule for linking verilated source code into a co-simulation library
+    ninja_writer.rule(
+        name="verilator_shared",
+        command=f"g++ {includes} {flags} -shared -fPIC $profile $args $in $libs -o $out",
     )
 
     ninja_writer.newline()
 
 
+@lru_cache(maxsize=None)
+def supports_pch():
+    "Returns if the compiler can build and use precompiled headers"
+    with tempfile.TemporaryDirectory() as temp_dir:
+        header = os.path.join(temp_dir, "pch.h")
+        Path(header).write_text("int pch_probe(void);\n")
+        process = subprocess.run(
+            ["g++", "-x", "c++-header", header, "-o", f"{header}.gch"],
+            capture_output=True,
+            check=False,
+        )
+        return process.returncode == 0 and Path(f"{header}.gch").is_file()
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync_model(staging_dir, obj_dir, manifest_path, jobs=None):
+    """Moves changed verilator outputs from the staging folder into obj_dir with
+    atomic renames, unchanged files are left alone so their mtimes are kept"""
+    try:
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+
+    def compare(name):
+        staged_hash = _hash_file(os.path.join(staging_dir, name))
+        path = os.path.join(obj_dir, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return name, staged_hash, False
+        # Trust the recorded hash of the synced file while it looks untouched
+        entry = manifest.get(name)
+        if entry is not None and entry[1:] == [stat.st_size, stat.st_mtime_ns]:
+            synced_hash = entry[0]
+        else:
+            synced_hash = _hash_file(path)
+        return name, staged_hash, staged_hash == synced_hash
+
+    names = [
+        str(path.relative_to(staging_dir))
+        for path in Path(staging_dir).rglob("*")
+        if path.is_file()
+    ]
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        compared = list(executor.map(compare, names))
+
+    synced = {}
+    for name, staged_hash, unchanged in compared:
+        path = os.path.join(obj_dir, name)
+        if not unchanged:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(os.path.join(staging_dir, name), path)
+        stat = os.stat(path)
+        synced[name] = [staged_hash, stat.st_size, stat.st_mtime_ns]
+
+    # Remove outputs the model no longer generates
+    for name in manifest.keys() - synced.keys():
+        try:
+            os.remove(os.path.join(obj_dir, name))
+        except FileNotFoundError:
+            pass
+
+    with open(manifest_path, "w") as file:
+        json.dump(synced, file)
+    return sum(1 for _, _, unchanged in compared if not unchanged)
+
+
+def write_parameters(stats_paths, parameters_path):
+    """Writes the top-level parameters as a verilator arguments file, the memory is
+    made just large enough for the largest of the programs"""
+    address_width = 0
+    for stats_path in stats_paths:
+        with open(stats_path, "r") as file:
+            address_width = max(address_width, json.load(file)["address_width"])
+    with open(parameters_path, "w") as file:
+        file.write(f"-GMEMORY_ADDR_WIDTH={address_width}\n")
+
+
 class VerilatorProgram:
     "Compiles Verilator testbenches from SystemVerilog sources"
 
-    def __init__(self, source_file, lint_only=False) -> None:
+    def __init__(self, source_file, lint_only=False, profile=None, variant="") -> None:
         self.path = source_file.path
         self.module_name = self.path.split("/")[-1].split(".sv")[0]
         self.cpp_file = (
             "tb_cpp/" + self.path.split("rtl/")[-1].split(".sv")[0] + "_tb.cpp"
         )
+        self.cosim_file = (
+            "tb_cpp/" + self.path.split("rtl/")[-1].split(".sv")[0] + "_cosim.cpp"
+        )
         self.source_file = source_file
         self.lint_only = lint_only
+        self.profile = profile if profile is not None else get_profile("debug")
+        # Models of every profile can coexist since their outputs are kept apart,
+        # variants of the same profile differ only in their top-level parameters
+        self.variant = variant
+        self.variant_suffix = f"_{variant}" if variant else ""
+        self.model_name = self.module_name + self.profile.suffix + self.variant_suffix
+
+    def get_verilate_flags(self):
+        """Returns the verilate flags of the profile, profiles are shared by every
+        model so files of each model are named with $model"""
+        # Ninja expands the variables of a build statement before it sees the others
+        return self.profile.verilate_flags.replace("$model", self.model_name)
+
+    def get_simulator(self):
+        "Returns the path of the compiled simulator"
+        return f"bin/{self.model_name}_simulator"
+
+    def get_cosim_library(self):
+        "Returns the path of the co-simulation library, if the module has one"
+        if not Path(self.cosim_file).is_file():
+            return None
+        return f"bin/lib{self.model_name}_cosim.so"
+
+    def get_log(self):
+        "Returns the path of the lint/verilate log"
+        if self.lint_only:
+            return str(Path(f"bin/lint/{self.path}").with_suffix(".log"))
+        return f"bin/verilator/V{self.model_name}.log"
+
+    def get_parameters(self):
+        "Returns the path of the top-level parameters file"
+        return f"bin/verilator/{self.model_name}.args"
+
+    def get_staging_dir(self):
+        "Returns the folder verilator writes the model to before it is synced"
+        return f"bin/verilator/V{self.model_name}"
+
+    def get_obj_dir(self):
+        "Returns the folder the model is synced to and compiled in"
+        return f"bin/obj_dir{self.profile.suffix}{self.variant_suffix}"
+
+    def get_profile_file(self):
+        "Returns the path the profile of the model is stored at"
+        return f"bin/verilator/V{self.model_name}.profile.json"
+
+    def get_closure_hash(self):
+        "Returns a hash of every file the model is built from"
+        digest = hashlib.sha1()
+        for path in self.source_file.get_dependencies() + [self.cpp_file]:
+            digest.update(path.encode("utf-8"))
+            digest.update(_hash_file(path).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_model_hash(self):
+        """Returns a hash of every file and flag the model is built from, checkpoints
+        can only be restored into the model they were saved from"""
+        digest = hashlib.sha1(self.get_closure_hash().encode("utf-8"))
+        digest.update(json.dumps(self.profile.to_dict()).encode("utf-8"))
+        digest.update(self.model_name.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_pch_header(self, group, pic=False):
+        "Returns the path of the header precompiled for the fast or slow sources"
+        suffix = "_pic" if pic else ""
+        return f"{self.get_obj_dir()}/V{self.module_name}__pch_{group}{suffix}.h"
+
+    def write_pch_headers(self, pic=False):
+        """Writes the headers that are precompiled, one for each set of compile flags
+        since a precompiled header is only used with the flags it was built with"""
+        text = f'#include "verilated.h"\n#include "V{self.module_name}__Syms.h"\n'
+        for group in ("fast", "slow"):
+            path = Path(self.get_pch_header(group, pic=pic))
+            if not path.is_file() or path.read_text() != text:
+                path.write_text(text)
+
+    def get_output_split(self):
+        "Returns the size verilator splits the generated code of the model into"
+        return load_output_splits().get(self.model_name, DEFAULT_OUTPUT_SPLIT)
+
+    def tune_output_split(self, durations, jobs):
+        """Picks the output split that compiles the model fastest on jobs cores from
+        the compile times of the last build, given as seconds per output. Returns
+        the split with the predicted times, or None without enough measurements"""
+        obj_dir = self.get_obj_dir()
+        if not Path(f"{obj_dir}/V{self.module_name}_classes.mk").is_file():
+            return None
+        cpp_dependencies = self._parse_makefile()
+        sizes = []
+        times = []
+        # Only the model classes are split, the support files are always one each
+        for category in ("VM_CLASSES_FAST", "VM_CLASSES_SLOW"):
+            for source_path in cpp_dependencies.get(category, (False, []))[1]:
+                object_path = str(Path(source_path).with_suffix(".o"))
+                if object_path in durations and Path(source_path).is_file():
+                    sizes.append(Path(source_path).stat().st_size)
+                    times.append(durations[object_path])
+        if len(sizes) < 2:
+            return None
+
+        overhead, rate = _fit_compile_times(sizes, times)
+        total_size = sum(sizes)
+        imbalance = max(sizes) / (total_size / len(sizes))
+        current = self.get_output_split()
+        # The statement count is only known through the split that made the files
+        bytes_per_statement = total_size / (len(sizes) * current)
+
+        def predict(n_files):
+            return predict_compile_time(
+                n_files, total_size, overhead, rate, imbalance, jobs
+            )
+
+        best = min(range(1, 4 * jobs + 1), key=predict)
+        # Small gains are not worth verilating and compiling everything again
+        split = current
+        if predict(best) < 0.95 * predict(len(sizes)):
+            split = total_size / (best * bytes_per_statement)
+            # Rounded to two significant digits so the split does not drift
+            split = max(100, int(round(split, 2 - len(str(int(split))))))
+        return {
+            "output_split": split,
+            "files": best if split != current else len(sizes),
+            "predicted": predict(best if split != current else len(sizes)),
+            "current": predict(len(sizes)),
+        }
+
+    def get_sync_manifest(self):
+        "Returns the path of the hashes of the synced model files"
+        return f"bin/verilator/V{self.model_name}.sync.json"
+
+    def get_compile_ninja(self):
+        "Returns the path of the generated build steps for compiling the model"
+        return f"bin/verilator/V{self.model_name}.ninja"
 
     def _parse_makefile(self):
         lines = []
         last_partial = False
-        with open(f"obj_dir/V{self.module_name}_classes.mk", "r") as file:
+        with open(f"{self.get_obj_dir()}/V{self.module_name}_classes.mk", "r") as file:
             for line in file.readlines():
                 line = line.strip()
                 if len(line) > 0 and line[0] == "#":
@@ -119,17 +570,23 @@ class VerilatorProgram:
             global_categories = ["VM_GLOBAL_FAST", "VM_GLOBAL_SLOW"]
             for category in categories:
                 if line.startswith(category):
-                    files[category] = (False, _split_makefile_variable(line))
+                    files[category] = (
+                        False,
+                        _split_makefile_variable(line, self.get_obj_dir()),
+                    )
             for category in global_categories:
                 if line.startswith(category):
                     files[category] = (
                         True,
-                        _split_makefile_variable(line, global_file=True),
+                        _split_makefile_variable(
+                            line, self.get_obj_dir(), global_file=True
+                        ),
                     )
         return files
 
-    def write_ninja_build_verilate(self, writer, verilator_args=None):
-        "Writes the ninja rules for verilating this module"
+    def write_ninja_build_verilate(self, writer, verilator_args=None, stats=None):
+        """Writes the ninja rules for verilating this module, the top-level parameters
+        are taken from the stats of the programs the model is built for"""
         if self.source_file.no_lint:
             return
 
@@ -138,54 +595,184 @@ class VerilatorProgram:
 
         if verilator_args is None:
             verilator_args = []
+        if not self.lint_only:
+            split = str(self.get_output_split())
+            verilator_args = verilator_args + [
+                "--output-split",
+                split,
+                "--output-split-cfuncs",
+                split,
+            ]
+
+        implicit = []
+        if stats:
+            ninja_writer.build(
+                outputs=self.get_parameters(),
+                rule="verilator_parameters",
+                inputs=stats,
+                implicit=["verilator.py"],
+            )
+            verilator_args = verilator_args + ["-f", self.get_parameters()]
+            implicit.append(self.get_parameters())
 
-        log_path = Path(f"bin/lint/{self.path}").with_suffix(".log")
         ninja_writer.build(
-            outputs=str(log_path),
+            outputs=self.get_log(),
             rule="verilator_lint" if self.lint_only else "verilator_verilate",
             inputs=self.source_file.get_dependencies(),
-            variables={"name": self.module_name, "args": " ".join(verilator_args)},
+            implicit=implicit,
+            variables={
+                "name": self.module_name,
+                "args": " ".join(verilator_args),
+                "mdir": self.get_staging_dir(),
+                "profile": self.get_verilate_flags(),
+            },
         )
 
-        ninja_writer.newline()
+        if not self.lint_only:
+            self.profile.save(self.get_profile_file())
+            ninja_writer.build(
+                outputs=self.get_compile_ninja(),
+                rule="verilator_model",
+                inputs=self.get_log(),
+                implicit=["verilator.py", self.get_profile_file()],
+                variables={
+                    "top": self.path,
+                    "profile_file": self.get_profile_file(),
+                    "variant": f"--variant {self.variant}" if self.variant else "",
+                },
+            )
 
-    def write_ninja_build_verilate_compile(self, writer):
-        "Writes the ninja rules for compiling a verilated model"
+        ninja_writer.newline()
 
-        ninja_writer = NinjaWriter(writer)
-        ninja_writer.comment(f"Build steps for {self.module_name}")
+    def write_compile_ninja(self):
+        "Writes the compile build steps for the model, only if they changed"
+        compile_ninja = io.StringIO()
+        self.write_ninja_build_verilate_compile(compile_ninja)
+        path = Path(self.get_compile_ninja())
+        if path.is_file() and path.read_text() == compile_ninja.getvalue():
+            return
+        path.write_text(compile_ninja.getvalue())
 
-        cpp_dependencies = self._parse_makefile()
+    def _write_objects(self, ninja_writer, cpp_dependencies, pic=False):
+        """Writes the compile steps of every source of the model, returning the
+        objects. Position independent objects are kept apart in pic/"""
         categories_fast = ["VM_CLASSES_FAST", "VM_SUPPORT_FAST", "VM_GLOBAL_FAST"]
         categories_slow = ["VM_CLASSES_SLOW", "VM_SUPPORT_SLOW", "VM_GLOBAL_SLOW"]
+        flags = {
+            "fast": self.profile.fast_flags + (" -fPIC" if pic else ""),
+            "slow": self.profile.slow_flags + (" -fPIC" if pic else ""),
+        }
+        object_dir = f"{self.get_obj_dir()}/pic" if pic else self.get_obj_dir()
+
+        # Without precompiled header support every source parses the headers itself
+        pch = {}
+        if supports_pch():
+            self.write_pch_headers(pic=pic)
+            for group, args in flags.items():
+                header = self.get_pch_header(group, pic=pic)
+                ninja_writer.build(
+                    outputs=f"{header}.gch",
+                    rule="verilator_pch",
+                    inputs=header,
+                    variables={"args": args},
+                )
+                pch[group] = header
 
         object_paths = []
         for object_group in categories_fast + categories_slow:
             is_global, source_paths = cpp_dependencies[object_group]
             for source_path in source_paths:
                 # Determine where the source file is and where the destination object file is
-                if is_global:
-                    source_path = Path(source_path)
-                    object_path = Path(f"bin/obj_dir/{source_path.stem}.o")
+                source_path = Path(source_path)
+                if is_global or pic:
+                    object_path = Path(f"{object_dir}/{source_path.stem}.o")
                 else:
-                    source_path = Path("bin") / Path(source_path)
-                    object_path = Path(source_path).with_suffix(".o")
-
+                    object_path = source_path.with_suffix(".o")
+
+                group = "fast" if object_group in categories_fast else "slow"
+                variables = {"args": flags[group]}
+                # The runtime sources of verilator do not include the model
+                order_only = None
+                if group in pch and not is_global:
+                    variables["pch"] = f"-include {pch[group]} -Winvalid-pch"
+                    order_only = [f"{pch[group]}.gch"]
                 ninja_writer.build(
                     outputs=str(object_path),
                     rule="verilator_compile",
                     inputs=str(source_path),
-                    variables={
-                        "args": "-O2" if object_group in categories_fast else ""
-                    },
+                    order_only=order_only,
+                    variables=variables,
                 )
                 object_paths.append(str(object_path))
+        return object_paths
+
+    def write_ninja_build_verilate_compile(self, writer):
+        "Writes the ninja rules for compiling a verilated model"
 
+        ninja_writer = NinjaWriter(writer)
+        ninja_writer.comment(f"Build steps for {self.model_name}")
+        ninja_writer.variable("obj_dir", self.get_obj_dir())
+        ninja_writer.variable("profile", self.profile.get_cpp_flags())
+
+        cpp_dependencies = self._parse_makefile()
+        object_paths = self._write_objects(ninja_writer, cpp_dependencies)
         ninja_writer.build(
-            outputs=f"bin/{self.module_name}_simulator",
+            outputs=self.get_simulator(),
             rule="verilator_link",
             inputs=object_paths + [self.cpp_file],
-            variables={"args": "-O2"},
+            variables={
+                "args": self.profile.link_flags,
+                "libs": self.profile.get_libraries(),
+            },
         )
 
+        if self.get_cosim_library() is not None:
+            # The library gets its own position independent objects so the
+            # simulators keep the faster code
+            pic_paths = self._write_objects(ninja_writer, cpp_dependencies, pic=True)
+            ninja_writer.build(
+                outputs=self.get_cosim_library(),
+                rule="verilator_shared",
+                inputs=pic_paths + [self.cosim_file],
+                variables={
+                    "args": self.profile.link_flags,
+                    "libs": self.profile.get_libraries(),
+                },
+            )
+
         ninja_writer.newline()
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parameters_parser = subparsers.add_parser(
+        "parameters", help="write top-level parameters from program stats"
+    )
+    parameters_parser.add_argument("stats", nargs="+", help="program stats files")
+    parameters_parser.add_argument("-o", "--output", required=True)
+    model_parser = subparsers.add_parser(
+        "model", help="merge a verilated model and write its compile build steps"
+    )
+    model_parser.add_argument("top", help="path of the top-level module")
+    model_parser.add_argument("--profile", required=True, help="stored profile")
+    model_parser.add_argument("--variant", default="", help="variant of the model")
+    args = parser.parse_args()
+
+    if args.command == "parameters":
+        write_parameters(args.stats, args.output)
+    elif args.command == "model":
+        # Imported here so the other commands stay cheap to start
+        from sources import SourceFile
+
+        profile = VerilatorProfile.load(args.profile)
+        v = VerilatorProgram(
+            SourceFile(args.top), profile=profile, variant=args.variant
+        )
+        sync_model(v.get_staging_dir(), v.get_obj_dir(), v.get_sync_manifest())
+        v.write_compile_ninja()
+
+
+if __name__ == "__main__":
+    main()
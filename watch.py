@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"Helper classes for waiting on changes to the source folders"
+
+from __future__ import annotations
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from util import debug
+
+# Folders the build is made from
+WATCH_FOLDERS = ["rtl", "wrappers", "tb_cpp", "tests"]
+
+# Editors write a file in several steps, changes this close together are one change
+_SETTLE_SECONDS = 0.05
+
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_ISDIR = 0x4000_0000
+_IN_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+_EVENT = struct.Struct("iIII")
+
+
+def _walk_folders(folders):
+    for folder in folders:
+        for path, _, _ in os.walk(folder):
+            yield path
+
+
+class InotifyWatcher:
+    "Waits on inotify events of every folder under the watched folders (Linux only)"
+
+    def __init__(self, folders) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        for folder in _walk_folders(folders):
+            self._add_folder(folder)
+
+    def _add_folder(self, folder):
+        descriptor = self.libc.inotify_add_watch(
+            self.fd, folder.encode("utf-8"), _IN_MASK
+        )
+        if descriptor < 0:
+            error_number = ctypes.get_errno()
+            # Folders can be removed again before they are watched
+            if error_number != errno.ENOENT:
+                raise OSError(error_number, f"Could not watch {folder}")
+            return
+        self.folders[descriptor] = folder
+
+    def _read(self):
+        changed = set()
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0").decode("utf-8")
+            offset += length
+            folder = self.folders.get(descriptor)
+            if folder is None or name == "":
+                continue
+            path = os.path.join(folder, name)
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    for new_folder in _walk_folders([path]):
+                        self._add_folder(new_folder)
+                continue
+            changed.add(path)
+        return changed
+
+    def wait(self):
+        "Blocks until files change, returning their paths"
+        changed = set()
+        while len(changed) == 0:
+            select.select([self.fd], [], [])
+            changed |= self._read()
+            while select.select([self.fd], [], [], _SETTLE_SECONDS)[0]:
+                changed |= self._read()
+        return changed
+
+    def close(self):
+        "Stops watching"
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    "Compares the modification times of every file on an interval"
+
+    def __init__(self, folders, interval=0.5) -> None:
+        self.folders = folders
+        self.interval = interval
+        self.mtimes = self._scan()
+
+    def _scan(self):
+        mtimes = {}
+        for folder in _walk_folders(self.folders):
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        mtimes[entry.path] = entry.stat().st_mtime_ns
+        return mtimes
+
+    def wait(self):
+        "Blocks until files change, returning their paths"
+        while True:
+            time.sleep(self.interval)
+            mtimes = self._scan()
+            changed = {
+                path
+                for path in mtimes.keys() | self.mtimes.keys()
+                if mtimes.get(path) != self.mtimes.get(path)
+            }
+            self.mtimes = mtimes
+            if len(changed) > 0:
+                return changed
+
+    def close(self):
+        "Stops watching"
+
+
+def get_watcher(folders=None):
+    "Returns an inotify watcher, or one that polls where inotify is not available"
+    if folders is None:
+        folders = WATCH_FOLDERS
+    folders = [folder for folder in folders if os.path.isdir(folder)]
+    try:
+        return InotifyWatcher(folders)
+    except (OSError, AttributeError) as exception:
+        debug(f"Polling for changes, inotify is not available: {exception}")
+        return PollingWatcher(folders)